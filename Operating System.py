@@ -1,127 +1,2913 @@
+import argparse
+import codecs
+import contextlib
+import datetime
+import fnmatch
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import marshal
+import mmap
+import multiprocessing
 import os
+import random
+import re
+import selectors
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
 import time
+import tracemalloc
 import zlib
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import connection
+
+try:
+    import resource  # Unix only: used to cap the memory of sandboxed runs
+except ImportError:
+    resource = None
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import numpy  # Optional: vectorises the fsck pass over the FAT
+except ImportError:
+    numpy = None
 
 # Constants for file system simulation
 DISK_FILE = "disk.img"
-BLOCK_SIZE = 512
-NUM_BLOCKS = 1024
-FAT_TABLE_SIZE = NUM_BLOCKS
+DEFAULT_BLOCK_SIZE = 512  # Block size used by `format` unless another is given
+DEFAULT_NUM_BLOCKS = 1024
+MIN_BLOCK_SIZE, MAX_BLOCK_SIZE = 512, 64 * 1024  # Block sizes are powers of two in this range
+MIN_NUM_BLOCKS, MAX_NUM_BLOCKS = 64, 2 ** 32 - 1  # Block numbers are stored on disk as 32-bit integers
 ROOT_DIR_SIZE = 64
+JOURNAL_BLOCKS = 32  # Write-ahead journal of metadata operations
+METADATA_BLOCKS = 1 + JOURNAL_BLOCKS  # Superblock in block 0, then the journal
+CHECKPOINT_INTERVAL = 30  # Seconds between background metadata checkpoints
+SUPERBLOCK_MAGIC = b"MINIOSFS"
+METADATA_VERSION = 2  # 2: checkpoint folders are separate records, loaded on first access; 1 is still readable
+FAT_FREE, FAT_RESERVED = 0, -2  # Any positive FAT entry is the number of files sharing that block
+ALLOC_POLICIES = ("next-fit", "best-fit")
+CACHE_BLOCKS = 64  # Default number of blocks held by the buffer cache
+STORAGE_ENGINES = ("file", "mmap")
+SEARCH_MODES = ("substring", "prefix", "glob", "regex")
+DENTRY_CACHE_SIZE = 4096  # Folder paths kept by the path-resolution cache
+LATENCY_SAMPLES = 1000  # Recent latencies kept for percentiles, per scheduler and per instrumented operation
+EXEC_WORKERS = 2  # Worker processes that run files
+EXEC_TIMEOUT = 30  # Seconds before a running file is killed (0 = no limit)
+EXEC_MEMORY_LIMIT = 512 * 1024 * 1024  # Address-space cap per worker in bytes (0 = no limit)
+CODE_CACHE_SIZE = 128  # Compiled files kept by the execution engine
+COMPRESSION_CODECS = ("zlib", "bz2", "lzma")
+COMPRESSION_LEVEL = 6  # Default level, 0 (fastest) to 9 (smallest)
+COMPRESSED_CHUNK_BLOCKS = 8  # Blocks' worth of logical bytes per independently compressed chunk
+ARCHIVE_CHUNK = 64 * 1024  # Bytes compressed at a time by `compress`, which bounds its memory use
+FILE_MODES = ("r", "r+", "w", "w+", "a", "a+")
+IO_VECTOR_BYTES = 64 * 1024  # Size of each buffer in a vectored host import/export call
+IO_BATCH_BYTES = 16 * IO_VECTOR_BYTES  # Bytes moved per pwritev/preadv call
+SERVER_WORKERS = 8  # Threads executing client commands
+SERVER_HOST = "127.0.0.1"  # TCP servers only listen locally
+# Console-only commands: whole-disk changes, and everything that runs code or touches host files, since clients
+# are not authenticated and would act with the server owner's permissions
+SERVER_BLOCKED = ("exit", "format", "resize", "serve", "engine", "runner", "benchmark", "script", "run", "schedule",
+                  "import", "export")
+SERVER_BLOCKED_FORMS = (("stats", "json"), ("audit", "config"))  # Console-only once given further arguments
+DISKLESS_COMMANDS = ("format", "help", "exit", "benchmark", "audit", "stats", "script")  # Work with no disk loaded
+RESPONSE_HEADER = struct.Struct("<I")  # Length prefix of every server response
+DEFRAG_RATE = 4096  # Default I/O budget of the background defragmenter, in blocks moved per second
+DEFRAG_IDLE = 5  # Seconds the background defragmenter waits before rescanning a defragmented disk
+AUDIT_FLUSH_BYTES = 64 * 1024  # Buffered audit log entries are written once this many bytes are waiting...
+AUDIT_FLUSH_INTERVAL = 1.0  # ...or the oldest has waited this many seconds
+AUDIT_MAX_BYTES = 1024 * 1024  # Size at which the audit log is rotated
+AUDIT_SEGMENTS = 5  # Rotated audit log segments kept (log.txt.1 is the newest)
+AUDIT_RESULT_CHARS = 200  # Characters of a command's last output line kept as its result
+AUDIT_QUERY_LIMIT = 100  # Most recent matching entries shown by `audit`
+BENCH_BLOCK_SIZE = 4096  # Geometry of the scratch disks used by `benchmark suite`...
+BENCH_VOLUME_SIZE = 1 << 30  # ...sized per unit of scale (sparse, so only written blocks take host space)
+METRICS_ENABLED = True  # Whether instrumentation starts on; `stats on|off` toggles it
+
+
+# Free-space allocator--------------------------------------------------------------------------------------------------
+class BlockAllocator:
+    def __init__(self, num_blocks=DEFAULT_NUM_BLOCKS, reserved=METADATA_BLOCKS, policy="next-fit"):
+        if policy not in ALLOC_POLICIES:
+            raise ValueError(f"Unknown allocation policy '{policy}'.")
+        # Free-space bitmap: one byte per block, 0 = free, 1 = in use
+        self.num_blocks = num_blocks
+        self.reserved = reserved
+        self.policy = policy
+        self.bitmap = bytearray(num_blocks)
+        self.bitmap[:reserved] = b'\x01' * reserved
+        self.free_count = num_blocks - reserved
+        self.spare = 0  # Free blocks held back for the next metadata checkpoint; only `metadata` allocations take them
+        self.cursor = reserved  # Next-fit rover
+        # Free-extent index over the maximal runs of free blocks: (length, start) pairs in sorted order for best-fit,
+        # and each run's length by its start and its start by its (exclusive) end, to split and merge runs
+        self.runs = []
+        self.run_at = {}
+        self.run_ending = {}
+        self._index_runs()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @property
+    def free_runs(self):
+        # Maximal runs of free blocks, a fragmentation measure
+        return len(self.runs)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def allocate_extent(self, count, policy=None, metadata=False):
+        # Hand out `count` contiguous blocks and return the first index, or None if no run is long enough
+        if count <= 0 or count > self.free_count - (0 if metadata else self.spare):
+            return None
+        if (policy or self.policy) == "best-fit":
+            start = self._find_best_fit(count)
+        else:
+            start = self._find_next_fit(count)
+        if start is None:
+            return None
+        self._claim(start, count)
+        return start
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def allocate(self, count, metadata=False):
+        # Hand out `count` blocks as a list, contiguous when possible, otherwise gathered from several free runs
+        if count <= 0:
+            return []
+        if count > self.free_count - (0 if metadata else self.spare):
+            return None
+        start = self.allocate_extent(count, metadata=metadata)
+        if start is not None:
+            return list(range(start, start + count))
+
+        blocks = []
+        position = self.cursor
+        while len(blocks) < count:
+            start = self.bitmap.find(0, position)
+            if start == -1:
+                start = self.bitmap.find(0, self.reserved)
+            end = self.bitmap.find(1, start)
+            if end == -1:
+                end = self.num_blocks
+            end = min(end, start + count - len(blocks))
+            self._claim(start, end - start)
+            blocks.extend(range(start, end))
+            position = end
+        return blocks
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def free(self, start, count=1):
+        if start < self.reserved or start + count > self.num_blocks:
+            raise IndexError(f"Block {start} is outside the data area.")
+        for index in range(start, start + count):
+            if self.bitmap[index]:
+                self.bitmap[index] = 0
+                self.free_count += 1
+                # Merge with the runs just before and just after the block
+                run_start = self.run_ending.get(index, index)
+                if run_start < index:
+                    self._remove_run(run_start)
+                run_end = index + 1 + (self._remove_run(index + 1) if index + 1 in self.run_at else 0)
+                self._add_run(run_start, run_end - run_start)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def mark_used(self, start, count=1):
+        # Record blocks that are already in use (e.g. when rebuilding from the FAT)
+        for index in range(start, start + count):
+            if not self.bitmap[index]:
+                self._take(index, 1)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def load(self, used):
+        # Replace the bitmap with one byte per block (non-zero = in use), e.g. built from the FAT in a single pass
+        self.bitmap = bytearray(used)
+        self.bitmap[:self.reserved] = b'\x01' * self.reserved
+        self.free_count = self.bitmap.count(0)
+        self.cursor = self.reserved
+        self._index_runs()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def resize(self, num_blocks):
+        # Grow or shrink the data area; shrinking is only valid once every block past the new end is free
+        if num_blocks < self.num_blocks:
+            if self.bitmap.find(1, num_blocks) != -1:
+                raise ValueError("Blocks past the new end of the volume are still in use.")
+            self.free_count -= self.num_blocks - num_blocks
+            del self.bitmap[num_blocks:]
+        elif num_blocks > self.num_blocks:
+            self.free_count += num_blocks - self.num_blocks
+            self.bitmap.extend(bytes(num_blocks - self.num_blocks))
+        self.num_blocks = num_blocks
+        if self.cursor >= num_blocks:
+            self.cursor = self.reserved
+        self._index_runs()  # Only the free tail changes, but resizing is rare enough to rescan
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def hold(self, start):
+        # Mark every free block from `start` on as used, so nothing is allocated there until the bitmap is next
+        # loaded from the FAT
+        position = self.bitmap.find(0, start)
+        while position != -1:
+            end = self.bitmap.find(1, position)
+            if end == -1:
+                end = self.num_blocks
+            self._take(position, end - position)
+            position = self.bitmap.find(0, end)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _claim(self, start, count):
+        # Hand out a run of free blocks and move the next-fit rover past it
+        self._take(start, count)
+        self.cursor = start + count
+        if self.cursor >= self.num_blocks:
+            self.cursor = self.reserved
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _take(self, start, count):
+        # Mark free blocks used: they split the run they came from into zero, one or two smaller ones. Best-fit
+        # always takes the start of a run; next-fit's rover usually sits just after a used block.
+        run_start = start if start in self.run_at else self.bitmap.rfind(1, 0, start) + 1
+        run_end = run_start + self._remove_run(run_start)
+        if run_start < start:
+            self._add_run(run_start, start - run_start)
+        if start + count < run_end:
+            self._add_run(start + count, run_end - start - count)
+        self.bitmap[start:start + count] = b'\x01' * count
+        self.free_count -= count
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _add_run(self, start, length):
+        self.run_at[start] = length
+        self.run_ending[start + length] = start
+        insort(self.runs, (length, start))
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _remove_run(self, start):
+        length = self.run_at.pop(start)
+        del self.run_ending[start + length]
+        del self.runs[bisect_left(self.runs, (length, start))]
+        return length
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _index_runs(self):
+        # Rebuild the free-extent index from the bitmap in one pass
+        self.run_at = {run.start(): run.end() - run.start() for run in re.finditer(rb'\x00+', self.bitmap)}
+        self.run_ending = {start + length: start for start, length in self.run_at.items()}
+        self.runs = sorted((length, start) for start, length in self.run_at.items())
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _find_next_fit(self, count):
+        # Search forward from the rover, then wrap around to the start of the data area
+        pattern = bytes(count)
+        start = self.bitmap.find(pattern, self.cursor)
+        if start == -1:
+            start = self.bitmap.find(pattern, self.reserved, self.cursor + count - 1)
+        return None if start == -1 else start
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _find_best_fit(self, count):
+        # Pick the smallest free run that still holds `count` blocks, the lowest one among equals (a binary search
+        # of the free-extent index)
+        i = bisect_left(self.runs, (count, 0))
+        return self.runs[i][1] if i < len(self.runs) else None
+
+
+# Inodes----------------------------------------------------------------------------------------------------------------
+class Inode:
+    # One file: its block map and size, plus the codec, level and compressed chunk lengths when stored compressed.
+    # Folders stay plain dicts of name -> Inode or sub-folder. __slots__ and 32-bit arrays keep a one-block file to
+    # about 206 bytes, plus 4 per extra block, where a dict holding a list of Python ints took about 322, plus 36 per
+    # extra block (as measured by `benchmark memory`).
+    __slots__ = ("blocks", "size", "codec", "level", "chunks", "version")
+
+    def __init__(self, blocks=(), size=0, codec=None, level=0, chunks=None):
+        self.blocks = array('I', blocks)
+        self.size = size
+        self.codec = codec  # None for a plain file
+        self.level = level
+        self.chunks = array('I', chunks or ()) if codec else None
+        self.version = 0  # Content version for the compiled-code cache, assigned on first run
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def copy(self):
+        return Inode(self.blocks, self.size, self.codec, self.level, self.chunks)
+
+
+class LazyDir:
+    # A folder not read from the checkpoint yet: where its record lies in the checkpoint's tree section, and where the
+    # records of everything below it start. Its parent swaps it for the folder dict on first access (_fault_in).
+    __slots__ = ("start", "offset", "length", "count")
+
+    def __init__(self, start, offset, length, count):
+        self.start = start
+        self.offset = offset
+        self.length = length
+        self.count = count  # Entries in the folder, so it can be tested for emptiness without reading it
+
+    def __len__(self):
+        return self.count
+
+
+# On-disk metadata format-----------------------------------------------------------------------------------------------
+# Superblock: magic, version, block size, block count, journal start, journal blocks, first journal sequence number,
+# checkpoint length, checkpoint CRC, extent count; followed by the checkpoint extents and a CRC of the whole record.
+# The top bits of the extent count give the depth of extent tables: a checkpoint too fragmented for its extents to fit
+# in the superblock lists them in blocks of its own, and the superblock lists those instead (see pack_extent_table).
+SUPERBLOCK = struct.Struct("<8sHIIIIQIIH")
+EXTENT = struct.Struct("<II")
+EXTENT_TABLE_SHIFT = 14
+MAX_EXTENT_TABLE_DEPTH = 3
+# Checkpoint (version 2): this header, the zlib-compressed FAT, the dedup index, then the tree section. The header
+# holds the FAT length and compressed length, the storage counters, the dedup flag and entry count, and the root
+# folder's reference. The superblock's checkpoint CRC covers everything before the tree section.
+CHECKPOINT_HEADER = struct.Struct("<II7QBIQQII")
+# Tree section: one record per folder (CRC, then the zlib-compressed entries), subfolders before their parent. A
+# subfolder entry refers to its record by distance back from the parent's record, the size of the records below it,
+# the record length and its entry count, so any folder's records can be copied elsewhere as one unchanged span.
+FOLDER_REF = struct.Struct("<QQII")
+# Journal record header: payload length, payload CRC, sequence number
+JOURNAL_RECORD = struct.Struct("<IIQ")
+OP_CREATE, OP_DELETE, OP_RENAME, OP_MKDIR, OP_RMDIR, OP_UPDATE = range(1, 7)
+DEDUP_DIGEST_SIZE = 16  # BLAKE2b digest bytes per block in the dedup index
+DEDUP_ENTRY = struct.Struct(f"<{DEDUP_DIGEST_SIZE}sI")
+# Archive header written by `compress`: magic, codec, level, original size; followed by the original name and then
+# independently compressed chunks, each prefixed with its length
+ARCHIVE_MAGIC = b"MINIZIP1"
+ARCHIVE_HEADER = struct.Struct("<8sBBQ")
+ARCHIVE_CHUNK_HEADER = struct.Struct("<I")
+
+
+def to_extents(block_chain):
+    # Collapse a block list into (start, count) runs
+    extents = []
+    for block_index in block_chain:
+        if extents and extents[-1][0] + extents[-1][1] == block_index:
+            extents[-1][1] += 1
+        else:
+            extents.append([block_index, 1])
+    return [tuple(extent) for extent in extents]
+
+
+def from_extents(extents):
+    block_chain = []
+    for start, count in extents:
+        block_chain.extend(range(start, start + count))
+    return block_chain
+
+
+def pack_str(text):
+    data = text.encode('utf-8')
+    return struct.pack("<H", len(data)) + data
+
+
+def unpack_str(data, offset):
+    (length,) = struct.unpack_from("<H", data, offset)
+    offset += 2
+    return data[offset:offset + length].decode('utf-8'), offset + length
+
+
+def pack_extents(block_chain):
+    extents = to_extents(block_chain)
+    return struct.pack("<I", len(extents)) + b''.join(EXTENT.pack(*extent) for extent in extents)
+
+
+def unpack_extents(data, offset):
+    (count,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    extents = [EXTENT.unpack_from(data, offset + i * EXTENT.size) for i in range(count)]
+    return from_extents(extents), offset + count * EXTENT.size
+
+
+def pack_compression(file_metadata):
+    # Codec, level and the compressed length of every chunk; the chunk offset table is derived from the lengths
+    chunks = file_metadata.chunks
+    return (struct.pack("<BBI", COMPRESSION_CODECS.index(file_metadata.codec), file_metadata.level, len(chunks))
+            + chunks.tobytes())
+
+
+def unpack_compression(data, offset, file_metadata):
+    codec, level, count = struct.unpack_from("<BBI", data, offset)
+    offset += 6
+    chunks = array('I')
+    chunks.frombytes(data[offset:offset + count * chunks.itemsize])
+    file_metadata.codec, file_metadata.level, file_metadata.chunks = COMPRESSION_CODECS[codec], level, chunks
+    return offset + count * chunks.itemsize
+
+
+def pack_file(file_metadata):
+    # Kind (1 file, 2 compressed file), size and extents, plus the chunk table of a compressed file
+    data = struct.pack("<BQ", 2 if file_metadata.codec else 1, file_metadata.size) + pack_extents(file_metadata.blocks)
+    return data + pack_compression(file_metadata) if file_metadata.codec else data
+
+
+def unpack_file(data, offset):
+    kind = data[offset]
+    (size,) = struct.unpack_from("<Q", data, offset + 1)
+    block_chain, offset = unpack_extents(data, offset + 9)
+    file_metadata = Inode(block_chain, size)
+    if kind == 2:
+        offset = unpack_compression(data, offset, file_metadata)
+    return file_metadata, offset
+
+
+def pack_tree(directory, out, read_span, moved):
+    # Append the records of `directory` and everything below it to the tree section `out`, parent last, and return
+    # the folder's reference (record offset, bytes of records below it, record length, entry count). A folder still
+    # in the old checkpoint is copied over whole: `read_span` returns its bytes, and (stub, new start, new offset)
+    # goes to `moved` so the stub can be pointed at the new checkpoint once it is committed.
+    start = len(out)
+    children = {}
+    for name, content in directory.items():
+        if isinstance(content, LazyDir):
+            span_start = len(out)
+            out += read_span(content)
+            offset = span_start + content.offset - content.start
+            moved.append((content, span_start, offset))
+            children[name] = (offset, offset - span_start, content.length, content.count)
+        elif not isinstance(content, Inode):
+            children[name] = pack_tree(content, out, read_span, moved)
+
+    record_start = len(out)
+    entries = bytearray(struct.pack("<I", len(directory)))
+    for name, content in directory.items():
+        entries += pack_str(name)
+        if isinstance(content, Inode):
+            entries += pack_file(content)
+        else:
+            offset, below, length, count = children[name]
+            entries += b'\x00' + FOLDER_REF.pack(record_start - offset, below, length, count)
+    body = zlib.compress(entries)
+    out += struct.pack("<I", zlib.crc32(body)) + body
+    return record_start, record_start - start, len(out) - record_start, len(directory)
+
+
+def unpack_dir(record, offset):
+    # Folder dict from its record, found at `offset` in the tree section; subfolders become LazyDir stubs
+    (crc,) = struct.unpack_from("<I", record)
+    if zlib.crc32(record[4:]) != crc:
+        raise ValueError(f"Checkpoint folder record at {offset} is corrupt.")
+    data = zlib.decompress(record[4:])
+    directory = {}
+    (count,) = struct.unpack_from("<I", data)
+    position = 4
+    for _ in range(count):
+        name, position = unpack_str(data, position)
+        if data[position]:
+            directory[name], position = unpack_file(data, position)
+        else:
+            back, below, length, entries = FOLDER_REF.unpack_from(data, position + 1)
+            position += 1 + FOLDER_REF.size
+            directory[name] = LazyDir(offset - back - below, offset - back, length, entries)
+    return directory
+
+
+def unpack_tree(data, offset):
+    # Whole directory tree of a version 1 checkpoint: entry count, then per entry name, kind and either the file or
+    # the folder's own entries
+    directory = {}
+    (count,) = struct.unpack_from("<I", data, offset)
+    offset += 4
+    for _ in range(count):
+        name, offset = unpack_str(data, offset)
+        if data[offset]:
+            directory[name], offset = unpack_file(data, offset)
+        else:
+            directory[name], offset = unpack_tree(data, offset + 1)
+    return directory, offset
+
+
+def pack_superblock(block_size, num_blocks, next_seq, checkpoint_extents=(), checkpoint_length=0, checkpoint_crc=0,
+                    table_depth=0):
+    record = SUPERBLOCK.pack(SUPERBLOCK_MAGIC, METADATA_VERSION, block_size, num_blocks, 1, JOURNAL_BLOCKS,
+                             next_seq, checkpoint_length, checkpoint_crc,
+                             len(checkpoint_extents) | table_depth << EXTENT_TABLE_SHIFT)
+    record += b''.join(EXTENT.pack(*extent) for extent in checkpoint_extents)
+    record += struct.pack("<I", zlib.crc32(record))
+    return record.ljust(block_size, b'\x00')
+
+
+def max_checkpoint_extents(block_size):
+    # Checkpoint extents that fit in the superblock block after the header and its CRC
+    return (block_size - SUPERBLOCK.size - 4) // EXTENT.size
+
+
+def pack_extent_table(extents):
+    # Extent count, the extents and a CRC of both, written to blocks of their own
+    record = struct.pack("<I", len(extents)) + b''.join(EXTENT.pack(*extent) for extent in extents)
+    return record + struct.pack("<I", zlib.crc32(record))
+
+
+def unpack_extent_table(data):
+    (count,) = struct.unpack_from("<I", data)
+    end = 4 + count * EXTENT.size
+    (stored_crc,) = struct.unpack_from("<I", data, end)
+    if zlib.crc32(data[:end]) != stored_crc:
+        raise ValueError("Checkpoint extent table is corrupt.")
+    return [EXTENT.unpack_from(data, 4 + i * EXTENT.size) for i in range(count)]
+
+
+def valid_block_size(block_size):
+    return MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE and block_size & (block_size - 1) == 0
+
+
+def parse_size(text):
+    # Byte count with an optional K, M or G suffix (powers of 1024), e.g. "4096", "64K", "2G"
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper().removesuffix("B")
+    if text and text[-1] in units:
+        return int(text[:-1]) * units[text[-1]]
+    return int(text)
+
+
+def new_fat(num_blocks):
+    # One machine int per block (4 bytes instead of a Python object per entry), all free
+    return array('i', [FAT_FREE]) * num_blocks
+
+
+NONZERO = bytes(1) + b'\x01' * 255  # bytes.translate table flagging non-zero bytes
+
+
+def fat_bitmap(fat):
+    # One byte per block, 1 where the FAT entry is non-zero. Each byte position of the entries is flagged and the
+    # positions are OR-ed together as big integers, so millions of entries take milliseconds instead of a Python loop.
+    flags = fat.tobytes().translate(NONZERO)
+    used = 0
+    for i in range(fat.itemsize):
+        used |= int.from_bytes(flags[i::fat.itemsize], 'little')
+    return used.to_bytes(len(fat), 'little')
+
+
+# Compression codecs----------------------------------------------------------------------------------------------------
+CODEC_ERRORS = (zlib.error, OSError, EOFError, ValueError, struct.error) + ((lzma.LZMAError,) if lzma else ())
+
+
+def available_codecs():
+    modules = {"zlib": zlib, "bz2": bz2, "lzma": lzma}
+    return [codec for codec in COMPRESSION_CODECS if modules[codec] is not None]
+
+
+def new_compressor(codec, level):
+    # Fresh streaming compressor; every chunk gets its own so chunks can be decompressed independently
+    if codec == "zlib":
+        return zlib.compressobj(level)
+    if codec == "bz2":
+        return bz2.BZ2Compressor(max(1, level))
+    return lzma.LZMACompressor(preset=level)
+
+
+def compress_chunk(codec, level, data):
+    compressor = new_compressor(codec, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_chunk(codec, data):
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "bz2":
+        return bz2.decompress(data)
+    return lzma.decompress(data)
+
+
+class ByteStream:
+    def __init__(self, chunks):
+        # Reads exact byte counts from an iterator of chunks without holding more than one chunk
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def read(self, count):
+        while len(self.buffer) < count:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+
+# Metadata journal------------------------------------------------------------------------------------------------------
+class Journal:
+    def __init__(self, write_raw, flush, block_size, start_block=1, num_blocks=JOURNAL_BLOCKS):
+        # Append-only log of metadata operations; each append writes only the block(s) the record touches
+        self.write_raw = write_raw
+        self.flush = flush
+        self.block_size = block_size
+        self.start_block = start_block
+        self.capacity = num_blocks * self.block_size
+        self.position = 0  # Bytes used since the last checkpoint
+        self.tail = b''  # Contents of the partially filled block at `position`
+        self.next_seq = 1
+        self.records = 0
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def reset(self, next_seq):
+        self.position = 0
+        self.tail = b''
+        self.next_seq = next_seq
+        self.records = 0
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def append(self, payload):
+        # Returns False when the record does not fit and a checkpoint is needed first. Once it returns True the
+        # record (and the file data written before it) is on stable storage, so a crash cannot lose the operation.
+        record = JOURNAL_RECORD.pack(len(payload), zlib.crc32(payload), self.next_seq) + payload
+        if self.position + len(record) > self.capacity:
+            return False
+        data = self.tail + record
+        first_block = self.position // self.block_size
+        padded = data.ljust((len(data) + self.block_size - 1) // self.block_size * self.block_size, b'\x00')
+        self.write_raw(self.start_block + first_block, padded)
+        self.flush(durable=True)
+        self.position += len(record)
+        self.tail = data[len(data) - self.position % self.block_size:] if self.position % self.block_size else b''
+        self.next_seq += 1
+        self.records += 1
+        return True
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def scan(self, data, first_seq):
+        # Yield the valid payloads in `data` (the raw journal area), stopping at the first torn or stale record
+        self.reset(first_seq)
+        offset = 0
+        while offset + JOURNAL_RECORD.size <= len(data):
+            length, crc, seq = JOURNAL_RECORD.unpack_from(data, offset)
+            payload = data[offset + JOURNAL_RECORD.size:offset + JOURNAL_RECORD.size + length]
+            if seq != self.next_seq or len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            yield payload
+            offset += JOURNAL_RECORD.size + length
+            self.next_seq += 1
+            self.records += 1
+        self.position = offset
+        self.tail = data[offset - offset % self.block_size:offset]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def usage(self):
+        return self.position / self.capacity
+
+
+# Filename index--------------------------------------------------------------------------------------------------------
+class NameIndex:
+    def __init__(self):
+        # Each name's trigrams map to the full paths containing them, for substring and glob queries, and a sorted
+        # list of (name, path) pairs answers prefix queries; patterns too short for a trigram are checked by scanning
+        self.names = {}  # full path -> entry name
+        self.grams = {}  # trigram -> set of full paths
+        self.by_name = []  # (entry name, full path), sorted
+        self.added = []  # Entries added since by_name was last sorted, merged in by the next query or removal
+        self.complete = True  # False until a lazily loaded tree is indexed; add/remove are skipped until then
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _grams(self, name):
+        return {name[i:i + 3] for i in range(len(name) - 2)}
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def add(self, path):
+        if not self.complete or path in self.names:
+            return
+        name = path.rsplit("/", 1)[-1]
+        self.names[path] = name
+        self.added.append((name, path))
+        for gram in self._grams(name):
+            self.grams.setdefault(gram, set()).add(path)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def remove(self, path):
+        name = self.names.pop(path, None)
+        if name is None:
+            return
+        by_name = self._sorted()
+        del by_name[bisect_left(by_name, (name, path))]
+        for gram in self._grams(name):
+            postings = self.grams.get(gram)
+            if postings is not None:
+                postings.discard(path)
+                if not postings:
+                    del self.grams[gram]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def clear(self, complete=True):
+        self.names.clear()
+        self.grams.clear()
+        self.by_name.clear()
+        self.added.clear()
+        self.complete = complete
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _sorted(self):
+        # by_name with recent additions merged in: a few by binary insertion, a bulk load with one sort
+        if len(self.added) > 64:
+            self.by_name += self.added
+            self.by_name.sort()
+        else:
+            for entry in self.added:
+                insort(self.by_name, entry)
+        self.added.clear()
+        return self.by_name
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _candidates(self, literal):
+        # Paths whose names may contain `literal`: those holding all of its trigrams, or every path if it has none
+        if len(literal) < 3:
+            return self.names.keys()
+        postings = []
+        for gram in self._grams(literal):
+            if gram not in self.grams:
+                return ()
+            postings.append(self.grams[gram])
+        postings.sort(key=len)
+        smallest, others = postings[0], postings[1:]
+        return [path for path in smallest if all(path in other for other in others)]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _prefixed(self, prefix):
+        # Paths whose names start with `prefix`, in name order, found by binary search
+        by_name = self._sorted()
+        for i in range(bisect_left(by_name, (prefix,)), len(by_name)):
+            name, path = by_name[i]
+            if not name.startswith(prefix):
+                break
+            yield path
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def search(self, pattern, mode="substring", limit=None):
+        # Matching paths in path order; prefix matches come in name order, so a limit stops the search early
+        if mode == "prefix":
+            return list(itertools.islice(self._prefixed(pattern), limit))
+        if mode == "substring":
+            candidates = self._candidates(pattern)
+            matches = lambda name: pattern in name
+        elif mode == "glob":
+            # Narrow down with the longest literal run in the pattern, or else the literal it starts with, then
+            # check the full glob
+            literals = re.split(r"[*?]", re.sub(r"\[[^\]]*\]", "*", pattern))
+            literal = max(literals, key=len)
+            if len(literal) >= 3:
+                candidates = self._candidates(literal)
+            else:
+                candidates = self._prefixed(literals[0]) if literals[0] else self.names.keys()
+            matches = lambda name: fnmatch.fnmatchcase(name, pattern)
+        elif mode == "regex":
+            regex = re.compile(pattern)
+            candidates = self.names.keys()
+            matches = lambda name: regex.search(name) is not None
+        else:
+            raise ValueError(f"Unknown search mode '{mode}'.")
+
+        found = (path for path in candidates if matches(self.names[path]))
+        return heapq.nsmallest(limit, found) if limit else sorted(found)
+
+
+# Buffer cache----------------------------------------------------------------------------------------------------------
+class BufferCache:
+    def __init__(self, capacity, read_block, write_block):
+        # `read_block` / `write_block` go straight to the disk image; the cache only calls them on misses and write-back
+        self.capacity = max(1, capacity)
+        self.read_through = read_block
+        self.write_through = write_block
+        self.blocks = OrderedDict()  # block index -> data, least recently used first
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        self.mutex = threading.RLock()  # Readers of different files may use the cache at the same time
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def read(self, block_index):
+        with self.mutex:
+            data = self.blocks.get(block_index)
+            if data is not None:
+                self.blocks.move_to_end(block_index)
+                self.hits += 1
+                return data
+            self.misses += 1
+            data = self.read_through(block_index)
+            self.blocks[block_index] = data
+            self._evict()
+            return data
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def write(self, block_index, data):
+        # Write-back: the block only reaches the disk on eviction or sync
+        with self.mutex:
+            self.blocks[block_index] = data
+            self.blocks.move_to_end(block_index)
+            self.dirty.add(block_index)
+            self._evict()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def discard(self, block_index):
+        # Drop a block without writing it back (e.g. it was freed)
+        with self.mutex:
+            self.blocks.pop(block_index, None)
+            self.dirty.discard(block_index)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def sync(self):
+        # Write every dirty block back in disk order and return how many were written
+        with self.mutex:
+            written = 0
+            for block_index in sorted(self.dirty):
+                self.write_through(block_index, self.blocks[block_index])
+                written += 1
+            self.writebacks += written
+            self.dirty.clear()
+            return written
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def sync_blocks(self, block_indices):
+        # Write back just the given blocks (used to order file data before the journal record that points at it)
+        with self.mutex:
+            for block_index in block_indices:
+                if block_index in self.dirty:
+                    self.dirty.discard(block_index)
+                    self.write_through(block_index, self.blocks[block_index])
+                    self.writebacks += 1
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def clear(self):
+        with self.mutex:
+            self.blocks.clear()
+            self.dirty.clear()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def resize(self, capacity):
+        with self.mutex:
+            self.capacity = max(1, capacity)
+            self._evict()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _evict(self):
+        while len(self.blocks) > self.capacity:
+            block_index, data = self.blocks.popitem(last=False)
+            self.evictions += 1
+            if block_index in self.dirty:
+                self.dirty.discard(block_index)
+                self.write_through(block_index, data)
+                self.writebacks += 1
+
+
+# Job scheduler---------------------------------------------------------------------------------------------------------
+class Scheduler:
+    def __init__(self, run_job):
+        # Min-heap of (due time, job id) serviced by one background thread; `run_job` is called with each due job
+        self.run_job = run_job
+        self.jobs = {}  # job id -> job dict
+        self.queue = []
+        self.condition = threading.Condition()
+        self.next_id = 1
+        self.thread = None
+        self.stopped = False
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)  # Seconds between each job's due time and its dispatch
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def schedule(self, path, delay, interval=None):
+        with self.condition:
+            job = {"id": self.next_id, "path": path, "due": time.monotonic() + delay, "interval": interval,
+                   "runs": 0, "total_latency": 0.0, "max_latency": 0.0}
+            self.next_id += 1
+            self.jobs[job["id"]] = job
+            heapq.heappush(self.queue, (job["due"], job["id"]))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+            return job
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def cancel(self, job_id):
+        # The heap entry is left behind and skipped when it surfaces
+        with self.condition:
+            return self.jobs.pop(job_id, None) is not None
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _next_due_job(self):
+        # Wait until the earliest live job is due and pop it; returns None once stopped
+        with self.condition:
+            while not self.stopped:
+                while self.queue:
+                    due, job_id = self.queue[0]
+                    job = self.jobs.get(job_id)
+                    if job is not None and job["due"] == due:
+                        break
+                    heapq.heappop(self.queue)  # Cancelled or rescheduled
+                if not self.queue:
+                    self.condition.wait()
+                    continue
+                delay = self.queue[0][0] - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+
+                due, job_id = heapq.heappop(self.queue)
+                job = self.jobs[job_id]
+                now = time.monotonic()
+                latency = now - due
+                self.latencies.append(latency)
+                job["runs"] += 1
+                job["total_latency"] += latency
+                job["max_latency"] = max(job["max_latency"], latency)
+                if job["interval"]:
+                    job["due"] = max(due + job["interval"], now)  # Fixed rate, without a burst of catch-up runs
+                    heapq.heappush(self.queue, (job["due"], job_id))
+                else:
+                    del self.jobs[job_id]
+                return job
+            return None
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _loop(self):
+        while True:
+            job = self._next_due_job()
+            if job is None:
+                return
+            self.run_job(job)
+
+
+# Execution engine------------------------------------------------------------------------------------------------------
+class PipeWriter:
+    def __init__(self, conn):
+        # Stands in for stdout/stderr inside a worker and streams each completed line back to the parent
+        self.conn = conn
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        if "\n" in self.buffer:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            self.conn.send(("out", self.buffer))
+            self.buffer = ""
+
+
+def execution_worker(conn, memory_limit):
+    # Worker process: runs marshalled code objects received on `conn` in a fresh namespace
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    stream = PipeWriter(conn)
+    sys.stdout = sys.stderr = stream
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        try:
+            exec(marshal.loads(message), {"__name__": "__main__"})
+            status = "ok"
+        except MemoryError:
+            status = "Memory limit exceeded."
+        except SystemExit:
+            status = "ok"
+        except BaseException as e:
+            status = f"{type(e).__name__}: {e}"
+        stream.flush()
+        conn.send(("done", status))
+
+
+class ExecutionEngine:
+    def __init__(self, workers=EXEC_WORKERS, timeout=EXEC_TIMEOUT, memory_limit=EXEC_MEMORY_LIMIT):
+        # Pool of worker processes, each with its own pipe so a hung or crashed run can be killed on its own
+        self.size = max(1, workers)
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        # Workers come from a fork server where available, so they never inherit a lock that another thread held at
+        # fork time (the console thread sits in input() holding stdin's lock while server threads submit runs)
+        forkserver = "forkserver" in multiprocessing.get_all_start_methods()
+        self.context = multiprocessing.get_context("forkserver" if forkserver else None)
+        self.workers = []  # dicts: process, conn, task
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.wakeup_reader = self.wakeup_writer = None  # Wakes the dispatcher thread; open only while it runs
+        self.thread = None
+        self.stopped = False
+        self.next_id = 1
+        self.code_cache = OrderedDict()  # (path, content version) -> marshalled code object
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.completed = 0
+        self.timeouts = 0
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def compile(self, key, read_source, filename):
+        # Compiled code for `key`, calling `read_source` only on a cache miss; raises SyntaxError
+        with self.lock:
+            code = self.code_cache.get(key)
+            if code is not None:
+                self.code_cache.move_to_end(key)
+                self.cache_hits += 1
+                return code
+            self.cache_misses += 1
+        code = marshal.dumps(compile(read_source(), filename, "exec"))
+        with self.lock:
+            self.code_cache[key] = code
+            if len(self.code_cache) > CODE_CACHE_SIZE:
+                self.code_cache.popitem(last=False)
+        return code
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def invalidate(self, path):
+        with self.lock:
+            for key in [key for key in self.code_cache if key[0] == path]:
+                del self.code_cache[key]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def submit(self, code, on_output, on_done=None):
+        with self.lock:
+            task = {"id": self.next_id, "code": code, "on_output": on_output, "on_done": on_done,
+                    "done": threading.Event(), "status": None, "started": None}
+            self.next_id += 1
+            if self.thread is None:
+                self.stopped = False
+                self.workers = [self._spawn_worker() for _ in range(self.size)]
+                self.wakeup_reader, self.wakeup_writer = self.context.Pipe(duplex=False)
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+            self.pending.append(task)
+        self.wakeup_writer.send(None)
+        return task
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def wait(self, task):
+        task["done"].wait()
+        return task["status"]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def busy(self):
+        with self.lock:
+            return sum(1 for worker in self.workers if worker["task"] is not None), len(self.pending)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def shutdown(self):
+        with self.lock:
+            thread, self.thread = self.thread, None
+            self.stopped = True
+            reader, writer = self.wakeup_reader, self.wakeup_writer
+        if thread is None:
+            return
+        writer.send(None)
+        thread.join()
+        reader.close()
+        writer.close()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _spawn_worker(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=execution_worker, args=(child_conn, self.memory_limit), daemon=True)
+        process.start()
+        child_conn.close()
+        return {"process": process, "conn": parent_conn, "task": None}
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _finish(self, worker, status):
+        task, worker["task"] = worker["task"], None
+        task["status"] = status
+        self.completed += 1
+        if task["on_done"] is not None:
+            task["on_done"](status)
+        task["done"].set()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _replace(self, worker):
+        worker["process"].terminate()
+        worker["process"].join()
+        worker["conn"].close()
+        self.workers[self.workers.index(worker)] = self._spawn_worker()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _loop(self):
+        # Hands pending tasks to idle workers, relays their output and enforces the timeout
+        while True:
+            with self.lock:
+                if self.stopped:
+                    break
+                for worker in self.workers:
+                    if worker["task"] is None and self.pending:
+                        task = self.pending.popleft()
+                        task["started"] = time.monotonic()
+                        worker["task"] = task
+                        worker["conn"].send(task["code"])
+                workers = list(self.workers)
+
+            ready = connection.wait([worker["conn"] for worker in workers] + [self.wakeup_reader], timeout=0.5)
+            for conn in ready:
+                if conn is self.wakeup_reader:
+                    conn.recv()
+                    continue
+                worker = next(worker for worker in workers if worker["conn"] is conn)
+                try:
+                    kind, data = conn.recv()
+                except (EOFError, OSError):
+                    if worker["task"] is not None:
+                        self._finish(worker, "Worker process exited unexpectedly.")
+                    with self.lock:
+                        self._replace(worker)
+                    continue
+                if kind == "out" and worker["task"] is not None:
+                    worker["task"]["on_output"](data)
+                elif kind == "done":
+                    self._finish(worker, data)
+
+            if self.timeout:
+                now = time.monotonic()
+                for worker in workers:
+                    task = worker["task"]
+                    if task is not None and now - task["started"] > self.timeout:
+                        self.timeouts += 1
+                        with self.lock:
+                            self._replace(worker)
+                        self._finish(worker, f"Timed out after {self.timeout} seconds.")
+
+        for worker in self.workers:
+            try:
+                worker["conn"].send(None)
+            except OSError:
+                pass
+            worker["process"].join(1)
+            if worker["process"].is_alive():
+                worker["process"].terminate()
+            worker["conn"].close()
+        for task in self.pending:
+            task["status"] = "Execution engine stopped."
+            task["done"].set()
+        self.pending.clear()
+        self.workers = []
+
+
+# File handles----------------------------------------------------------------------------------------------------------
+class FileHandle:
+    def __init__(self, fs, path, file_metadata, mode):
+        # Open file with its own position; writes touch only the blocks they cover and are journaled on flush/close
+        self.fs = fs
+        self.path = path
+        self.metadata = file_metadata
+        self.mode = mode
+        self.position = 0
+        self.dirty = False
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __iter__(self):
+        return self.blocks()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def read(self, size=-1):
+        with self.fs.lock:
+            self._check("r")
+            remaining = self.metadata.size - self.position
+            size = remaining if size is None or size < 0 else min(size, remaining)
+            data = self.fs._read_range(self.metadata, self.position, size)
+            self.position += len(data)
+            return data
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def write(self, data):
+        with self.fs.lock:
+            self._check("w")
+            if self.mode.startswith("a"):
+                self.position = self.metadata.size
+            self._fill_to(self.position)  # Writing past the end leaves a zero-filled gap
+            if not self.fs._write_range(self.metadata, self.position, data):
+                raise OSError("No free space left on the disk.")
+            self.position += len(data)
+            self.dirty = True
+            return len(data)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def append(self, data):
+        with self.fs.lock:
+            self.seek(0, os.SEEK_END)
+            return self.write(data)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def seek(self, offset, whence=os.SEEK_SET):
+        with self.fs.lock:
+            self._check()
+            base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.metadata.size}[whence]
+            if base + offset < 0:
+                raise ValueError("Negative seek position.")
+            self.position = base + offset
+            return self.position
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def tell(self):
+        return self.position
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def truncate(self, size=None):
+        with self.fs.lock:
+            self._check("w")
+            size = self.position if size is None else size
+            if size < 0:
+                raise ValueError("Negative size.")
+            if not self.fs._truncate(self.metadata, size):
+                raise OSError("No free space left on the disk.")
+            self._fill_to(size)
+            self.dirty = True
+            return size
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def blocks(self):
+        # Generator over the file's blocks from the current position on, one block in memory at a time
+        self._check("r")
+        while True:
+            block = self.read(self.fs.block_size)
+            if not block:
+                return
+            yield block
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def flush(self):
+        with self.fs.lock:
+            self._check()
+            if self.dirty:
+                self.fs._commit_write(self.path, self.metadata)
+                self.dirty = False
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def close(self):
+        with self.fs.lock:
+            if not self.closed:
+                if self.dirty and self._still_linked():
+                    self.flush()
+                self.closed = True
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _fill_to(self, size):
+        # Extend the file with zeros up to `size`, one bounded piece at a time
+        while self.metadata.size < size:
+            gap = min(ARCHIVE_CHUNK, size - self.metadata.size)
+            if not self.fs._write_range(self.metadata, self.metadata.size, bytes(gap)):
+                raise OSError("No free space left on the disk.")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _still_linked(self):
+        dir_content, name, _ = self.fs.resolve_path(self.path)
+        return dir_content is not None and dir_content.get(name) is self.metadata
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _check(self, access=None):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+        if access == "r" and self.mode in ("w", "a"):
+            raise io.UnsupportedOperation("File not open for reading.")
+        if access == "w" and self.mode == "r":
+            raise io.UnsupportedOperation("File not open for writing.")
+        if not self._still_linked():
+            raise ValueError(f"'{self.path}' was deleted or moved while open.")
+
+
+# Locking---------------------------------------------------------------------------------------------------------------
+class RWLock:
+    def __init__(self):
+        # Many readers or one writer; a waiting writer holds back new readers so it cannot be starved
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def acquire(self, mode):
+        with self.condition:
+            if mode == "w":
+                self.waiting_writers += 1
+                while self.writer or self.readers:
+                    self.condition.wait()
+                self.waiting_writers -= 1
+                self.writer = True
+            else:
+                while self.writer or self.waiting_writers:
+                    self.condition.wait()
+                self.readers += 1
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def release(self, mode):
+        with self.condition:
+            if mode == "w":
+                self.writer = False
+            else:
+                self.readers -= 1
+            self.condition.notify_all()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def hold(self, mode):
+        self.acquire(mode)
+        try:
+            yield
+        finally:
+            self.release(mode)
+
+
+class LockTable:
+    def __init__(self):
+        # Reader/writer lock per absolute path, created on first use and dropped when nobody holds or waits for it
+        self.mutex = threading.Lock()
+        self.locks = {}  # path -> [RWLock, number of holders and waiters]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def hold(self, requests):
+        # Take every (path, mode) in path order, so two commands never wait on each other's locks
+        modes = {}
+        for path, mode in requests:
+            if modes.get(path) != "w":
+                modes[path] = mode
+        held = []
+        try:
+            for path in sorted(modes):
+                with self.mutex:
+                    entry = self.locks.setdefault(path, [RWLock(), 0])
+                    entry[1] += 1
+                try:
+                    entry[0].acquire(modes[path])
+                except BaseException:
+                    self._drop(path, entry)
+                    raise
+                held.append((path, entry))
+            yield
+        finally:
+            for path, entry in reversed(held):
+                entry[0].release(modes[path])
+                self._drop(path, entry)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _drop(self, path, entry):
+        with self.mutex:
+            entry[1] -= 1
+            if not entry[1]:
+                del self.locks[path]
+
+
+# Instrumentation-------------------------------------------------------------------------------------------------------
+class Metrics:
+    def __init__(self):
+        # Call counts, total and maximum latency and the last LATENCY_SAMPLES latencies (for percentiles) of each
+        # timed operation, plus plain counters such as bytes moved and system calls made. Off, nothing is recorded.
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.timings = {}  # operation name -> {"calls", "total", "max", "samples"}
+        self.since = time.time()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def observe(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {"calls": 0, "total": 0.0, "max": 0.0,
+                                               "samples": deque(maxlen=LATENCY_SAMPLES)}
+            timing["calls"] += 1
+            timing["total"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+            timing["samples"].append(seconds)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.timings.clear()
+            self.since = time.time()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def snapshot(self):
+        # Everything recorded so far as plain JSON-ready data; latencies in milliseconds
+        with self.lock:
+            counters = dict(sorted(self.counters.items()))
+            timings = [(name, timing["calls"], timing["total"], timing["max"], sorted(timing["samples"]))
+                       for name, timing in sorted(self.timings.items())]
+        latency = {}
+        for name, calls, total, longest, samples in timings:
+            def percentile(fraction):
+                return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000, 4)
+
+            latency[name] = {"calls": calls, "total_ms": round(total * 1000, 4),
+                             "mean_ms": round(total / calls * 1000, 4), "p50_ms": percentile(0.5),
+                             "p95_ms": percentile(0.95), "p99_ms": percentile(0.99), "max_ms": round(longest * 1000, 4)}
+        return {"enabled": self.enabled, "since": round(self.since, 3), "counters": counters, "latency": latency}
+
+
+def instrumented(name):
+    # Time every call of a FileSystem method into self.metrics under `name`. While metrics are off the instance
+    # shadows the method with the undecorated one (see FileSystem.set_instrumentation), so calls cost nothing extra.
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.observe(name, time.perf_counter() - started)
+        wrapper.metric_name = name
+        return wrapper
+    return decorate
+
+
+# Audit log-------------------------------------------------------------------------------------------------------------
+def parse_time(text):
+    # A point in time for audit queries: an ISO date/time ("2024-05-01", "2024-05-01T13:00") or an age such as
+    # "90s", "15m", "2h" or "7d" before now
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    text = text.strip()
+    if text[-1:].lower() in units and text[:-1].replace(".", "", 1).isdigit():
+        return time.time() - float(text[:-1]) * units[text[-1].lower()]
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+
+class AuditLog:
+    def __init__(self, path, max_bytes=AUDIT_MAX_BYTES, segments=AUDIT_SEGMENTS, compress=True):
+        # Entries are JSON lines buffered in memory and appended by one background writer, a group at a time, once
+        # AUDIT_FLUSH_BYTES are waiting or the oldest has waited AUDIT_FLUSH_INTERVAL. The file stays open between
+        # groups. Past `max_bytes` it is rotated to path.1 (gzipped if `compress`), path.1 to path.2, and so on.
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segments = segments
+        self.compress = compress
+        self.pending = []  # Encoded entries not yet written
+        self.pending_bytes = 0
+        self.oldest = 0.0  # When the oldest pending entry was recorded
+        self.condition = threading.Condition()
+        self.write_lock = threading.Lock()  # One group write or rotation at a time
+        self.file = None
+        self.thread = None
+        self.closed = False  # Once closed, entries are written straight through
+        self.entries = self.flushes = self.rotations = 0
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def record(self, entry):
+        line = json.dumps(entry, separators=(",", ":")) + "\n"
+        with self.condition:
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.pending.append(line)
+            self.pending_bytes += len(line)
+            closed = self.closed
+            if not closed and self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True)
+                self.thread.start()
+            elif self.pending_bytes >= AUDIT_FLUSH_BYTES:
+                self.condition.notify()
+        if closed:
+            self.flush()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def flush(self):
+        # Write every pending entry with a single write call
+        with self.write_lock:
+            with self.condition:
+                lines, self.pending, self.pending_bytes = self.pending, [], 0
+            if lines:
+                if self.file is None:
+                    self.file = open(self.path, 'a', encoding='utf-8')
+                self.file.write("".join(lines))
+                self.file.flush()
+                self.entries += len(lines)
+                self.flushes += 1
+                if self.file.tell() >= self.max_bytes:
+                    self._rotate()
+            if self.closed and self.file is not None:
+                self.file.close()
+                self.file = None
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def configure(self, max_bytes, segments, compress):
+        with self.write_lock:
+            self.max_bytes, self.segments, self.compress = max_bytes, segments, compress
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def segment(self, number):
+        # Name of rotated segment `number` (1 is the newest), or None if there is none
+        for name in (f"{self.path}.{number}.gz", f"{self.path}.{number}"):
+            if os.path.exists(name):
+                return name
+        return None
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def query(self, since=None, until=None, command=None):
+        # Yield the entries recorded between `since` and `until` (epoch seconds) whose command name is `command`,
+        # oldest first. Lines written before entries were structured only carry the command.
+        self.flush()
+        names = [self.segment(number) for number in range(self.segments, 0, -1)] + [self.path]
+        for name in names:
+            if name is None or not os.path.exists(name):
+                continue
+            opener = gzip.open if name.endswith(".gz") else open
+            with opener(name, 'rt', encoding='utf-8', errors='replace') as log:
+                for line in log:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        entry = None
+                    if not isinstance(entry, dict):
+                        entry = {"command": line.strip()}
+                    timestamp = entry.get("ts")
+                    if (since is not None or until is not None) and timestamp is None:
+                        continue
+                    if since is not None and timestamp < since or until is not None and timestamp > until:
+                        continue
+                    if command is not None and entry.get("command", "").split()[:1] != [command]:
+                        continue
+                    yield entry
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.closed and self.pending_bytes < AUDIT_FLUSH_BYTES:
+                    if not self.pending:
+                        self.condition.wait()
+                        continue
+                    delay = self.oldest + AUDIT_FLUSH_INTERVAL - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if self.closed:
+                    return  # close() writes what is left
+            self.flush()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _rotate(self):
+        # Called with write_lock held, after a group write took the file past max_bytes
+        self.file.close()
+        self.file = None
+        oldest = self.segment(self.segments)
+        if oldest is not None:
+            os.remove(oldest)
+        for number in range(self.segments - 1, 0, -1):
+            name = self.segment(number)
+            if name is not None:
+                os.replace(name, f"{self.path}.{number + 1}" + (".gz" if name.endswith(".gz") else ""))
+        if self.compress:
+            with open(self.path, 'rb') as source, gzip.open(f"{self.path}.1.gz", 'wb') as target:
+                while chunk := source.read(ARCHIVE_CHUNK):
+                    target.write(chunk)
+            os.remove(self.path)
+        else:
+            os.replace(self.path, f"{self.path}.1")
+        self.rotations += 1
+
+
+# Initialize the file system--------------------------------------------------------------------------------------------
+class FileSystem:
+    def __init__(self, alloc_policy="next-fit", cache_size=CACHE_BLOCKS, storage_engine="file", disk_file=DISK_FILE):
+        try:
+            self.disk_file = disk_file  # Host path of the disk image
+            self.metrics = Metrics()  # Latency and I/O instrumentation, first since every timed method reads it
+            self.disk = None
+            self.seek_lock = threading.Lock()  # Only needed where positional I/O is unavailable
+            self.storage_engine = storage_engine
+            self.disk_map = None  # mmap of the disk image when storage_engine == "mmap"
+            self.disk_view = None  # memoryview over disk_map, sliced for zero-copy block access
+            self.block_size = DEFAULT_BLOCK_SIZE  # Geometry of the open disk, read from its superblock
+            self.num_blocks = DEFAULT_NUM_BLOCKS
+            self.fat = new_fat(self.num_blocks)
+            self.fat[:METADATA_BLOCKS] = array('i', [FAT_RESERVED]) * METADATA_BLOCKS  # Superblock and journal
+            self.allocator = BlockAllocator(self.num_blocks, METADATA_BLOCKS, alloc_policy)
+            self.cache = BufferCache(cache_size, self._disk_read, self._disk_write)
+            self.journal = Journal(self._disk_write, self._flush_disk, self.block_size)
+            self.checkpoint_blocks = []  # Blocks holding the current metadata checkpoint
+            self.checkpoint_tables = []  # Blocks listing its extents when they do not fit in the superblock
+            self.checkpoint_tree = 0  # Where the checkpoint's tree section starts, for folders not loaded yet
+            self.folders_loaded = 0  # Folders read from the checkpoint on first access since startup
+            self.faulted = None  # (stub, its subfolder stubs) for folders loaded while a checkpoint is being written
+            self.dedup = False  # Content-addressed dedup of newly written blocks
+            self.dedup_index = {}  # Block digest -> block index
+            self.block_digests = {}  # Block index -> digest, to drop index entries when a block changes
+            self.dedup_hits = 0
+            # Storage counters, kept in step by every command that links, unlinks or rewrites a file (see _account)
+            self.file_count = self.logical_bytes = self.stored_bytes = self.block_refs = 0
+            self.compressed_files = self.compressed_bytes = self.compressed_blocks = 0
+            self.lock = threading.RLock()  # Serialises commands with the background checkpointer
+            self.checkpointer = None
+            self.defragger = None  # Background defragmenter thread, when running
+            self.defrag_stop = threading.Event()
+            self.defrag_rate = DEFRAG_RATE
+            self.defrag_moved = 0  # Blocks and files relocated by the background defragmenter
+            self.defrag_files = 0
+            self.checkpoint_wakeup = threading.Event()
+            self.checkpoint_stop = threading.Event()
+            self.root_dir = {"/": {}}  # Root directory structure
+            self.name_index = NameIndex()  # Kept in step with root_dir by every mutating command
+            self.dentries = OrderedDict()  # Absolute folder path -> folder dict, least recently used first
+            self.dentry_hits = 0
+            self.dentry_misses = 0
+            self.dentry_lock = threading.RLock()
+            self.session = threading.local()  # Per-thread state, so every server client has its own cwd
+            self.tree_lock = RWLock()  # Shared by ordinary commands, exclusive for whole-disk ones (format, ...)
+            self.path_locks = LockTable()  # Reader/writer locks on the files and folders a command touches
+            self.server = None
+            self.current_dir = "/"  # Start in root directory
+            self.log_file = "log.txt"
+            self.audit = AuditLog(self.log_file)  # Buffered command audit log, flushed in groups and on shutdown
+            self.scheduler = Scheduler(self._run_scheduled)
+            self.engine = ExecutionEngine()
+            self.file_versions = itertools.count(1)  # Content versions that key the compiled-code cache
+            self.set_instrumentation(METRICS_ENABLED)
+        except Exception as e:
+            print(f"Initialization error: {e}")
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    @property
+    def current_dir(self):
+        return getattr(self.session, "cwd", "/")
+
+    @current_dir.setter
+    def current_dir(self, path):
+        self.session.cwd = path
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    @property
+    def compressed_chunk(self):
+        # Logical bytes per independently compressed chunk of a compressed file
+        return COMPRESSED_CHUNK_BLOCKS * self.block_size
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def max_checkpoint_extents(self):
+        return max_checkpoint_extents(self.block_size)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def format_disk(self, block_size=None, volume_size=None):
+        try:
+            # Create and format the virtual disk: a superblock followed by a sparse image, so the journal and free
+            # blocks take no host space until written. Without arguments the current geometry is kept.
+            block_size = block_size or self.block_size
+            num_blocks = (volume_size or self.block_size * self.num_blocks) // block_size
+            if not valid_block_size(block_size):
+                print(f"Block size must be a power of two from {MIN_BLOCK_SIZE} to {MAX_BLOCK_SIZE} bytes.")
+                return
+            if not MIN_NUM_BLOCKS <= num_blocks <= MAX_NUM_BLOCKS:
+                print(f"Volume must hold {MIN_NUM_BLOCKS} to {MAX_NUM_BLOCKS} blocks of {block_size} bytes.")
+                return
+            self._close_disk()
+            self.cache.clear()
+            with open(self.disk_file, 'wb') as disk:
+                disk.write(pack_superblock(block_size, num_blocks, next_seq=1))
+                disk.truncate(block_size * num_blocks)
+            self.current_dir = "/"
+            self.load_disk()  # Reopen the disk after formatting
+            self.save_metadata()
+            print("Disk formatted.")
+        except IOError as e:
+            print(f"Error formatting disk: {e}")
+
+    # --------------------------------------------------------------------------------------------------------------------
+    @instrumented("save_metadata")
+    def save_metadata(self):
+        try:
+            # Checkpoint: write the FAT, storage counters, dedup index and directory tree to fresh blocks, point the
+            # superblock at them, then start a new journal. The previous checkpoint stays valid until the superblock
+            # write lands. Folders never loaded since startup are copied across without being decoded.
+            with self.lock:
+                self.cache.sync()  # The checkpoint must not refer to data that is still only in memory
+
+                fat = array('i', self.fat)
+                for block_index in self.checkpoint_blocks + self.checkpoint_tables:
+                    fat[block_index] = FAT_FREE  # Released once this checkpoint is committed
+                tree, moved = bytearray(), []
+                with self.dentry_lock:
+                    self.faulted = []  # Readers may still load folders from the old checkpoint (see _fault_in)
+                root = pack_tree(self.root_dir["/"], tree, self._read_subtree, moved)
+                fat_data = zlib.compress(fat.tobytes())
+                header = CHECKPOINT_HEADER.pack(
+                    len(fat), len(fat_data), self.file_count, self.logical_bytes, self.stored_bytes, self.block_refs,
+                    self.compressed_files, self.compressed_bytes, self.compressed_blocks, self.dedup,
+                    len(self.dedup_index), *root)
+                prefix = header + fat_data + b''.join(DEDUP_ENTRY.pack(digest, block_index)
+                                                      for digest, block_index in self.dedup_index.items())
+                payload = prefix + tree
+
+                blocks_needed = (len(payload) + self.block_size - 1) // self.block_size
+                new_blocks = self.allocator.allocate(blocks_needed, metadata=True)
+                if new_blocks is None:
+                    raise Exception("Disk is full.")
+                new_tables = []
+                try:
+                    extents = to_extents(new_blocks)
+                    self._write_checkpoint(extents, payload)
+                    # However fragmented free space is, the extents fit: a list too long for the superblock goes
+                    # into blocks of its own, and the superblock lists the far fewer extents of those instead
+                    depth = 0
+                    while len(extents) > self.max_checkpoint_extents():
+                        table = pack_extent_table(extents)
+                        table_blocks = None
+                        if depth < MAX_EXTENT_TABLE_DEPTH:
+                            table_needed = (len(table) + self.block_size - 1) // self.block_size
+                            table_blocks = self.allocator.allocate(table_needed, metadata=True)
+                        if table_blocks is None:
+                            raise Exception("Disk is full.")
+                        new_tables.extend(table_blocks)
+                        extents = to_extents(table_blocks)
+                        self._write_checkpoint(extents, table)
+                        depth += 1
+                except BaseException:
+                    for block_index in new_blocks + new_tables:
+                        self.allocator.free(block_index)
+                    raise
+                for block_index in new_blocks + new_tables:
+                    self.fat[block_index] = FAT_RESERVED
+                self._flush_disk(durable=True)
+
+                next_seq = self.journal.next_seq
+                self._disk_write(0, pack_superblock(self.block_size, self.num_blocks, next_seq, extents,
+                                                    len(payload), zlib.crc32(prefix), depth))
+                self._flush_disk(durable=True)
+
+                with self.dentry_lock:  # Folders are faulted in under this lock, from checkpoint_blocks
+                    shifts = {}
+                    for stub, start, offset in moved:
+                        shifts[stub] = start - stub.start
+                        stub.start, stub.offset = start, offset
+                    # A folder loaded from a span that was copied whole has subfolder stubs that still point into
+                    # the old checkpoint; the span moved as one piece, so they move by the same distance
+                    for stub, children in self.faulted:
+                        shift = shifts.get(stub)
+                        if shift is not None:
+                            for child in children:
+                                child.start += shift
+                                child.offset += shift
+                                shifts[child] = shift
+                    self.faulted = None
+                    for block_index in self.checkpoint_blocks + self.checkpoint_tables:
+                        self.fat[block_index] = FAT_FREE
+                        self.allocator.free(block_index)
+                    self.checkpoint_blocks, self.checkpoint_tables = new_blocks, new_tables
+                    self.checkpoint_tree = len(prefix)
+                self.journal.reset(next_seq)
+                self._reserve_checkpoint()
+                return True
+        except Exception as e:
+            with self.dentry_lock:
+                self.faulted = None
+            print(f"Error saving metadata: {e}")
+            return False
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _write_checkpoint(self, extents, data):
+        # Write `data` across the given extents in order, padding the last block
+        position = 0
+        for start, count in extents:
+            chunk = data[position:position + count * self.block_size]
+            self._disk_write(start, chunk.ljust(count * self.block_size, b'\x00'))
+            position += count * self.block_size
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def load_disk(self):
+        try:
+            if not os.path.exists(self.disk_file) or os.path.getsize(self.disk_file) == 0:
+                print("Disk not found. Formatting a new disk.")
+                self.format_disk()
+                return
+
+            # Anything else is never formatted over: an image from an older or newer version, or one whose
+            # superblock or checkpoint is damaged, is left as it is until the user runs `format`
+            self.disk = open(self.disk_file, 'r+b')
+            try:
+                loaded = self._load_metadata()
+            except (ValueError, struct.error, zlib.error) as e:
+                print(f"Error reading the checkpoint: {e}")
+                loaded = False
+            if not loaded:
+                self.disk.close()
+                self.disk = None
+                print(f"'{self.disk_file}' holds no file system this version can read, so it was left untouched. "
+                      "Use 'format' to erase it and create a new one.")
+                return
+            if self.storage_engine == "mmap":
+                self._map_disk()  # After loading, once the image is known to cover the whole volume
+            self._start_checkpointer()
+        except IOError as e:
+            print(f"Error loading disk: {e}")
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _map_disk(self):
+        # (Re)map the whole image; needed again whenever the image changes size. The new mapping is made first, so
+        # a failure leaves the old one in place.
+        disk_map = mmap.mmap(self.disk.fileno(), 0)
+        if self.disk_map is not None:
+            self._unmap_disk()
+        self.disk_map, self.disk_view = disk_map, memoryview(disk_map)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _unmap_disk(self):
+        # Flush and drop the mapping. Views handed out by read_block and read_content may still point into it; then
+        # close() refuses, and the mapping stays valid for them until the last one goes and it is unmapped.
+        self.disk_map.flush()
+        self.disk_view.release()
+        try:
+            self.disk_map.close()
+        except BufferError:
+            pass
+        self.disk_map = self.disk_view = None
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _load_metadata(self, report=True):
+        # Read the superblock, load the last checkpoint and replay the journal on top of it. The geometry comes from
+        # the superblock: its first MIN_BLOCK_SIZE bytes give the block size, then the whole block is read.
+        superblock = self._disk_read(0)
+        if len(superblock) < SUPERBLOCK.size or superblock[:len(SUPERBLOCK_MAGIC)] != SUPERBLOCK_MAGIC:
+            return False
+        (_, version, block_size, num_blocks, journal_start, journal_blocks, next_seq, checkpoint_length,
+         checkpoint_crc, extent_count) = SUPERBLOCK.unpack_from(superblock)
+        table_depth, extent_count = extent_count >> EXTENT_TABLE_SHIFT, extent_count & ((1 << EXTENT_TABLE_SHIFT) - 1)
+        if (version not in (1, METADATA_VERSION) or not valid_block_size(block_size)
+                or not MIN_NUM_BLOCKS <= num_blocks <= MAX_NUM_BLOCKS
+                or extent_count > max_checkpoint_extents(block_size)):
+            return False
+        self.block_size = block_size
+        superblock = self._disk_read(0)
+        extents_end = SUPERBLOCK.size + extent_count * EXTENT.size
+        (stored_crc,) = struct.unpack_from("<I", superblock, extents_end)
+        if zlib.crc32(superblock[:extents_end]) != stored_crc:
+            return False
+        extents = [EXTENT.unpack_from(superblock, SUPERBLOCK.size + i * EXTENT.size) for i in range(extent_count)]
+        self.num_blocks = num_blocks
+        if os.fstat(self.disk.fileno()).st_size < block_size * num_blocks:
+            self.disk.truncate(block_size * num_blocks)  # A sparse image may have lost its zero tail when copied
+        self.journal = Journal(self._disk_write, self._flush_disk, block_size, journal_start, journal_blocks)
 
+        self.fat = new_fat(num_blocks)
+        self.root_dir = {"/": {}}
+        self.dentries.clear()
+        self.dedup = False
+        self.dedup_index.clear()
+        self.block_digests.clear()
+        self.checkpoint_tables = []
+        for _ in range(table_depth):  # Follow the extent tables down to the checkpoint itself
+            self.checkpoint_tables += from_extents(extents)
+            extents = unpack_extent_table(b''.join(self._disk_read(start, count) for start, count in extents))
+        self.checkpoint_blocks = from_extents(extents)
+        self.checkpoint_tree = 0
+        self.folders_loaded = 0
+        self.file_count = self.logical_bytes = self.stored_bytes = self.block_refs = 0
+        self.compressed_files = self.compressed_bytes = self.compressed_blocks = 0
+        lazy = version > 1 and checkpoint_length > 0
+        if lazy:
+            # Only the header, FAT, dedup index and root folder are read; other folders wait for first access
+            (fat_length, fat_size, self.file_count, self.logical_bytes, self.stored_bytes, self.block_refs,
+             self.compressed_files, self.compressed_bytes, self.compressed_blocks, dedup, entry_count,
+             *root) = CHECKPOINT_HEADER.unpack(self._read_checkpoint(0, CHECKPOINT_HEADER.size))
+            self.checkpoint_tree = CHECKPOINT_HEADER.size + fat_size + entry_count * DEDUP_ENTRY.size
+            prefix = self._read_checkpoint(0, self.checkpoint_tree)
+            if zlib.crc32(prefix) != checkpoint_crc:
+                return False
+            fat_data = zlib.decompress(prefix[CHECKPOINT_HEADER.size:CHECKPOINT_HEADER.size + fat_size])
+            dedup_entries = prefix[CHECKPOINT_HEADER.size + fat_size:]
+            self.root_dir["/"] = unpack_dir(self._read_checkpoint(self.checkpoint_tree + root[0], root[2]), root[0])
+        elif checkpoint_length:
+            payload = b''.join(self._disk_read(start, count) for start, count in extents)[:checkpoint_length]
+            if zlib.crc32(payload) != checkpoint_crc:
+                return False
+            data = zlib.decompress(payload)
+            (fat_length,) = struct.unpack_from("<I", data)
+            fat_data = data[4:4 + fat_length * self.fat.itemsize]
+            self.root_dir["/"], offset = unpack_tree(data, 4 + len(fat_data))
+            dedup, entry_count = struct.unpack_from("<BI", data, offset) if offset < len(data) else (0, 0)
+            dedup_entries = data[offset + 5:]
+        if checkpoint_length:
+            fat = array('i')
+            fat.frombytes(fat_data)
+            del fat[num_blocks:]  # The volume may have been resized since the checkpoint
+            fat.extend(new_fat(num_blocks - len(fat)))
+            self.fat = fat
+            self.dedup = bool(dedup)
+            for i in range(entry_count):
+                digest, block_index = DEDUP_ENTRY.unpack_from(dedup_entries, i * DEDUP_ENTRY.size)
+                self.dedup_index[digest] = block_index
+                self.block_digests[block_index] = digest
 
-# Initialize the file system--------------------------------------------------------------------------------------------
-class FileSystem:
-    def __init__(self):
-        try:
-            self.disk = None
-            self.fat = [0] * FAT_TABLE_SIZE
-            self.root_dir = {"/": {}}  # Root directory structure
-            self.current_dir = "/"  # Start in root directory
-            self.log_file = "log.txt"
-        except Exception as e:
-            print(f"Initialization error: {e}")
+        self.fat[:METADATA_BLOCKS] = array('i', [FAT_RESERVED]) * METADATA_BLOCKS
+        for block_index in self.checkpoint_blocks + self.checkpoint_tables:
+            self.fat[block_index] = FAT_RESERVED
+        self.allocator = BlockAllocator(num_blocks, METADATA_BLOCKS, self.allocator.policy)
+        self.allocator.load(fat_bitmap(self.fat))
+        self._reserve_checkpoint()
+
+        journal_area = self._disk_read(journal_start, journal_blocks)
+        replayed = 0
+        for payload in self.journal.scan(journal_area, next_seq):
+            self._replay(payload)
+            replayed += 1
+        if replayed:
+            if report:
+                print(f"Replayed {replayed} metadata journal record(s).")
+            if self.dedup:
+                # Blocks may have been rewritten since the checkpoint; rehash the image rather than trust it
+                self.rebuild_dedup_index()
+
+        # A lazily loaded tree keeps the counters from the checkpoint (replay adjusts them) and indexes names on the
+        # first search; an old version 1 checkpoint was decoded whole, so both are rebuilt from it now
+        self.name_index.clear(complete=not lazy)
+        if not lazy:
+            self._index_tree(self.root_dir["/"], "")
+            self._tally()
+        return True
 
     # -----------------------------------------------------------------------------------------------------------------------
-    def format_disk(self):
-        try:
-            # Create and format the virtual disk
-            with open(DISK_FILE, 'wb') as disk:
-                disk.write(b'\x00' * BLOCK_SIZE * NUM_BLOCKS)
-            self.fat = [0] * FAT_TABLE_SIZE
-            self.root_dir = {"/": {}}
+    def _reserve_checkpoint(self):
+        # Keep enough free blocks back from file data for the next checkpoint: the size of the current one plus a
+        # journal's worth of growth, so a full disk can still fold a full journal into a checkpoint
+        self.allocator.spare = len(self.checkpoint_blocks) + len(self.checkpoint_tables) + JOURNAL_BLOCKS
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _rollback(self):
+        # Drop in-memory metadata changes that reached neither the journal nor a checkpoint, by reloading both
+        self.cache.sync()
+        self.cache.clear()
+        self._load_metadata(report=False)
+        if self.lookup_dir(self.current_dir) is None:
             self.current_dir = "/"
-            self.save_metadata()
-            print("Disk formatted.")
-            self.load_disk()  # Reopen the disk after formatting
-        except IOError as e:
-            print(f"Error formatting disk: {e}")
 
-    # --------------------------------------------------------------------------------------------------------------------
-    def save_metadata(self):
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _read_checkpoint(self, offset, length):
+        # Bytes [offset, offset + length) of the current checkpoint, read from just the blocks that hold them
+        first, last = offset // self.block_size, (offset + length - 1) // self.block_size
+        data = b''.join(self._disk_read(start, count)
+                        for start, count in to_extents(self.checkpoint_blocks[first:last + 1]))
+        return data[offset - first * self.block_size:][:length]
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _read_subtree(self, stub):
+        # The records of a folder not loaded yet and of everything below it, for copying into a new checkpoint
+        return self._read_checkpoint(self.checkpoint_tree + stub.start, stub.offset + stub.length - stub.start)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _fault_in(self, parent, name):
+        # Replace the LazyDir stub parent[name] by the folder dict read from the checkpoint, and return the folder
+        with self.dentry_lock:
+            content = parent[name]
+            if isinstance(content, LazyDir):
+                record = self._read_checkpoint(self.checkpoint_tree + content.offset, content.length)
+                stub, content = content, unpack_dir(record, content.offset)
+                parent[name] = content
+                self.folders_loaded += 1
+                if self.faulted is not None:  # Its subfolder stubs are rebased when that checkpoint commits
+                    self.faulted.append((stub, [child for child in content.values() if isinstance(child, LazyDir)]))
+            return content
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _account(self, file_metadata, sign=1):
+        # Add a file to the storage counters (sign -1 removes it); a file changed in place is removed before the
+        # change and added back after it. Stored bytes are the bytes the file's blocks actually hold.
+        self.file_count += sign
+        self.logical_bytes += sign * file_metadata.size
+        self.block_refs += sign * len(file_metadata.blocks)
+        if file_metadata.codec:
+            self.stored_bytes += sign * sum(file_metadata.chunks)
+            self.compressed_files += sign
+            self.compressed_bytes += sign * file_metadata.size
+            self.compressed_blocks += sign * len(file_metadata.blocks)
+        else:
+            self.stored_bytes += sign * file_metadata.size
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _tally(self):
+        # Recount the storage counters from the whole tree (after loading, replay or repair)
+        self.file_count = self.logical_bytes = self.stored_bytes = self.block_refs = 0
+        self.compressed_files = self.compressed_bytes = self.compressed_blocks = 0
+        for _, file_metadata in self.walk_files():
+            self._account(file_metadata)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def walk_files(self, directory=None, path=""):
+        # Yield (absolute path, Inode) for every file below `directory` (the whole tree by default), loading any
+        # folders still in the checkpoint
+        directory = self.root_dir["/"] if directory is None else directory
+        for name, content in directory.items():
+            if isinstance(content, Inode):
+                yield path + "/" + name, content
+            else:
+                if isinstance(content, LazyDir):
+                    content = self._fault_in(directory, name)
+                yield from self.walk_files(content, path + "/" + name)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _replay(self, payload):
+        # Re-apply one journaled operation to the in-memory FAT and directory tree
+        op = payload[0]
+        path, offset = unpack_str(payload, 1)
+        parent, name, path = self.resolve_path(path)
+        if parent is None:
+            print(f"Skipping journal record for '{path}': parent folder is missing.")
+            return
+        if op in (OP_CREATE, OP_UPDATE):
+            (size,) = struct.unpack_from("<Q", payload, offset)
+            block_chain, offset = unpack_extents(payload, offset + 8)
+            for block_index in block_chain:
+                self._ref_block(block_index)
+            old_metadata = parent.get(name) if op == OP_UPDATE else None
+            if isinstance(old_metadata, Inode):
+                self._account(old_metadata, -1)
+                for block_index in old_metadata.blocks:
+                    self.free_block(block_index)
+            parent[name] = Inode(block_chain, size)
+            if offset < len(payload):  # Compressed file: the chunk table follows the extents
+                unpack_compression(payload, offset, parent[name])
+            self._account(parent[name])
+        elif op == OP_DELETE:
+            file_metadata = parent.pop(name, None)
+            if isinstance(file_metadata, Inode):
+                self._account(file_metadata, -1)
+                for block_index in file_metadata.blocks:
+                    self.free_block(block_index)
+        elif op == OP_RENAME:
+            new_path, _ = unpack_str(payload, offset)
+            new_parent, new_name, _ = self.resolve_path(new_path)
+            if name in parent and new_parent is not None:
+                new_parent[new_name] = parent.pop(name)
+                self._invalidate_dentries(path)
+        elif op == OP_MKDIR:
+            parent.setdefault(name, {})
+        elif op == OP_RMDIR:
+            parent.pop(name, None)
+            self._invalidate_dentries(path)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _index_tree(self, directory, path, add=True):
+        # Add (or remove) every entry below `directory`, whose own path is `path`, to the name index. Nothing to do
+        # while the index waits for its first search (see _complete_name_index).
+        if not self.name_index.complete:
+            return
+        for name, content in directory.items():
+            entry_path = path + "/" + name
+            if add:
+                self.name_index.add(entry_path)
+            else:
+                self.name_index.remove(entry_path)
+            if isinstance(content, LazyDir):
+                content = self._fault_in(directory, name)
+            if not isinstance(content, Inode):
+                self._index_tree(content, entry_path, add)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _complete_name_index(self):
+        # Index the whole tree on the first search after a lazy load, loading every folder on the way
+        with self.lock:
+            if not self.name_index.complete:
+                self.name_index.complete = True
+                self._index_tree(self.root_dir["/"], "")
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    @instrumented("journal_append")
+    def _journal(self, op, path, extra=b'', undo=None):
+        # Make a metadata operation durable: one small append to the journal instead of rewriting all metadata
+        payload = struct.pack("<B", op) + pack_str(path) + extra
+        if not self.journal.append(payload):
+            # Journal full: a checkpoint already contains this operation. If that fails too the operation would be
+            # lost on restart, so it is undone now and the command fails. Callers journal a change before telling
+            # anything else about it, so only the tree and FAT need reverting: by `undo` if the caller gave one.
+            if not self.save_metadata():
+                if undo is not None:
+                    undo()
+                else:
+                    self._undo(op, path, extra)
+                raise OSError("Metadata could not be saved; the change was undone.")
+        elif self.journal.usage() > 0.5:
+            self.checkpoint_wakeup.set()
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _journal_create(self, path, file_metadata, op=OP_CREATE, undo=None):
+        # Ordered mode: the file's data reaches the disk before the record that points at it
+        self.cache.sync_blocks(file_metadata.blocks)
+        extra = struct.pack("<Q", file_metadata.size) + pack_extents(file_metadata.blocks)
+        if file_metadata.codec:
+            extra += pack_compression(file_metadata)
+        self._journal(op, path, extra, undo)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _undo(self, op, path, extra):
+        # Revert a create, rename or folder operation in memory. Writes change blocks in place and leave no old
+        # block map to go back to, so for them metadata is reloaded to what the disk holds.
+        parent, name, _ = self.resolve_path(path)
+        if op == OP_CREATE:
+            file_metadata = parent.pop(name)
+            self._account(file_metadata, -1)
+            for block_index in file_metadata.blocks:
+                self.free_block(block_index)
+        elif op == OP_RENAME:
+            new_path, _ = unpack_str(extra, 0)
+            new_parent, new_name, _ = self.resolve_path(new_path)
+            parent[name] = new_parent.pop(new_name)
+            self._invalidate_dentries(new_path)
+        elif op == OP_MKDIR:
+            parent.pop(name)
+            self._invalidate_dentries(path)
+        elif op == OP_RMDIR:
+            parent[name] = {}
+        else:
+            self._rollback()
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _restore(self, dir_content, name, file_metadata, replaced=None):
+        # Undo for a delete or a copy-on-write update: put the old file back (its blocks are freed only after the
+        # journal took the change) and free the blocks of the file that `replaced` it, if any
+        if replaced is not None:
+            self._account(replaced, -1)
+            for block_index in replaced.blocks:
+                self.free_block(block_index)
+        dir_content[name] = file_metadata
+        self._account(file_metadata)
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _start_checkpointer(self):
+        if self.checkpointer is None:
+            self.checkpoint_stop.clear()
+            self.checkpointer = threading.Thread(target=self._checkpoint_loop, daemon=True)
+            self.checkpointer.start()
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _stop_checkpointer(self):
+        # Must not be called holding `self.lock`, which the checkpointer may be waiting for
+        thread, self.checkpointer = self.checkpointer, None
+        if thread is not None:
+            self.checkpoint_stop.set()
+            self.checkpoint_wakeup.set()
+            thread.join()
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _checkpoint_loop(self):
+        # Background checkpointer: folds the journal into a new checkpoint periodically or when it fills up
+        while True:
+            self.checkpoint_wakeup.wait(CHECKPOINT_INTERVAL)
+            self.checkpoint_wakeup.clear()
+            if self.checkpoint_stop.is_set():
+                return  # Whoever stopped it writes the last checkpoint
+            with self.lock:
+                if self.disk is not None and self.journal.records:
+                    self.save_metadata()
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def _close_disk(self):
+        # Flush and release the disk image and its mapping, if open
+        if self.disk is None:
+            return
+        self.cache.sync()
+        if self.disk_map is not None:
+            self._unmap_disk()
+        self.disk.close()
+        self.disk = None
+
+    # -----------------------------------------------------------------------------------------------------------------------
+    def set_storage_engine(self, engine):
         try:
-            self.disk.seek(0)
-            import pickle
-            metadata = pickle.dumps((self.fat, self.root_dir))
-            self.disk.write(metadata.ljust(BLOCK_SIZE, b'\x00'))
+            if engine not in STORAGE_ENGINES:
+                print(f"Unknown storage engine '{engine}'. Choose one of: {', '.join(STORAGE_ENGINES)}.")
+                return
+            self._close_disk()
+            self.cache.clear()
+            self.storage_engine = engine
+            self.load_disk()
+            print(f"Storage engine set to '{engine}'.")
         except Exception as e:
-            print(f"Error saving metadata: {e}")
+            print(f"Error switching storage engine: {e}")
 
     # -----------------------------------------------------------------------------------------------------------------------
-    def load_disk(self):
+    def resize(self, volume_size):
         try:
-            if not os.path.exists(DISK_FILE):
-                print("Disk not found. Formatting a new disk.")
-                self.format_disk()
-            else:
-                self.disk = open(DISK_FILE, 'r+b')
-        except IOError as e:
-            print(f"Error loading disk: {e}")
+            # Grow or shrink the open volume. Growing extends the sparse image, the FAT and the free-space bitmap;
+            # shrinking only gives up free blocks at the end of the volume, so no file data ever moves.
+            num_blocks = volume_size // self.block_size
+            if not MIN_NUM_BLOCKS <= num_blocks <= MAX_NUM_BLOCKS:
+                print(f"Volume must hold {MIN_NUM_BLOCKS} to {MAX_NUM_BLOCKS} blocks of {self.block_size} bytes.")
+                return
+            with self.lock:
+                old_blocks = self.num_blocks
+                self.cache.sync()
+                if num_blocks > old_blocks:
+                    self.disk.truncate(num_blocks * self.block_size)
+                    if self.disk_map is not None:
+                        try:
+                            self._map_disk()
+                        except Exception:
+                            self.disk.truncate(old_blocks * self.block_size)  # Nothing else has changed yet
+                            raise
+                    self.fat.extend(new_fat(num_blocks - old_blocks))
+                    self.allocator.resize(num_blocks)
+                    self.num_blocks = num_blocks
+                    if not self.save_metadata():  # The superblock records the new size along with the checkpoint
+                        # Until it does, the new blocks must not be used: on restart they would not exist
+                        del self.fat[old_blocks:]
+                        self.allocator.resize(old_blocks)
+                        self.num_blocks = old_blocks
+                        if self.disk_map is not None:
+                            self._unmap_disk()
+                        self.disk.truncate(old_blocks * self.block_size)
+                        if self.storage_engine == "mmap":
+                            self._map_disk()
+                        print("Volume was not resized: its metadata could not be saved.")
+                        return
+                elif num_blocks < old_blocks:
+                    if max(self.checkpoint_blocks + self.checkpoint_tables, default=0) >= num_blocks:
+                        # Move the checkpoint below the new end: the free blocks past it are held while the next
+                        # one is written, then the bitmap is rebuilt from the FAT, which never marked them
+                        self.allocator.hold(num_blocks)
+                        saved = self.save_metadata()
+                        self.allocator.load(fat_bitmap(self.fat))
+                        if not saved or max(self.checkpoint_blocks + self.checkpoint_tables) >= num_blocks:
+                            print("Volume was not resized: the metadata could not be moved below the new end.")
+                            return
+                    try:
+                        self.allocator.resize(num_blocks)
+                    except ValueError:
+                        used = self.allocator.bitmap.rfind(1) + 1
+                        print(f"Cannot shrink below {used * self.block_size} bytes: blocks up to {used - 1} "
+                              f"are in use.")
+                        return
+                    fat_tail = self.fat[num_blocks:]
+                    del self.fat[num_blocks:]
+                    self.num_blocks = num_blocks
+                    if not self.save_metadata():  # Commit the smaller size before the image loses its tail
+                        self.fat.extend(fat_tail)
+                        self.allocator.resize(old_blocks)
+                        self.num_blocks = old_blocks
+                        print("Volume was not resized: its metadata could not be saved.")
+                        return
+                    if self.disk_map is not None:
+                        self._unmap_disk()
+                    self.disk.truncate(num_blocks * self.block_size)
+                    if self.storage_engine == "mmap":
+                        self._map_disk()
+            print(f"Volume is {num_blocks} blocks of {self.block_size} bytes ({num_blocks * self.block_size} bytes, "
+                  f"was {old_blocks} blocks).")
+        except Exception as e:
+            print(f"Error resizing volume: {e}")
 
     # -----------------------------------------------------------------------------------------------------------------------
+    @instrumented("allocate_block")
     def allocate_block(self):
         try:
-            # Allocate a free block from FAT
-            for i in range(FAT_TABLE_SIZE):
-                if self.fat[i] == 0:
-                    self.fat[i] = -1
-                    return i
-            raise Exception("Disk is full.")
+            # Allocate a free block from the free-space bitmap and mark it in the FAT
+            block_index = self.allocator.allocate_extent(1)
+            if block_index is None:
+                raise Exception("Disk is full.")
+            self.fat[block_index] = 1
+            return block_index
         except Exception as e:
             print(f"Error allocating block: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("allocate_extent")
+    def allocate_extent(self, count):
+        try:
+            # Allocate `count` contiguous blocks in one call and return the first index
+            start = self.allocator.allocate_extent(count)
+            if start is None:
+                raise Exception(f"No free run of {count} contiguous blocks.")
+            self.fat[start:start + count] = array('i', [1]) * count
+            return start
+        except Exception as e:
+            print(f"Error allocating extent: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("allocate_blocks")
+    def allocate_blocks(self, count):
+        try:
+            # Allocate `count` blocks, as a single extent when one is available
+            block_chain = self.allocator.allocate(count)
+            if block_chain is None:
+                raise Exception("Disk is full.")
+            for block_index in block_chain:
+                self.fat[block_index] = 1
+            return block_chain
+        except Exception as e:
+            print(f"Error allocating blocks: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("free_block")
     def free_block(self, block_index):
         try:
-            # Free a block in FAT
-            self.fat[block_index] = 0
+            # Drop one reference to a block; it only goes back to the free-space bitmap with the last one
+            if block_index < METADATA_BLOCKS or self.fat[block_index] == FAT_RESERVED:
+                raise IndexError(f"Block {block_index} is reserved for metadata.")
+            if self.fat[block_index] > 1:
+                self.fat[block_index] -= 1
+                return
+            self.fat[block_index] = FAT_FREE
+            self.allocator.free(block_index)
+            self.cache.discard(block_index)
+            self._dedup_forget(block_index)
         except IndexError as e:
             print(f"Error freeing block: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
+    def _ref_block(self, block_index):
+        # Add one reference to a block, claiming it from the free-space bitmap if it was free
+        if self.fat[block_index] == FAT_FREE:
+            self.allocator.mark_used(block_index)
+        self.fat[block_index] += 1
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _dedup_lookup(self, data):
+        # Return an existing block holding exactly `data` (taking a reference to it), or None
+        padded = bytes(data).ljust(self.block_size, b'\x00')
+        block_index = self.dedup_index.get(hashlib.blake2b(padded, digest_size=DEDUP_DIGEST_SIZE).digest())
+        if block_index is None or self.fat[block_index] <= 0:
+            return None
+        if bytes(self.read_block(block_index)) != padded:  # Never trust the hash alone
+            return None
+        self.fat[block_index] += 1
+        self.dedup_hits += 1
+        return block_index
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _dedup_remember(self, block_index, data):
+        digest = hashlib.blake2b(bytes(data).ljust(self.block_size, b'\x00'), digest_size=DEDUP_DIGEST_SIZE).digest()
+        self._dedup_forget(block_index)
+        self.dedup_index.setdefault(digest, block_index)
+        self.block_digests[block_index] = digest
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _dedup_forget(self, block_index):
+        digest = self.block_digests.pop(block_index, None)
+        if digest is not None and self.dedup_index.get(digest) == block_index:
+            del self.dedup_index[digest]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def rebuild_dedup_index(self):
+        # Rehash every in-use data block straight from the image
+        self.cache.sync()
+        self.dedup_index.clear()
+        self.block_digests.clear()
+        for block_index in range(METADATA_BLOCKS, self.num_blocks):
+            if self.fat[block_index] > 0:
+                self._dedup_remember(block_index, self._disk_read(block_index))
+        return len(self.dedup_index)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def set_dedup(self, mode):
+        try:
+            if mode == "on":
+                self.dedup = True
+                entries = self.rebuild_dedup_index()
+                print(f"Deduplication enabled ({entries} distinct blocks indexed).")
+            elif mode == "off":
+                self.dedup = False
+                print("Deduplication disabled.")
+            elif mode == "rebuild":
+                entries = self.rebuild_dedup_index()
+                print(f"Dedup index rebuilt from the disk image ({entries} distinct blocks).")
+            else:
+                print("Usage: dedup on|off|rebuild")
+                return
+            self.save_metadata()  # Persist the mode and index right away; it is not journaled
+        except Exception as e:
+            print(f"Error configuring deduplication: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _store_blocks(self, content):
+        # Allocate and write blocks for `content`; in dedup mode blocks already on disk are shared instead
+        if not self.dedup:
+            block_chain = self.allocate_blocks((len(content) + self.block_size - 1) // self.block_size)
+            if block_chain is None:
+                return None
+            for i, block_index in enumerate(block_chain):
+                self.write_block(block_index, content[i * self.block_size:(i + 1) * self.block_size])
+            return block_chain
+
+        block_chain = []
+        for start in range(0, len(content), self.block_size):
+            chunk = content[start:start + self.block_size]
+            block_index = self._dedup_lookup(chunk)
+            if block_index is None:
+                block_index = self.allocate_block()
+                if block_index is None:
+                    for shared_block in block_chain:
+                        self.free_block(shared_block)
+                    return None
+                self.write_block(block_index, chunk)
+                self._dedup_remember(block_index, chunk)
+            block_chain.append(block_index)
+        return block_chain
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def set_alloc_policy(self, policy):
+        try:
+            if policy not in ALLOC_POLICIES:
+                print(f"Unknown policy '{policy}'. Choose one of: {', '.join(ALLOC_POLICIES)}.")
+                return
+            self.allocator.policy = policy
+            print(f"Allocation policy set to '{policy}'.")
+        except Exception as e:
+            print(f"Error setting allocation policy: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("write_block")
     def write_block(self, block_index, data):
         try:
-            if len(data) > BLOCK_SIZE:
+            if len(data) > self.block_size:
                 raise Exception("Data exceeds block size.")
-            self.disk.seek(block_index * BLOCK_SIZE)
-            self.disk.write(data.ljust(BLOCK_SIZE, b'\x00'))
+            if self.disk_map is not None:
+                # The mapping is already backed by the page cache, so write straight into it
+                offset = block_index * self.block_size
+                self.disk_map[offset:offset + len(data)] = data
+                self.disk_map[offset + len(data):offset + self.block_size] = bytes(self.block_size - len(data))
+            else:
+                self.cache.write(block_index, bytes(data).ljust(self.block_size, b'\x00'))
         except Exception as e:
             print(f"Error writing block: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("read_block")
     def read_block(self, block_index):
         try:
-            self.disk.seek(block_index * BLOCK_SIZE)
-            return self.disk.read(BLOCK_SIZE)
+            if self.disk_view is not None:
+                # Zero-copy view of the block inside the mapped image
+                offset = block_index * self.block_size
+                return self.disk_view[offset:offset + self.block_size]
+            return self.cache.read(block_index)
         except Exception as e:
             print(f"Error reading block: {e}")
             return b''
 
+    # -------------------------------------------------------------------------------------------------------------------
+    def read_content(self, file_metadata):
+        # Return a file's bytes as a memoryview, assembled without intermediate copies
+        block_chain = file_metadata.blocks
+        file_size = file_metadata.size
+        if not block_chain:
+            return memoryview(b'')
+        if file_metadata.codec:
+            content = bytearray()
+            for i in range(len(file_metadata.chunks)):
+                content += self.read_chunk(file_metadata, i)
+            return memoryview(content)[:file_size]
+
+        first = block_chain[0]
+        if self.disk_view is not None and block_chain == array('I', range(first, first + len(block_chain))):
+            # Contiguous file: a single view straight into the mapped image
+            offset = first * self.block_size
+            return self.disk_view[offset:offset + file_size]
+
+        content = memoryview(bytearray(len(block_chain) * self.block_size))
+        for i, block_index in enumerate(block_chain):
+            content[i * self.block_size:(i + 1) * self.block_size] = self.read_block(block_index)
+        return content[:file_size]
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def iter_content(self, file_metadata, chunk_size=ARCHIVE_CHUNK):
+        # Yield a file's bytes in pieces of `chunk_size` (the last may be shorter), holding one piece at a time
+        file_size = file_metadata.size
+        if file_metadata.codec:
+            pending = bytearray()
+            for i in range(len(file_metadata.chunks)):
+                pending += self.read_chunk(file_metadata, i)
+                while len(pending) >= chunk_size:
+                    yield bytes(pending[:chunk_size])
+                    del pending[:chunk_size]
+            if pending:
+                yield bytes(pending[:file_size % chunk_size or chunk_size])
+            return
+
+        blocks_per_chunk = max(1, chunk_size // self.block_size)
+        block_chain = file_metadata.blocks
+        pending = bytearray()
+        for start in range(0, len(block_chain), blocks_per_chunk):
+            for block_index in block_chain[start:start + blocks_per_chunk]:
+                pending += self.read_block(block_index)
+            remaining = file_size - start * self.block_size
+            while len(pending) >= chunk_size and remaining >= chunk_size:
+                yield bytes(pending[:chunk_size])
+                del pending[:chunk_size]
+                remaining -= chunk_size
+        remaining = file_size - (len(block_chain) * self.block_size - len(pending))
+        if remaining > 0:
+            yield bytes(pending[:remaining])
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def chunk_offsets(self, file_metadata):
+        # Chunk offset table: position in the block chain where each compressed chunk starts, plus the end
+        offsets = [0]
+        for length in file_metadata.chunks:
+            offsets.append(offsets[-1] + (length + self.block_size - 1) // self.block_size)
+        return offsets
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def read_chunk(self, file_metadata, index, offsets=None):
+        # Decompress one chunk of a compressed file, reading only the blocks that hold it
+        offsets = offsets or self.chunk_offsets(file_metadata)
+        raw = bytearray()
+        for block_index in file_metadata.blocks[offsets[index]:offsets[index + 1]]:
+            raw += self.read_block(block_index)
+        return decompress_chunk(file_metadata.codec, bytes(raw[:file_metadata.chunks[index]]))
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _store_chunk(self, codec, level, data):
+        # Compress one chunk and store it from a block boundary; returns (block chain, compressed length)
+        compressed = compress_chunk(codec, level, data)
+        block_chain = self._store_blocks(compressed)
+        return None if block_chain is None else (block_chain, len(compressed))
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _stream_store(self, pieces):
+        # Store an iterable of byte strings block by block so only the current piece is held in memory;
+        # returns (block chain, size), or frees what it stored and raises OSError when the disk fills up
+        block_chain, pending, size = [], bytearray(), 0
+        try:
+            for piece in pieces:
+                pending += piece
+                size += len(piece)
+                full = len(pending) - len(pending) % self.block_size
+                if full:
+                    stored = self._store_blocks(bytes(pending[:full]))
+                    if stored is None:
+                        raise OSError("No free space left on the disk.")
+                    block_chain.extend(stored)
+                    del pending[:full]
+            if pending:
+                stored = self._store_blocks(bytes(pending))
+                if stored is None:
+                    raise OSError("No free space left on the disk.")
+                block_chain.extend(stored)
+        except BaseException:
+            for block_index in block_chain:
+                self.free_block(block_index)
+            raise
+        return block_chain, size
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _write_compressed(self, file_metadata, offset, data):
+        # Rewrite only the chunks covering [offset, offset + len(data)); each is recompressed and spliced into the
+        # block chain at its offset table position, so chunks after it are untouched
+        end = offset + len(data)
+        new_size = max(file_metadata.size, end)
+        chunks = file_metadata.chunks
+        for index in range(offset // self.compressed_chunk, (end + self.compressed_chunk - 1) // self.compressed_chunk):
+            chunk_start = index * self.compressed_chunk
+            offsets = self.chunk_offsets(file_metadata)
+            chunk = bytearray(self.read_chunk(file_metadata, index, offsets)) if index < len(chunks) else bytearray()
+            chunk_length = min(self.compressed_chunk, new_size - chunk_start)
+            chunk.extend(bytes(chunk_length - len(chunk)))
+            lo, hi = max(offset, chunk_start), min(end, chunk_start + self.compressed_chunk)
+            chunk[lo - chunk_start:hi - chunk_start] = data[lo - offset:hi - offset]
+
+            if not self._replace_chunk(file_metadata, index, bytes(chunk), offsets):
+                return False
+        return True
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _replace_chunk(self, file_metadata, index, data, offsets):
+        # Store `data` as chunk `index` (appending it if the file has no such chunk yet) and free the old blocks
+        stored = self._store_chunk(file_metadata.codec, file_metadata.level, data)
+        if stored is None:
+            return False
+        new_blocks, compressed_length = stored
+        chunks = file_metadata.chunks
+        if index < len(chunks):
+            old_blocks = file_metadata.blocks[offsets[index]:offsets[index + 1]]
+            file_metadata.blocks[offsets[index]:offsets[index + 1]] = array('I', new_blocks)
+            chunks[index] = compressed_length
+            for block_index in old_blocks:
+                self.free_block(block_index)
+        else:
+            file_metadata.blocks.extend(new_blocks)
+            chunks.append(compressed_length)
+        return True
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _write_plain(self, file_metadata, offset, data):
+        end = offset + len(data)
+        block_chain = file_metadata.blocks
+        old_block_count = len(block_chain)
+        blocks_needed = (end + self.block_size - 1) // self.block_size - old_block_count
+        if blocks_needed > 0:
+            new_blocks = self.allocate_blocks(blocks_needed)
+            if new_blocks is None:
+                return False
+            block_chain.extend(new_blocks)
+
+        # Only the blocks covering [offset, end) are rewritten
+        for position in range(offset // self.block_size, (end + self.block_size - 1) // self.block_size):
+            block_start = position * self.block_size
+            if offset <= block_start and block_start + self.block_size <= end:
+                block = data[block_start - offset:block_start - offset + self.block_size]
+            else:
+                if position < old_block_count:
+                    block = bytearray(self.read_block(block_chain[position]))
+                else:
+                    block = bytearray(self.block_size)
+                lo = max(offset, block_start)
+                hi = min(end, block_start + self.block_size)
+                block[lo - block_start:hi - block_start] = data[lo - offset:hi - offset]
+            if not self.write_file_block(file_metadata, position, block):
+                return False
+        return True
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _write_range(self, file_metadata, offset, data):
+        # Write `data` at `offset` (at most the current size), touching only the blocks or chunks it covers
+        self._account(file_metadata, -1)
+        try:
+            if file_metadata.codec:
+                written = self._write_compressed(file_metadata, offset, data)
+            else:
+                written = self._write_plain(file_metadata, offset, data)
+            if written:
+                file_metadata.size = max(file_metadata.size, offset + len(data))
+            return written
+        finally:
+            self._account(file_metadata)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _read_range(self, file_metadata, offset, length):
+        # Bytes [offset, offset + length) of a file, reading only the blocks (or chunks) that hold them
+        end = min(offset + length, file_metadata.size)
+        if offset >= end:
+            return b''
+        if file_metadata.codec:
+            unit = self.compressed_chunk
+            offsets = self.chunk_offsets(file_metadata)
+            read_unit = lambda index: self.read_chunk(file_metadata, index, offsets)
+        else:
+            unit = self.block_size
+            read_unit = lambda index: self.read_block(file_metadata.blocks[index])
+        first = offset // unit
+        content = bytearray()
+        for index in range(first, (end + unit - 1) // unit):
+            content += read_unit(index)
+        return bytes(content[offset - first * unit:end - first * unit])
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _truncate(self, file_metadata, size):
+        # Cut a file down to `size` bytes, freeing the blocks past the new end
+        if size >= file_metadata.size:
+            return True
+        self._account(file_metadata, -1)
+        try:
+            if file_metadata.codec:
+                chunk_count = (size + self.compressed_chunk - 1) // self.compressed_chunk
+                offsets = self.chunk_offsets(file_metadata)
+                tail = size % self.compressed_chunk
+                if tail and chunk_count <= len(file_metadata.chunks):
+                    # The last kept chunk is recompressed without the cut-off bytes
+                    chunk = self.read_chunk(file_metadata, chunk_count - 1, offsets)[:tail]
+                    if not self._replace_chunk(file_metadata, chunk_count - 1, chunk, offsets):
+                        return False
+                    offsets = self.chunk_offsets(file_metadata)
+                keep = offsets[min(chunk_count, len(file_metadata.chunks))]
+                del file_metadata.chunks[chunk_count:]
+            else:
+                keep = (size + self.block_size - 1) // self.block_size
+            for block_index in file_metadata.blocks[keep:]:
+                self.free_block(block_index)
+            del file_metadata.blocks[keep:]
+            file_metadata.size = min(file_metadata.size, size)
+            return True
+        finally:
+            self._account(file_metadata)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _commit_write(self, path, file_metadata):
+        file_metadata.version = 0  # New content, so the next run compiles afresh
+        self.engine.invalidate(path)
+        self._journal_create(path, file_metadata, OP_UPDATE)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def write_file_block(self, file_metadata, position, data):
+        # Copy-on-write: a block shared with another file is duplicated before it is modified
+        block_index = file_metadata.blocks[position]
+        if self.dedup:
+            shared_block = self._dedup_lookup(data)
+            if shared_block is not None:
+                file_metadata.blocks[position] = shared_block
+                self.free_block(block_index)
+                return True
+        if self.fat[block_index] > 1:
+            new_block_index = self.allocate_block()
+            if new_block_index is None:
+                return False
+            self.fat[block_index] -= 1
+            file_metadata.blocks[position] = new_block_index
+            block_index = new_block_index
+        self._dedup_forget(block_index)  # Its contents are about to change
+        self.write_block(block_index, data)
+        if self.dedup:
+            self._dedup_remember(block_index, data)
+        return True
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("disk_write")
+    def _disk_write(self, block_index, data):
+        if self.metrics.enabled:
+            self._count_io("write", len(data))
+        if self.disk_map is not None:
+            offset = block_index * self.block_size
+            self.disk_map[offset:offset + len(data)] = data
+            return
+        if hasattr(os, "pwrite"):
+            # Positional write: no shared file offset, so concurrent commands cannot interleave seek and write
+            os.pwrite(self.disk.fileno(), data, block_index * self.block_size)
+            return
+        with self.seek_lock:
+            self.disk.seek(block_index * self.block_size)
+            self.disk.write(data)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("disk_read")
+    def _disk_read(self, block_index, count=1):
+        if self.metrics.enabled:
+            self._count_io("read", count * self.block_size)
+        if self.disk_view is not None:
+            offset = block_index * self.block_size
+            return bytes(self.disk_view[offset:offset + count * self.block_size])
+        if hasattr(os, "pread"):
+            return os.pread(self.disk.fileno(), count * self.block_size, block_index * self.block_size)
+        with self.seek_lock:
+            self.disk.seek(block_index * self.block_size)
+            return self.disk.read(count * self.block_size)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("flush_disk")
+    def _flush_disk(self, durable=False):
+        # Push raw writes to the OS; `durable` also forces them to stable storage
+        if self.disk_map is not None:
+            self.disk_map.flush()
+        else:
+            self.disk.flush()
+        if durable:
+            os.fsync(self.disk.fileno())
+        if self.metrics.enabled:
+            self.metrics.add("syscalls.msync" if self.disk_map is not None else "io.flushes")
+            if durable:
+                self.metrics.add("syscalls.fsync")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _count_io(self, direction, nbytes, vectored=False):
+        # Block I/O bytes and the system calls they took. The mmap engine copies to or from memory without any,
+        # but vectored host imports and exports always go through the file descriptor.
+        metrics = self.metrics
+        metrics.add(f"io.{direction}_bytes", nbytes)
+        call = f"p{direction}v" if vectored else f"p{direction}"
+        if self.disk_map is not None and not vectored:
+            metrics.add(f"io.mmap_{direction}s")
+        elif hasattr(os, call):
+            metrics.add(f"syscalls.{call}")
+        else:
+            metrics.add("syscalls.lseek")
+            metrics.add(f"syscalls.{direction}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _write_extents(self, extents, source):
+        # Fill whole extents from the host file `source`, one vectored write per batch instead of one per block;
+        # the tail past the end of `source` is zeroed. Returns the number of write calls.
+        fd = self.disk.fileno()
+        buffers = [memoryview(bytearray(IO_VECTOR_BYTES)) for _ in range(IO_BATCH_BYTES // IO_VECTOR_BYTES)]
+        calls = 0
+        for start, count in extents:
+            offset, extent_end = start * self.block_size, (start + count) * self.block_size
+            while offset < extent_end:
+                batch = min(extent_end - offset, IO_BATCH_BYTES)
+                vectors = []
+                for i in range(0, batch, IO_VECTOR_BYTES):
+                    vector = buffers[i // IO_VECTOR_BYTES][:min(IO_VECTOR_BYTES, batch - i)]
+                    filled = source.readinto(vector) or 0
+                    vector[filled:] = bytes(len(vector) - filled)
+                    vectors.append(vector)
+                if hasattr(os, "pwritev"):
+                    written = os.pwritev(fd, vectors, offset)
+                    if written < batch:  # Short write: finish the batch with a plain positional write
+                        os.pwrite(fd, b''.join(vectors)[written:], offset + written)
+                else:
+                    with self.seek_lock:
+                        self.disk.seek(offset)
+                        self.disk.write(b''.join(vectors))
+                if self.metrics.enabled:
+                    self._count_io("write", batch, vectored=True)
+                calls += 1
+                offset += batch
+        return calls
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _read_extents(self, extents, target, size):
+        # Copy the first `size` bytes held in `extents` to the host file `target` with vectored reads;
+        # returns the number of read calls
+        fd = self.disk.fileno()
+        buffers = [memoryview(bytearray(IO_VECTOR_BYTES)) for _ in range(IO_BATCH_BYTES // IO_VECTOR_BYTES)]
+        calls = 0
+        for start, count in extents:
+            offset = start * self.block_size
+            extent_end = min(offset + count * self.block_size, offset + size)
+            while offset < extent_end:
+                batch = min(extent_end - offset, IO_BATCH_BYTES)
+                vectors = [buffers[i // IO_VECTOR_BYTES][:min(IO_VECTOR_BYTES, batch - i)]
+                           for i in range(0, batch, IO_VECTOR_BYTES)]
+                if hasattr(os, "preadv"):
+                    os.preadv(fd, vectors, offset)
+                else:
+                    with self.seek_lock:
+                        self.disk.seek(offset)
+                        for vector in vectors:
+                            self.disk.readinto(vector)
+                if self.metrics.enabled:
+                    self._count_io("read", batch, vectored=True)
+                for vector in vectors:
+                    target.write(vector)
+                calls += 1
+                offset += batch
+                size -= batch
+        return calls
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def sync(self):
+        try:
+            written = self.cache.sync()
+            if self.disk_map is not None:
+                self.disk_map.flush()
+            self.disk.flush()
+            print(f"{written} dirty block(s) written to disk.")
+        except Exception as e:
+            print(f"Error syncing cache: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def cache_stats(self, size=None):
+        try:
+            cache = self.cache
+            if size is not None:
+                cache.resize(size)
+                print(f"Cache resized to {cache.capacity} blocks.")
+            lookups = cache.hits + cache.misses
+            hit_rate = cache.hits / lookups * 100 if lookups else 0.0
+            print(f"Cache: {len(cache.blocks)}/{cache.capacity} blocks, {len(cache.dirty)} dirty.")
+            print(f"Hits: {cache.hits}, Misses: {cache.misses}, Hit rate: {hit_rate:.1f}%.")
+            print(f"Evictions: {cache.evictions}, Write-backs: {cache.writebacks}.")
+            if self.disk_map is not None:
+                print("Note: the mmap storage engine bypasses the buffer cache.")
+            print(f"Dentry cache: {len(self.dentries)} folders, Hits: {self.dentry_hits}, "
+                  f"Misses: {self.dentry_misses}.")
+            print(f"Folders loaded from the checkpoint on first access: {self.folders_loaded}"
+                  f"{'' if self.name_index.complete else ' (name index builds on the first find)'}.")
+        except Exception as e:
+            print(f"Error displaying cache statistics: {e}")
+
     # -------------------------------------------------------------------------------------------------------------------
     def create_file(self, filename, content):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if filename in dir_content:
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or not name:
+                print("Folder not found.")
+                return
+            if name in dir_content:
                 print("File already exists.")
                 return
 
             content_size = len(content)
-            blocks_needed = (content_size + BLOCK_SIZE - 1) // BLOCK_SIZE
-            block_chain = []
-
-            # Allocate blocks and write content
-            for i in range(blocks_needed):
-                block_index = self.allocate_block()
-                block_chain.append(block_index)
-                start = i * BLOCK_SIZE
-                end = start + BLOCK_SIZE
-                self.write_block(block_index, content[start:end])
+            block_chain = self._store_blocks(content)
+            if block_chain is None:
+                return
 
             # Store metadata
-            dir_content[filename] = {
-                "blocks": block_chain,  # List of integers
-                "size": content_size
-            }
+            dir_content[name] = Inode(block_chain, content_size)
+            self._account(dir_content[name])
+            self._journal_create(path, dir_content[name])
+            self.name_index.add(path)
             print(f"File '{filename}' created.")
         except Exception as e:
             print(f"Error creating file: {e}")
@@ -129,17 +2915,20 @@ class FileSystem:
     # -------------------------------------------------------------------------------------------------------------------
     def delete_file(self, filename):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if filename not in dir_content:
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
                 print("File not found.")
                 return
 
-            file_metadata = dir_content.pop(filename)
-            block_chain = file_metadata["blocks"]
+            file_metadata = dir_content.pop(name)
+            self._account(file_metadata, -1)
+            self._journal(OP_DELETE, path, undo=lambda: self._restore(dir_content, name, file_metadata))
 
             # Free allocated blocks
-            for block_index in block_chain:
+            for block_index in file_metadata.blocks:
                 self.free_block(block_index)
+            self.name_index.remove(path)
+            self.engine.invalidate(path)
             print(f"File '{filename}' deleted.")
         except Exception as e:
             print(f"Error deleting file: {e}")
@@ -147,68 +2936,202 @@ class FileSystem:
     # -------------------------------------------------------------------------------------------------------------------
     def rename_file(self, old_name, new_name):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if old_name not in dir_content:
+            dir_content, name, old_path = self.resolve_path(old_name)
+            if dir_content is None or name not in dir_content:
                 print("File not found.")
                 return
 
-            if new_name in dir_content:
+            new_dir_content, new_entry_name, new_path = self.resolve_path(new_name)
+            if new_dir_content is None or not new_entry_name:
+                print("Destination folder not found.")
+                return
+
+            if new_entry_name in new_dir_content:
                 print("File with the new name already exists.")
                 return
 
-            dir_content[new_name] = dir_content.pop(old_name)
+            if new_path.startswith(old_path + "/"):
+                print("Cannot move a folder inside itself.")
+                return
+
+            new_dir_content[new_entry_name] = dir_content.pop(name)
+            self._journal(OP_RENAME, old_path, pack_str(new_path))
+            self.name_index.remove(old_path)
+            self.name_index.add(new_path)
+            if not isinstance(new_dir_content[new_entry_name], Inode):  # Renamed a folder: re-key everything below it
+                self._index_tree(new_dir_content[new_entry_name], old_path, add=False)
+                self._index_tree(new_dir_content[new_entry_name], new_path)
+                self._invalidate_dentries(old_path)
+                if self.current_dir == old_path or self.current_dir.startswith(old_path + "/"):
+                    self.current_dir = new_path + self.current_dir[len(old_path):]
             print(f"File renamed from '{old_name}' to '{new_name}'.")
         except Exception as e:
             print(f"Error renaming file: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
-    def read_file(self, filename):
+    def read_file(self, filename, offset=0, length=None):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if filename not in dir_content:
+            dir_content, name, _ = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
                 print("File not found.")
                 return
 
-            file_metadata = dir_content[filename]
-            block_chain = file_metadata["blocks"]
-            file_size = file_metadata["size"]
+            file_metadata = dir_content[name]
+            file_size = file_metadata.size
+            if offset < 0 or offset > file_size or (length is not None and length < 0):
+                print(f"Offset must be between 0 and the file size ({file_size} bytes) "
+                      "and the length must not be negative.")
+                return
 
-            # Read content from blocks
-            content = b''.join(self.read_block(block) for block in block_chain)[:file_size]
-            print(content.decode('utf-8').rstrip('\x00'))
+            # Decode piece by piece so only the requested range is read and never all of it at once. Trailing NULs
+            # are dropped as before: each piece holds back its trailing run until text follows it.
+            end = file_size if length is None else min(file_size, offset + length)
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+            held = ""
+            for start in range(offset, end, ARCHIVE_CHUNK):
+                text = held + decoder.decode(self._read_range(file_metadata, start, min(ARCHIVE_CHUNK, end - start)))
+                stripped = text.rstrip('\x00')
+                held = text[len(stripped):]
+                print(stripped, end="")
+            print((held + decoder.decode(b'', final=True)).rstrip('\x00'))
         except Exception as e:
             print(f"Error reading file: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
-    def run_file(self, filename):
+    def open(self, filename, mode="r"):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if filename not in dir_content:
+            # File handle for streaming reads and partial writes; "w" and "a" modes create the file if it is missing
+            if mode not in FILE_MODES:
+                print(f"Unknown mode '{mode}'. Choose one of: {', '.join(FILE_MODES)}.")
+                return None
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or not name:
+                print("Folder not found.")
+                return None
+            if name not in dir_content:
+                if mode.startswith("r"):
+                    print("File not found.")
+                    return None
+                dir_content[name] = Inode()
+                self._account(dir_content[name])
+                self._journal_create(path, dir_content[name])
+                self.name_index.add(path)
+            elif not isinstance(dir_content[name], Inode):
+                print(f"'{filename}' is a folder.")
+                return None
+
+            handle = FileHandle(self, path, dir_content[name], mode)
+            if mode.startswith("w"):
+                handle.truncate(0)
+            return handle
+        except Exception as e:
+            print(f"Error opening file: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def append_file(self, filename, data):
+        try:
+            dir_content, name, _ = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
+                print("File not found.")
+                return
+            with self.open(filename, "a") as handle:
+                handle.write(data)
+            print(f"Appended {len(data)} bytes to '{filename}'.")
+        except Exception as e:
+            print(f"Error appending to file: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def truncate_file(self, filename, size):
+        try:
+            dir_content, name, _ = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
+                print("File not found.")
+                return
+            if size < 0:
+                print("Size must not be negative.")
+                return
+            with self.open(filename, "r+") as handle:
+                handle.truncate(size)
+            print(f"File '{filename}' truncated to {size} bytes.")
+        except Exception as e:
+            print(f"Error truncating file: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def write_file(self, filename, offset, data):
+        try:
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
                 print("File not found.")
                 return
 
-            file_metadata = dir_content[filename]
-            block_chain = file_metadata["blocks"]
-            file_size = file_metadata["size"]
+            file_metadata = dir_content[name]
+            file_size = file_metadata.size
+            if offset < 0 or offset > file_size:
+                print(f"Offset must be between 0 and the file size ({file_size} bytes).")
+                return
+
+            if not self._write_range(file_metadata, offset, data):
+                return
+            self._commit_write(path, file_metadata)
+            print(f"Wrote {len(data)} bytes to '{filename}' at offset {offset}.")
+        except Exception as e:
+            print(f"Error writing file: {e}")
 
-            # Read content from blocks
-            content = b''.join(self.read_block(block) for block in block_chain)[:file_size]
-            code = content.decode('utf-8').rstrip('\x00')
+    # -------------------------------------------------------------------------------------------------------------------
+    def run_file(self, filename, on_output=None, on_done=None):
+        try:
+            # Submit the file to the execution engine and return its task (wait on it with engine.wait)
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
+                print("File not found.")
+                return None
 
+            file_metadata = dir_content[name]
+            if not file_metadata.version:
+                file_metadata.version = next(self.file_versions)
             try:
-                exec(code)  # Execute Python code
+                code = self.engine.compile(
+                    (path, file_metadata.version),
+                    lambda: str(self.read_content(file_metadata), 'utf-8').rstrip('\x00'),
+                    path)
             except SyntaxError:
                 print("The file content is not valid Python code.")
-            except Exception as e:
-                print(f"Error while executing file")
+                return None
+
+            return self.engine.submit(code, on_output or (lambda text: print(text, end="")), on_done)
         except Exception as e:
             print(f"Error running file: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
-    def list_files(self):
+    def configure_engine(self, workers=None, timeout=None, memory_mb=None):
+        try:
+            engine = self.engine
+            if workers is not None:
+                if workers < 1 or timeout < 0 or memory_mb < 0:
+                    print("Workers must be at least 1; timeout and memory limit must not be negative.")
+                    return
+                engine.shutdown()
+                self.engine = engine = ExecutionEngine(workers, timeout, memory_mb * 1024 * 1024)
+                print("Execution engine reconfigured.")
+            running, queued = engine.busy()
+            memory = f"{engine.memory_limit // (1024 * 1024)} MB" if engine.memory_limit else "unlimited"
+            print(f"Workers: {engine.size}, Timeout: {engine.timeout or 'none'} s, Memory limit: {memory}.")
+            print(f"Running: {running}, Queued: {queued}, Completed: {engine.completed}, "
+                  f"Timed out: {engine.timeouts}.")
+            print(f"Compiled-code cache: {len(engine.code_cache)} entries, Hits: {engine.cache_hits}, "
+                  f"Misses: {engine.cache_misses}.")
+        except Exception as e:
+            print(f"Error configuring execution engine: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def list_files(self, foldername=None):
         try:
-            dir_content = self.navigate_to_current_dir()
-            print(f"Files in directory '{self.current_dir}':")
+            path = self.normalize_path(foldername) if foldername else self.current_dir
+            dir_content = self.lookup_dir(path)
+            if dir_content is None:
+                print("Folder not found.")
+                return
+            print(f"Files in directory '{path}':")
             for name in dir_content:
                 print(f"- {name}")
         except Exception as e:
@@ -217,63 +3140,192 @@ class FileSystem:
     # -------------------------------------------------------------------------------------------------------------------
     def copy_file(self, src_filename, dest_filename):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if src_filename not in dir_content:
+            dir_content, name, _ = self.resolve_path(src_filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
                 print("Source file not found.")
                 return
 
-            src_metadata = dir_content[src_filename]
-            src_block_chain = src_metadata["blocks"]
+            dest_dir_content, dest_name, dest_path = self.resolve_path(dest_filename)
+            if dest_dir_content is None or not dest_name:
+                print("Destination folder not found.")
+                return
+
+            if dest_name in dest_dir_content:
+                print("Destination file already exists.")
+                return
+
+            src_metadata = dir_content[name]
+
+            # Share the source blocks instead of duplicating them; a write to either file copies the block first.
+            # A compressed file keeps its chunk table too, since the shared blocks hold compressed chunks.
+            for block_index in src_metadata.blocks:
+                self.fat[block_index] += 1
+            dest_dir_content[dest_name] = src_metadata.copy()
+            self._account(dest_dir_content[dest_name])
+            self._journal_create(dest_path, dest_dir_content[dest_name])
+            self.name_index.add(dest_path)
+            print(f"File '{src_filename}' copied to '{dest_filename}'.")
+        except Exception as e:
+            print(f"Error copying file: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def find_file(self, keyword, mode="substring", limit=None):
+        try:
+            if mode not in SEARCH_MODES:
+                print(f"Unknown search mode '{mode}'. Choose one of: {', '.join(SEARCH_MODES)}.")
+                return
+
+            self._complete_name_index()
+            try:
+                results = self.name_index.search(keyword, mode, limit)
+            except re.error as e:
+                print(f"Invalid regular expression: {e}")
+                return
+            if results:
+                print("Files matching the keyword:")
+                for file_path in results:
+                    print(file_path)
+            else:
+                print("No files found with the specified keyword.")
+        except Exception as e:
+            print(f"Error finding file: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def import_file(self, host_path, filename):
+        try:
+            # Copy a host file, or a whole host folder tree, into the file system
+            started = time.perf_counter()
+            if os.path.isdir(host_path):
+                files, size, calls = self._import_tree(host_path, filename)
+            elif os.path.isfile(host_path):
+                dir_content, name, path = self.resolve_path(filename)
+                if dir_content is None or not name:
+                    print("Folder not found.")
+                    return
+                if name in dir_content:
+                    print("File already exists.")
+                    return
+                size, calls = self._import_host_file(host_path, dir_content, name, path)
+                files = 1
+            else:
+                print("Host file not found.")
+                return
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            print(f"Imported {files} file(s) from '{host_path}' to '{filename}': {size} bytes in {elapsed:.3f} s "
+                  f"({size / elapsed / 1e6:.1f} MB/s, {calls} write calls).")
+        except Exception as e:
+            print(f"Error importing file: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _import_tree(self, host_dir, foldername):
+        files = size = calls = 0
+        for host_path, _, names in os.walk(host_dir):
+            relative = os.path.relpath(host_path, host_dir)
+            folder = foldername if relative == "." else foldername + "/" + relative.replace(os.sep, "/")
+            dir_content = self._make_dirs(folder)
+            for name in sorted(names):
+                source = os.path.join(host_path, name)
+                if not os.path.isfile(source):
+                    continue
+                if name in dir_content:
+                    print(f"Skipping '{source}': '{folder}/{name}' already exists.")
+                    continue
+                _, _, path = self.resolve_path(folder + "/" + name)
+                file_size, file_calls = self._import_host_file(source, dir_content, name, path)
+                files += 1
+                size += file_size
+                calls += file_calls
+        return files, size, calls
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _make_dirs(self, foldername):
+        # Folder dict for `foldername`, creating it and any missing parents
+        path = self.normalize_path(foldername)
+        dir_content = self.lookup_dir(path)
+        if dir_content is not None:
+            return dir_content
+        parent = self._make_dirs(path.rsplit("/", 1)[0] or "/")
+        name = path.rsplit("/", 1)[1]
+        if name in parent:
+            raise Exception(f"'{path}' is a file.")
+        parent[name] = {}
+        self._journal(OP_MKDIR, path)
+        self.name_index.add(path)
+        return parent[name]
 
-            # Allocate new blocks for the copy
-            dest_block_chain = []
-            for block_index in src_block_chain:
-                new_block_index = self.allocate_block()
-                data = self.read_block(block_index)
-                self.write_block(new_block_index, data)
-                dest_block_chain.append(new_block_index)
+    # -------------------------------------------------------------------------------------------------------------------
+    def _import_host_file(self, host_path, dir_content, name, path):
+        # Stream a host file into contiguous extents; returns (bytes, write calls)
+        with open(host_path, "rb") as source:
+            if self.dedup:
+                # Deduplicated blocks cannot be laid out in advance, so go through the block-by-block store
+                block_chain, size = self._stream_store(iter(lambda: source.read(IO_BATCH_BYTES), b''))
+                calls = len(block_chain)
+            else:
+                size = os.fstat(source.fileno()).st_size
+                block_chain = self.allocate_blocks((size + self.block_size - 1) // self.block_size)
+                if block_chain is None:
+                    raise Exception(f"Not enough free space for '{host_path}'.")
+                try:
+                    for block_index in block_chain:
+                        self.cache.discard(block_index)  # The raw writes below bypass the buffer cache
+                    calls = self._write_extents(to_extents(block_chain), source)
+                    self._flush_disk()
+                except BaseException:
+                    for block_index in block_chain:
+                        self.free_block(block_index)
+                    raise
 
-            # Create new metadata for the destination file
-            dir_content[dest_filename] = {
-                "blocks": dest_block_chain,
-                "size": src_metadata["size"]
-            }
-            print(f"File '{src_filename}' copied to '{dest_filename}'.")
-        except Exception as e:
-            print(f"Error copying file: {e}")
+        dir_content[name] = Inode(block_chain, size)
+        self._account(dir_content[name])
+        self._journal_create(path, dir_content[name])
+        self.name_index.add(path)
+        return size, calls
 
     # -------------------------------------------------------------------------------------------------------------------
-    def find_file(self, keyword):
+    def export_file(self, filename, host_path):
         try:
-            def search_recursive(directory, path):
-                found_files = []
-                for name, content in directory.items():
-                    current_path = path + name
-                    if keyword in name:
-                        found_files.append(current_path)
-                    if isinstance(content, dict):  # Recursively search subdirectories
-                        found_files.extend(search_recursive(content, current_path + "/"))
-                return found_files
+            dir_content, name, _ = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
+                print("File not found.")
+                return
+            if os.path.isdir(host_path):
+                host_path = os.path.join(host_path, name)
 
-            results = search_recursive(self.root_dir["/"], "/")
-            if results:
-                print("Files matching the keyword:")
-                for file_path in results:
-                    print(file_path)
-            else:
-                print("No files found with the specified keyword.")
+            file_metadata = dir_content[name]
+            started = time.perf_counter()
+            with open(host_path, "wb") as target:
+                if file_metadata.codec:
+                    calls = 0
+                    for piece in self.iter_content(file_metadata, IO_BATCH_BYTES):
+                        target.write(piece)
+                        calls += 1
+                else:
+                    # Dirty cached blocks and buffered writes must reach the image before reading it directly
+                    self.cache.sync_blocks(file_metadata.blocks)
+                    self._flush_disk()
+                    calls = self._read_extents(to_extents(file_metadata.blocks), target, file_metadata.size)
+            elapsed = max(time.perf_counter() - started, 1e-9)
+            size = file_metadata.size
+            print(f"Exported '{filename}' to '{host_path}': {size} bytes in {elapsed:.3f} s "
+                  f"({size / elapsed / 1e6:.1f} MB/s, {calls} read calls).")
         except Exception as e:
-            print(f"Error finding file: {e}")
+            print(f"Error exporting file: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
     def mkdir(self, foldername):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if foldername in dir_content:
+            dir_content, name, path = self.resolve_path(foldername)
+            if dir_content is None:
+                print("Parent folder not found.")
+                return
+            if not name or name in dir_content:
                 print("Folder already exists.")
                 return
 
-            dir_content[foldername] = {}  # Representing an empty folder
+            dir_content[name] = {}  # Representing an empty folder
+            self._journal(OP_MKDIR, path)
+            self.name_index.add(path)
             print(f"Folder '{foldername}' created.")
         except Exception as e:
             print(f"Error creating folder: {e}")
@@ -281,16 +3333,23 @@ class FileSystem:
     # -------------------------------------------------------------------------------------------------------------------
     def rmdir(self, foldername):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if foldername not in dir_content or not isinstance(dir_content[foldername], dict):
+            dir_content, name, path = self.resolve_path(foldername)
+            if dir_content is None or name not in dir_content or isinstance(dir_content[name], Inode):
                 print("Folder not found.")
                 return
 
-            if dir_content[foldername]:
+            if dir_content[name]:
                 print("Folder is not empty.")
                 return
 
-            dir_content.pop(foldername)
+            if self.current_dir == path or self.current_dir.startswith(path + "/"):
+                print("Cannot remove the current directory.")
+                return
+
+            dir_content.pop(name)
+            self._journal(OP_RMDIR, path)
+            self.name_index.remove(path)
+            self._invalidate_dentries(path)
             print(f"Folder '{foldername}' removed.")
         except Exception as e:
             print(f"Error removing folder: {e}")
@@ -302,16 +3361,16 @@ class FileSystem:
                 self.cdup()
                 return
 
-            dir_content = self.navigate_to_current_dir()
-            if foldername not in dir_content:
-                print("Folder not found.")
-                return
-
-            if not isinstance(dir_content[foldername], dict):
-                print(f"'{foldername}' is not a folder.")
+            path = self.normalize_path(foldername)
+            if self.lookup_dir(path) is None:
+                dir_content, name, _ = self.resolve_path(path)
+                if dir_content is not None and name in dir_content:
+                    print(f"'{foldername}' is not a folder.")
+                else:
+                    print("Folder not found.")
                 return
 
-            self.current_dir = self.current_dir.rstrip("/") + "/" + foldername
+            self.current_dir = path
             print(f"Current directory changed to '{self.current_dir}'.")
         except Exception as e:
             print(f"Error changing directory: {e}")
@@ -336,42 +3395,113 @@ class FileSystem:
             print(f"Error displaying current directory: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("navigate_to_current_dir")
     def navigate_to_current_dir(self):
         try:
-            parts = [p for p in self.current_dir.split("/") if p]
-            dir_content = self.root_dir["/"]
-            for part in parts:
-                dir_content = dir_content[part]
+            dir_content = self.lookup_dir(self.current_dir)
+            if dir_content is None:
+                raise KeyError(self.current_dir)
             return dir_content
         except Exception as e:
             print(f"Error navigating to current directory: {e}")
             return {}
 
     # -------------------------------------------------------------------------------------------------------------------
+    def normalize_path(self, path):
+        # Absolute form of `path`, which may be relative to the current directory and contain '.' and '..'
+        if not path.startswith("/"):
+            path = self.current_dir.rstrip("/") + "/" + path
+        parts = []
+        for part in path.split("/"):
+            if part == "..":
+                if parts:
+                    parts.pop()
+            elif part and part != ".":
+                parts.append(part)
+        return "/" + "/".join(parts)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def lookup_dir(self, path):
+        # Folder dict for an absolute, normalised path, or None; served from the dentry cache when possible
+        with self.dentry_lock:
+            dir_content = self.dentries.get(path)
+            if dir_content is not None:
+                self.dentries.move_to_end(path)
+                self.dentry_hits += 1
+                return dir_content
+
+            self.dentry_misses += 1
+            if path == "/":
+                dir_content = self.root_dir["/"]
+            else:
+                parent_path, name = path.rsplit("/", 1)
+                parent = self.lookup_dir(parent_path or "/")
+                dir_content = parent.get(name) if parent is not None else None
+                if isinstance(dir_content, LazyDir):
+                    dir_content = self._fault_in(parent, name)
+                if dir_content is None or isinstance(dir_content, Inode):
+                    return None
+
+            self.dentries[path] = dir_content
+            if len(self.dentries) > DENTRY_CACHE_SIZE:
+                self.dentries.popitem(last=False)
+            return dir_content
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @instrumented("resolve_path")
+    def resolve_path(self, path):
+        # Split `path` into (parent folder dict or None, entry name, absolute path)
+        path = self.normalize_path(path)
+        if path == "/":
+            return None, "", path
+        parent_path, name = path.rsplit("/", 1)
+        return self.lookup_dir(parent_path or "/"), name, path
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _invalidate_dentries(self, path):
+        # Forget a renamed or removed folder and every cached folder below it
+        prefix = path + "/"
+        with self.dentry_lock:
+            for cached in [p for p in self.dentries if p == path or p.startswith(prefix)]:
+                del self.dentries[cached]
 
-    def compress_file(self, filename):
+    # -------------------------------------------------------------------------------------------------------------------
+    def compress_file(self, filename, codec="zlib", level=COMPRESSION_LEVEL):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if filename not in dir_content:
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
                 print("File not found.")
                 return
+            if codec not in available_codecs():
+                print(f"Unknown codec '{codec}'. Choose one of: {', '.join(available_codecs())}.")
+                return
+            if not 0 <= level <= 9:
+                print("Compression level must be between 0 and 9.")
+                return
 
-            file_metadata = dir_content[filename]
-            block_chain = file_metadata["blocks"]
-            original_size = file_metadata["size"]
-
-            # Read original content
-            original_content = b''.join(self.read_block(block) for block in block_chain)[:original_size]
+            file_metadata = dir_content[name]
+            original_size = file_metadata.size
+            compressed_filename = path[:-len(name)] + name.split('.')[0] + ".zip"
+            archive_dir, archive_name, archive_path = self.resolve_path(compressed_filename)
+            if archive_name in archive_dir:
+                print("File already exists.")
+                return
 
-            # Add metadata (original filename)
-            file_metadata_info = f"{filename}|".encode('utf-8')  # Store original name
-            compressed_content = file_metadata_info + zlib.compress(original_content)
-            compressed_size = len(compressed_content)
+            # Stream the file through the compressor one chunk at a time straight into the archive's blocks
+            def archive():
+                yield (ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, COMPRESSION_CODECS.index(codec), level, original_size)
+                       + pack_str(name))
+                for chunk in self.iter_content(file_metadata):
+                    data = compress_chunk(codec, level, chunk)
+                    yield ARCHIVE_CHUNK_HEADER.pack(len(data)) + data
 
-            compressed_filename = filename.split('.')[0] + ".zip"
-            self.create_file(compressed_filename, compressed_content)
+            block_chain, compressed_size = self._stream_store(archive())
+            archive_dir[archive_name] = Inode(block_chain, compressed_size)
+            self._account(archive_dir[archive_name])
+            self._journal_create(archive_path, archive_dir[archive_name])
+            self.name_index.add(archive_path)
 
-            print(f"File '{filename}' compressed to '{compressed_filename}'.")
+            print(f"File '{filename}' compressed to '{compressed_filename}' with {codec} (level {level}).")
             print(f"Original size: {original_size} bytes, Compressed size: {compressed_size} bytes.")
             if compressed_size < original_size:
                 print("Compression was successful and saved space.")
@@ -381,100 +3511,726 @@ class FileSystem:
             print(f"Error compressing file: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
-    def check_storage(self):
+    def set_compression(self, filename, codec, level=COMPRESSION_LEVEL):
         try:
-            total_space = BLOCK_SIZE * NUM_BLOCKS
-            used_space = 0
+            # Re-encode a file in place: compressed files are stored as independently compressed chunks and
+            # decompressed transparently on read
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or not isinstance(dir_content.get(name), Inode):
+                print("File not found.")
+                return
+            if codec != "off" and codec not in available_codecs():
+                print(f"Unknown codec '{codec}'. Choose one of: off, {', '.join(available_codecs())}.")
+                return
+            if not 0 <= level <= 9:
+                print("Compression level must be between 0 and 9.")
+                return
+
+            old_metadata = dir_content[name]
+            if codec == "off":
+                if not old_metadata.codec:
+                    print(f"File '{filename}' is not compressed.")
+                    return
+                block_chain, _ = self._stream_store(self.iter_content(old_metadata))
+                new_metadata = Inode(block_chain, old_metadata.size)
+            else:
+                new_metadata = Inode(size=old_metadata.size, codec=codec, level=level)
+                try:
+                    for chunk in self.iter_content(old_metadata, self.compressed_chunk):
+                        stored = self._store_chunk(codec, level, chunk)
+                        if stored is None:
+                            raise OSError("No free space left on the disk.")
+                        new_metadata.blocks.extend(stored[0])
+                        new_metadata.chunks.append(stored[1])
+                except BaseException:
+                    for block_index in new_metadata.blocks:
+                        self.free_block(block_index)
+                    raise
 
-            # Calculate the total size of all files
-            def calculate_size(directory):
-                nonlocal used_space
-                for name, metadata in directory.items():
-                    if isinstance(metadata, dict) and "blocks" in metadata:
-                        used_space += metadata["size"]
-                    elif isinstance(metadata, dict):  # It's a folder
-                        calculate_size(metadata)
+            dir_content[name] = new_metadata
+            self._account(old_metadata, -1)
+            self._account(new_metadata)
+            self._journal_create(path, new_metadata, OP_UPDATE,
+                                 lambda: self._restore(dir_content, name, old_metadata, new_metadata))
+            for block_index in old_metadata.blocks:
+                self.free_block(block_index)
+            self.engine.invalidate(path)
+            stored_size = len(new_metadata.blocks) * self.block_size
+            if codec == "off":
+                print(f"File '{filename}' is now stored uncompressed ({stored_size} bytes on disk).")
+            else:
+                print(f"File '{filename}' is now compressed with {codec} (level {level}): "
+                      f"{new_metadata.size} bytes stored in {stored_size} bytes.")
+        except Exception as e:
+            print(f"Error changing file compression: {e}")
 
-            calculate_size(self.root_dir)
+    # -------------------------------------------------------------------------------------------------------------------
+    def check_storage(self):
+        try:
+            # Constant time: every figure comes from counters kept up to date by the commands themselves
+            bs = self.block_size
+            total_space = bs * self.num_blocks
+            free_blocks = self.allocator.free_count
+            metadata_blocks = METADATA_BLOCKS + len(self.checkpoint_blocks) + len(self.checkpoint_tables)
+            physical_blocks = self.num_blocks - free_blocks - metadata_blocks  # Each shared block counts once
+            ratio = self.block_refs / physical_blocks if physical_blocks else 1.0
+            slack = self.block_refs * bs - self.stored_bytes  # Unused tails of the blocks files refer to
+            runs = self.allocator.free_runs
+            fragmentation = (runs - 1) / (free_blocks - 1) if free_blocks > 1 else 0.0
 
-            print(f"{used_space} bytes / {total_space} bytes used.")
+            print(f"{self.logical_bytes} bytes / {total_space} bytes used by {self.file_count} files.")
+            print(f"Physical: {physical_blocks * bs} bytes in {physical_blocks} data blocks, "
+                  f"{metadata_blocks * bs} bytes of metadata, {free_blocks * bs} bytes free.")
+            print(f"Logical: {self.block_refs * bs} bytes in {self.block_refs} block references, "
+                  f"slack {slack} bytes ({slack / (self.block_refs * bs) if self.block_refs else 0:.1%}).")
+            print(f"Dedup ratio: {ratio:.2f}:1 (dedup {'on' if self.dedup else 'off'}, "
+                  f"{self.dedup_hits} duplicate blocks shared this session).")
+            print(f"Free space: {runs} runs, {free_blocks / runs if runs else 0:.1f} blocks per run on average, "
+                  f"fragmentation {fragmentation:.1%}.")
+            if self.compressed_files:
+                print(f"Compressed files: {self.compressed_files}, {self.compressed_bytes} bytes stored in "
+                      f"{self.compressed_blocks * bs} bytes.")
         except Exception as e:
             print(f"Error checking storage: {e}")
 
+    # -------------------------------------------------------------------------------------------------------------------
+    def fsck(self, repair=False):
+        try:
+            # Count the references to every block from all block maps in one pass, then compare the counts with the
+            # FAT, vectorised with NumPy when available and slice by slice otherwise. Blocks past the end of the
+            # volume or inside the superblock, journal or checkpoint cannot be counted and are reported per file.
+            started = time.perf_counter()
+            num_blocks = self.num_blocks
+            checkpoint = set(self.checkpoint_blocks + self.checkpoint_tables)
+            out_of_range = []  # (path, Inode, first bad position, blocks kept by a repair)
+            refs = array('I')
+            for path, file_metadata in self.walk_files():
+                blocks = file_metadata.blocks
+                if blocks and (min(blocks) < METADATA_BLOCKS or max(blocks) >= num_blocks
+                               or not checkpoint.isdisjoint(blocks)):
+                    position = next(i for i, block_index in enumerate(blocks) if block_index < METADATA_BLOCKS
+                                    or block_index >= num_blocks or block_index in checkpoint)
+                    keep = position
+                    if file_metadata.codec:  # Only whole chunks survive
+                        keep = max(offset for offset in self.chunk_offsets(file_metadata) if offset <= position)
+                    out_of_range.append((path, file_metadata, position, keep))
+                    blocks = blocks[:keep]
+                refs.extend(blocks)
+
+            if numpy is not None:
+                counts = numpy.bincount(numpy.frombuffer(refs, dtype=numpy.uint32), minlength=num_blocks)
+                expected = array('i', counts.astype(numpy.int32).tobytes())
+            else:
+                expected = new_fat(num_blocks)
+                for block_index, count in Counter(refs).items():
+                    expected[block_index] = count
+            expected[:METADATA_BLOCKS] = array('i', [FAT_RESERVED]) * METADATA_BLOCKS
+            for block_index in checkpoint:
+                expected[block_index] = FAT_RESERVED
+
+            if numpy is not None:
+                fat = numpy.frombuffer(self.fat, dtype=numpy.int32)
+                differing = numpy.flatnonzero(fat != numpy.frombuffer(expected, dtype=numpy.int32)).tolist()
+                bitmap = numpy.frombuffer(self.allocator.bitmap, dtype=numpy.uint8)
+                bitmap_errors = int(numpy.count_nonzero((bitmap != 0) != (fat != 0)))
+            else:
+                differing = []
+                step = 1 << 16
+                for low in range(0, num_blocks, step):
+                    if self.fat[low:low + step] != expected[low:low + step]:
+                        differing.extend(i for i in range(low, min(low + step, num_blocks))
+                                         if self.fat[i] != expected[i])
+                used = bytearray(map(bool, self.fat))
+                bitmap_errors = 0 if used == self.allocator.bitmap else sum(
+                    1 for a, b in zip(used, self.allocator.bitmap) if a != b)
+
+            orphaned, cross_linked, mismatched = [], [], []
+            for block_index in differing:
+                found, wanted = self.fat[block_index], expected[block_index]
+                if wanted == FAT_FREE:
+                    orphaned.append(block_index)
+                elif wanted > 1 and found < wanted:
+                    cross_linked.append(block_index)
+                else:
+                    mismatched.append(block_index)
+            stale_dedup = [digest for digest, block_index in self.dedup_index.items()
+                           if block_index >= num_blocks or expected[block_index] <= 0]
+
+            elapsed = time.perf_counter() - started
+            print(f"Checked {len(refs)} block references against {num_blocks} FAT entries in {elapsed:.3f} s "
+                  f"({'numpy' if numpy is not None else 'array'}).")
+
+            def report(label, items):
+                shown = ", ".join(str(item) for item in items[:10]) + (", ..." if len(items) > 10 else "")
+                print(f"  {label}: {len(items)}" + (f" ({shown})" if items else ""))
+
+            report("Out-of-range block references", [f"{path} at block {position}"
+                                                     for path, _, position, _ in out_of_range])
+            report("Orphaned blocks", orphaned)
+            report("Cross-linked blocks", cross_linked)
+            report("Refcount mismatches", mismatched)
+            print(f"  Free-space bitmap mismatches: {bitmap_errors}")
+            print(f"  Stale dedup index entries: {len(stale_dedup)}")
+            problems = len(out_of_range) + len(differing) + bitmap_errors + len(stale_dedup)
+            if not problems:
+                print("File system is clean.")
+                return
+            if not repair:
+                print(f"{problems} problem(s) found. Run 'fsck repair' to fix them.")
+                return
+
+            # Files are cut back to their last good block (or chunk); cross-linked blocks become shared
+            # copy-on-write blocks, so a later write to either owner copies the block first
+            for path, file_metadata, _, keep in out_of_range:
+                if file_metadata.codec:
+                    chunk_count = self.chunk_offsets(file_metadata).index(keep)
+                    del file_metadata.chunks[chunk_count:]
+                    file_metadata.size = min(file_metadata.size, chunk_count * self.compressed_chunk)
+                else:
+                    file_metadata.size = min(file_metadata.size, keep * self.block_size)
+                del file_metadata.blocks[keep:]
+                file_metadata.version = 0
+                self.engine.invalidate(path)
+            for block_index in differing:
+                self.fat[block_index] = expected[block_index]
+            for block_index in orphaned:
+                self.cache.discard(block_index)
+                self._dedup_forget(block_index)
+            for digest in stale_dedup:
+                block_index = self.dedup_index.pop(digest, None)
+                self.block_digests.pop(block_index, None)
+            self.allocator.load(map(bool, self.fat))
+            self._tally()
+            self.save_metadata()
+            print(f"Repaired {problems} problem(s).")
+        except Exception as e:
+            print(f"Error checking file system: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _relocate(self, path, file_metadata):
+        # Move a file into one contiguous run: copy its blocks, make the copy durable, then switch the block map
+        # with a single journaled update before the old blocks are freed, so a crash leaves either layout intact.
+        # Returns the number of blocks moved, or None if the file shares blocks or no free run is long enough.
+        old_blocks = file_metadata.blocks
+        count = len(old_blocks)
+        if any(self.fat[block_index] > 1 for block_index in old_blocks):
+            return None  # Moving a shared block would mean rewriting every file that refers to it
+        start = self.allocator.allocate_extent(count, "best-fit")  # Fill holes instead of splitting large runs
+        if start is None:
+            return None
+        self.fat[start:start + count] = array('i', [1]) * count
+        self.cache.sync_blocks(old_blocks)
+        batch = max(1, IO_BATCH_BYTES // self.block_size)
+        position = 0
+        for extent_start, extent_count in to_extents(old_blocks):
+            for offset in range(0, extent_count, batch):
+                blocks = min(batch, extent_count - offset)
+                self._disk_write(start + position, self._disk_read(extent_start + offset, blocks))
+                position += blocks
+        for block_index in range(start, start + count):
+            self.cache.discard(block_index)
+        self._flush_disk()
+
+        digests = [self.block_digests.get(block_index) for block_index in old_blocks]
+        file_metadata.blocks = array('I', range(start, start + count))
+
+        def undo():
+            file_metadata.blocks = old_blocks
+            for block_index in range(start, start + count):
+                self.free_block(block_index)
+
+        self._journal_create(path, file_metadata, OP_UPDATE, undo)
+        for block_index in old_blocks:
+            self.free_block(block_index)
+        for block_index, digest in zip(file_metadata.blocks, digests):
+            if digest is not None:  # The dedup index follows the data to its new place
+                self.dedup_index[digest] = block_index
+                self.block_digests[block_index] = digest
+        return count
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _sequential_read(self, files, repeat=3):
+        # Read files extent by extent straight from the image, as a sequential scan would; returns the best MB/s
+        # of `repeat` passes, so the first pass warming the host page cache does not skew the comparison
+        self.cache.sync()
+        batch = max(1, IO_BATCH_BYTES // self.block_size)
+        best = 0.0
+        for _ in range(repeat):
+            total = 0
+            started = time.perf_counter()
+            for file_metadata in files:
+                for start, count in to_extents(file_metadata.blocks):
+                    for offset in range(0, count, batch):
+                        total += len(self._disk_read(start + offset, min(batch, count - offset)))
+            elapsed = time.perf_counter() - started
+            best = max(best, total / (1 << 20) / elapsed if elapsed else 0.0)
+        return best
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _fragmented_files(self):
+        # (path, extent count) of every file in more than one extent, most fragmented first
+        files = ((path, len(to_extents(file_metadata.blocks))) for path, file_metadata in self.walk_files())
+        return sorted((item for item in files if item[1] > 1), key=lambda item: -item[1])
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def defrag_report(self):
+        try:
+            extents = [(path, len(to_extents(file_metadata.blocks))) for path, file_metadata in self.walk_files()]
+            fragmented = sorted((item for item in extents if item[1] > 1), key=lambda item: -item[1])
+            total = sum(count for _, count in extents)
+            print(f"{len(extents)} files in {total} extents, {len(fragmented)} fragmented "
+                  f"({total / len(extents) if extents else 0:.2f} extents per file).")
+            for path, count in fragmented[:10]:
+                print(f"  {path}: {count} extents")
+            print(f"Free space: {self.allocator.free_count} blocks in {self.allocator.free_runs} runs.")
+            if self.defragger is not None:
+                print(f"Background defrag running at {self.defrag_rate} blocks/s: {self.defrag_files} files, "
+                      f"{self.defrag_moved} blocks moved so far.")
+        except Exception as e:
+            print(f"Error reporting fragmentation: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def defrag(self, filename=None):
+        try:
+            # Defragment one file or every fragmented file now, reporting sequential read speed before and after
+            if filename is None:
+                targets = [path for path, _ in self._fragmented_files()]
+            else:
+                dir_content, name, path = self.resolve_path(filename)
+                if dir_content is None or not isinstance(dir_content.get(name), Inode):
+                    print("File not found.")
+                    return
+                if len(to_extents(dir_content[name].blocks)) <= 1:
+                    print(f"File '{filename}' is already contiguous.")
+                    return
+                targets = [path]
+            files = {}
+            for path in targets:
+                parent, name, _ = self.resolve_path(path)
+                files[path] = parent[name]
+            if not files:
+                print("No fragmented files.")
+                return
+
+            extents_before = sum(len(to_extents(file_metadata.blocks)) for file_metadata in files.values())
+            speed_before = self._sequential_read(files.values())
+            moved = relocated = skipped = 0
+            for path, file_metadata in files.items():
+                if len(to_extents(file_metadata.blocks)) <= 1:
+                    continue
+                blocks = self._relocate(path, file_metadata)
+                if blocks is None:
+                    skipped += 1
+                else:
+                    moved += blocks
+                    relocated += 1
+            extents_after = sum(len(to_extents(file_metadata.blocks)) for file_metadata in files.values())
+            speed_after = self._sequential_read(files.values())
+
+            print(f"Relocated {relocated} file(s), {moved} blocks; extents {extents_before} -> {extents_after}.")
+            if skipped:
+                print(f"Skipped {skipped} file(s) that share blocks or have no free run long enough.")
+            print(f"Sequential read: {speed_before:.1f} MB/s before, {speed_after:.1f} MB/s after.")
+        except Exception as e:
+            print(f"Error defragmenting: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def start_defrag(self, rate=None):
+        try:
+            # Defragment in the background, one file at a time, moving at most `rate` blocks per second on average
+            rate = rate or self.defrag_rate
+            if rate <= 0:
+                print("The defrag rate must be a positive number of blocks per second.")
+                return
+            self.defrag_rate = rate
+            if self.defragger is None:
+                self.defrag_stop.clear()
+                self.defragger = threading.Thread(target=self._defrag_loop, daemon=True)
+                self.defragger.start()
+            print(f"Background defrag running at {rate} blocks/s.")
+        except Exception as e:
+            print(f"Error starting the defragmenter: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def stop_defrag(self):
+        thread, self.defragger = self.defragger, None
+        if thread is not None:
+            self.defrag_stop.set()
+            thread.join()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _defrag_loop(self):
+        # Each step takes the same locks as a write to the file being moved, so clients only wait for that file
+        skipped = {}  # path -> extent count when it could not be moved; retried once its layout changes
+        while not self.defrag_stop.is_set():
+            with self.tree_lock.hold("r"), self.lock:
+                candidates = [item for item in self._fragmented_files() if skipped.get(item[0]) != item[1]]
+            if not candidates:
+                self.defrag_stop.wait(DEFRAG_IDLE)
+                continue
+            for path, _ in candidates:
+                if self.defrag_stop.is_set():
+                    break
+                moved = 0
+                with self.command_locks("write", [path]):
+                    if self.disk is None:
+                        break
+                    parent, name, _ = self.resolve_path(path)
+                    file_metadata = parent.get(name) if parent is not None else None
+                    if isinstance(file_metadata, Inode) and len(to_extents(file_metadata.blocks)) > 1:
+                        moved = self._relocate(path, file_metadata)
+                        if moved is None:
+                            skipped[path] = len(to_extents(file_metadata.blocks))
+                        else:
+                            self.defrag_moved += moved
+                            self.defrag_files += 1
+                self.defrag_stop.wait((moved or 0) / self.defrag_rate)  # Spend the I/O budget, then rest
+
     # -------------------------------------------------------------------------------------------------------------------
     def decompress_file(self, filename):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if not filename.endswith(".zip") or filename not in dir_content:
+            dir_content, name, path = self.resolve_path(filename)
+            if not name.endswith(".zip") or dir_content is None or name not in dir_content:
                 print("Compressed file not found.")
                 return
 
-            file_metadata = dir_content[filename]
-            block_chain = file_metadata["blocks"]
-            compressed_size = file_metadata["size"]
+            archive_metadata = dir_content[name]
+            stream = ByteStream(self.iter_content(archive_metadata))
+            header = stream.read(ARCHIVE_HEADER.size)
+            try:
+                if header.startswith(ARCHIVE_MAGIC):
+                    _, codec, _, original_size = ARCHIVE_HEADER.unpack(header)
+                    codec = COMPRESSION_CODECS[codec]
+                    (name_length,) = struct.unpack("<H", stream.read(2))
+                    original_filename = stream.read(name_length).decode('utf-8')
 
-            # Read compressed content
-            compressed_content = b''.join(self.read_block(block) for block in block_chain)[:compressed_size]
+                    def original_chunks():
+                        remaining = original_size
+                        while remaining > 0:
+                            (length,) = ARCHIVE_CHUNK_HEADER.unpack(stream.read(ARCHIVE_CHUNK_HEADER.size))
+                            chunk = decompress_chunk(codec, stream.read(length))
+                            remaining -= len(chunk)
+                            yield chunk
+                    pieces = original_chunks()
+                else:
+                    # Archive from before the chunked format: "name|" followed by a single zlib stream
+                    compressed_content = bytes(self.read_content(archive_metadata))
+                    file_metadata_info, compressed_data = compressed_content.split(b'|', 1)
+                    original_filename = file_metadata_info.decode('utf-8')
+                    pieces = [zlib.decompress(compressed_data)]
 
-            try:
-                # Extract metadata and decompress content
-                file_metadata_info, compressed_data = compressed_content.split(b'|', 1)
-                original_filename = file_metadata_info.decode('utf-8')
-                original_content = zlib.decompress(compressed_data)
-            except zlib.error:
+                # Create the decompressed file with the original name, next to the archive
+                output_dir, output_name, output_path = self.resolve_path(path[:-len(name)] + original_filename)
+                if output_name in output_dir:
+                    print("File already exists.")
+                    return
+                block_chain, original_size = self._stream_store(pieces)
+            except CODEC_ERRORS:
                 print("Error decompressing file.")
                 return
 
-            # Create the decompressed file with the original name
-            self.create_file(original_filename, original_content)
+            output_dir[output_name] = Inode(block_chain, original_size)
+            self._account(output_dir[output_name])
+            self._journal_create(output_path, output_dir[output_name])
+            self.name_index.add(output_path)
             print(f"File '{filename}' decompressed to '{original_filename}'.")
         except Exception as e:
             print(f"Error decompressing file: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
-    def schedule_file(self, filename, delay):
+    def schedule_file(self, filename, delay, interval=None):
         try:
-            dir_content = self.navigate_to_current_dir()
-            if filename not in dir_content:
+            dir_content, name, path = self.resolve_path(filename)
+            if dir_content is None or name not in dir_content:
                 print("File not found.")
                 return
+            if delay < 0 or (interval is not None and interval <= 0):
+                print("Delay must not be negative and the interval must be positive.")
+                return
 
-            print(f"File '{filename}' scheduled to run after {delay} seconds.")
-            time.sleep(delay)
-            self.run_file(filename)
+            job = self.scheduler.schedule(path, delay, interval)
+            repeat = f", then every {interval} seconds" if interval else ""
+            print(f"Job {job['id']}: file '{filename}' scheduled to run after {delay} seconds{repeat}.")
         except Exception as e:
             print(f"Error scheduling file: {e}")
 
     # -------------------------------------------------------------------------------------------------------------------
-    def log_command(self, command):
+    def _run_scheduled(self, job):
+        # Runs on the scheduler thread; the lock is only held while the file is looked up and submitted
+        prefix = f"[job {job['id']}]"
+        with self.lock:
+            self.run_file(job["path"],
+                          on_output=lambda text: print(f"\n{prefix} {text}", end=""),
+                          on_done=lambda status: status == "ok" or print(f"\n{prefix} Error: {status}"))
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def list_jobs(self):
+        try:
+            scheduler = self.scheduler
+            with scheduler.condition:
+                jobs = sorted(scheduler.jobs.values(), key=lambda job: job["due"])
+                latencies = sorted(scheduler.latencies)
+            if not jobs:
+                print("No scheduled jobs.")
+            now = time.monotonic()
+            for job in jobs:
+                repeat = f"every {job['interval']}s" if job["interval"] else "once"
+                average = job["total_latency"] / job["runs"] * 1000 if job["runs"] else 0.0
+                print(f"  [{job['id']}] {job['path']} - next run in {max(job['due'] - now, 0):.1f}s, {repeat}, "
+                      f"{job['runs']} run(s), dispatch latency avg {average:.2f} ms / max "
+                      f"{job['max_latency'] * 1000:.2f} ms")
+            if latencies:
+                p50 = latencies[len(latencies) // 2] * 1000
+                p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+                print(f"Scheduler lag over the last {len(latencies)} dispatches: p50 {p50:.2f} ms, p99 {p99:.2f} ms.")
+        except Exception as e:
+            print(f"Error listing jobs: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def cancel_job(self, job_id):
+        try:
+            if self.scheduler.cancel(job_id):
+                print(f"Job {job_id} cancelled.")
+            else:
+                print(f"Job {job_id} not found.")
+        except Exception as e:
+            print(f"Error cancelling job: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    @contextlib.contextmanager
+    def command_locks(self, cmd, params):
+        # Lock what one command touches: the tree lock (exclusive for whole-disk commands), reader/writer locks on
+        # the paths involved, then `self.lock` if it changes shared metadata (FAT, allocator, journal, name index).
+        # Commands that only read files and folders skip `self.lock`, so they run alongside writers elsewhere.
+        # Each command also read-locks the subtree key ("/a/" for folder /a) of every folder above its paths, and
+        # renaming a folder write-locks its subtree key: no command can have its path moved away while it runs, yet
+        # creating or deleting an entry in a folder does not wait for commands working further down.
+        def target(index):
+            return self.normalize_path(params[index]) if len(params) > index else self.current_dir
+
+        def parent(path):
+            return path.rsplit("/", 1)[0] or "/"
+
+        tree_mode, paths, metadata = "r", [], True
+        if cmd in ("read", "run", "export"):
+            path = target(0)
+            paths, metadata = [(parent(path), "r"), (path, "r")], False
+        elif cmd == "dir":
+            paths, metadata = [(target(0), "r")], False
+        elif cmd in ("write", "append", "truncate", "compression"):
+            path = target(0)
+            paths = [(parent(path), "r"), (path, "w")]
+        elif cmd in ("create", "mkdir"):
+            paths = [(parent(target(0)), "w")]
+        elif cmd in ("delete", "rmdir"):
+            path = target(0)
+            paths = [(parent(path), "w"), (path, "w")]
+        elif cmd == "rename":
+            old_path, new_path = target(0), target(1)
+            paths = [(parent(old_path), "w"), (old_path, "w"), (old_path + "/", "w"), (parent(new_path), "w")]
+        elif cmd == "copy":
+            source, destination = target(0), target(1)
+            paths = [(parent(source), "r"), (source, "r"), (parent(destination), "w")]
+        elif cmd in ("compress", "decompress"):
+            path = target(0)
+            paths = [(parent(path), "w"), (path, "r")]
+        elif cmd == "import":
+            path = target(1)
+            paths = [(parent(path), "w"), (path, "w")]
+        elif cmd in ("cd", "cdup", "pwd", "help", "exit", "serve", "benchmark", "audit", "stats",
+                     "script"):
+            tree_mode, metadata = None, False
+        elif cmd == "defrag" and params[:1] in (["start"], ["stop"]):
+            tree_mode, metadata = None, False  # The background defragmenter locks each file it moves itself
+        elif cmd not in ("find", "jobs", "cancel", "schedule", "storage"):
+            tree_mode = "w"  # format, engine, cache, dedup, policy, sync, checkpoint, runner, ...
+        for path, _ in list(paths):
+            position = path.find("/", 1)
+            while position != -1:
+                paths.append((path[:position + 1], "r"))
+                position = path.find("/", position + 1)
+
+        with contextlib.ExitStack() as stack:
+            if tree_mode:
+                stack.enter_context(self.tree_lock.hold(tree_mode))
+            stack.enter_context(self.path_locks.hold(paths))
+            if metadata:
+                stack.enter_context(self.lock)
+            yield
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def serve(self, address=None, workers=SERVER_WORKERS):
+        try:
+            if address is None:
+                if self.server is None:
+                    print("Server is not running.")
+                else:
+                    print(f"Serving on {self.server.address}: {len(self.server.clients)} client(s), "
+                          f"{self.server.requests} request(s) handled, {self.server.workers} worker threads.")
+            elif address == "stop":
+                if self.server is None:
+                    print("Server is not running.")
+                    return
+                self.server.stop()
+                self.server = None
+                print("Server stopped.")
+            elif self.server is not None:
+                print(f"Server is already running on {self.server.address}.")
+            elif workers < 1:
+                print("The server needs at least one worker thread.")
+            else:
+                self.server = FileServer(self, address, workers)
+                print(f"Serving on {self.server.address} with {workers} worker threads.")
+        except Exception as e:
+            print(f"Error running server: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def log_command(self, command, cwd=None, duration=0.0, result=""):
+        # Queue an audit entry; the audit log's writer thread appends it to the log file with others
         try:
-            with open(self.log_file, 'a') as log:
-                log.write(command + '\n')
+            self.audit.record({"ts": round(time.time(), 3), "cwd": cwd or self.current_dir, "command": command,
+                               "duration": round(duration, 6), "result": result[:AUDIT_RESULT_CHARS]})
         except Exception as e:
             print(f"Error logging command: {e}")
 
+    # -------------------------------------------------------------------------------------------------------------------
+    def audit_query(self, command=None, since=None, until=None):
+        try:
+            matches = deque(self.audit.query(since, until, command), maxlen=AUDIT_QUERY_LIMIT)
+            if not matches:
+                print("No matching audit log entries.")
+                return
+            for entry in matches:
+                if "ts" in entry:
+                    stamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["ts"]))
+                    print(f"{stamp}  {entry['duration'] * 1000:9.2f} ms  {entry['cwd']}> {entry['command']}"
+                          + (f"  => {entry['result']}" if entry.get("result") else ""))
+                else:
+                    print(f"{'(no timestamp)':19}  {'':12}  {entry['command']}")
+        except Exception as e:
+            print(f"Error querying audit log: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def audit_config(self, max_bytes=None, segments=None, compress=None):
+        try:
+            audit = self.audit
+            if max_bytes is not None:
+                if max_bytes < 1 or segments < 1:
+                    print("The rotation size and number of segments must be positive.")
+                    return
+                audit.configure(max_bytes, segments, compress)
+            rotated = [name for name in map(audit.segment, range(1, audit.segments + 1)) if name]
+            print(f"Audit log: {audit.path}, rotated at {audit.max_bytes} bytes, keeping {audit.segments} segments"
+                  f" ({'gzipped' if audit.compress else 'uncompressed'}); {len(rotated)} on disk.")
+            with audit.condition:
+                pending = len(audit.pending)
+            print(f"Entries written: {audit.entries} in {audit.flushes} group writes"
+                  f" ({audit.entries / max(audit.flushes, 1):.1f} per write), {pending} buffered,"
+                  f" {audit.rotations} rotations.")
+        except Exception as e:
+            print(f"Error configuring audit log: {e}")
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def set_instrumentation(self, enabled):
+        # Off, every timed method is shadowed on this instance by its plain version, so calls skip the timing wrapper.
+        # Components holding a bound method from before (journal, buffer cache) still go through it and see the flag.
+        self.metrics.enabled = enabled
+        for name, method in vars(FileSystem).items():
+            if getattr(method, "metric_name", None) is not None:
+                if enabled:
+                    self.__dict__.pop(name, None)
+                else:
+                    setattr(self, name, method.__wrapped__.__get__(self))
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def stats(self, action=None, host_path=None):
+        try:
+            metrics = self.metrics
+            if action in ("on", "off"):
+                self.set_instrumentation(action == "on")
+                print(f"Instrumentation {'enabled' if metrics.enabled else 'disabled'}.")
+                return
+            if action == "reset":
+                metrics.reset()
+                print("Instrumentation counters reset.")
+                return
+            snapshot = metrics.snapshot()
+            if action == "json":
+                text = json.dumps(snapshot, indent=2)
+                if host_path is None:
+                    print(text)
+                else:
+                    with open(host_path, 'w', encoding='utf-8') as target:
+                        target.write(text + "\n")
+                    print(f"Statistics written to '{host_path}'.")
+                return
+
+            since = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot["since"]))
+            print(f"Instrumentation is {'on' if metrics.enabled else 'off'}; recording since {since}.")
+            for name, value in snapshot["counters"].items():
+                print(f"  {name:<32} {value:>14}")
+            if snapshot["latency"]:
+                print(f"  {'operation (ms)':<32} {'calls':>9} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+            for name, timing in snapshot["latency"].items():
+                print(f"  {name:<32} {timing['calls']:>9} {timing['mean_ms']:>9.3f} {timing['p50_ms']:>9.3f} "
+                      f"{timing['p95_ms']:>9.3f} {timing['p99_ms']:>9.3f} {timing['max_ms']:>9.3f}")
+        except Exception as e:
+            print(f"Error displaying statistics: {e}")
+
     # -------------------------------------------------------------------------------------------------------------------
     def help_menu(self):
         try:
             print("Available commands:")
-            print("  format               - Format the disk.")
+            print("  format [block_size] [volume_size] - Format the disk (sizes in bytes, or with a K, M or G suffix).")
             print("  create <file> <data> - Create a file with specified data.")
+            print("  write <file> <offset> <data> - Overwrite or extend a file starting at a byte offset.")
             print("  delete <file>        - Delete a file.")
             print("  rename <old> <new>   - Rename a file.")
-            print("  read <file>          - Read and display a file's content.")
-            print("  run <file>           - Execute the content of a file.")
-            print("  dir                  - List all files and folders in the current directory.")
-            print("  copy <src> <dest>    - Copy a file to a new file.")
-            print("  find <keyword>       - Search for files by keyword.")
+            print("  read <file> [offset length] - Read and display a file's content, or just a byte range of it.")
+            print("  append <file> <data> - Append data to the end of a file.")
+            print("  import <hostpath> <name> - Copy a host file (or a whole host folder) into the file system.")
+            print("  export <name> <hostpath> - Copy a file out to the host.")
+            print("  truncate <file> <size> - Shrink or zero-extend a file to a size in bytes.")
+            print("  run <file>           - Execute the content of a file in a sandboxed worker process.")
+            print("  runner [workers timeout memory_mb] - Show or reconfigure the execution engine.")
+            print("  dir [folder]         - List all files and folders in the current (or given) directory.")
+            print("  copy <src> <dest>    - Copy a file to a new file (blocks are shared until either file is written).")
+            print("  find <keyword> [mode] [limit] - Search for files by keyword (substring, prefix, glob or regex).")
             print("  mkdir <folder>       - Create a new folder.")
             print("  rmdir <folder>       - Remove an empty folder.")
             print("  cd <folder>          - Change to a specific folder.")
             print("  cdup                 - Move up to the parent directory.")
             print("  pwd                  - Show the current directory path.")
-            print("  compress <file>      - Compress a file.")
+            print("  compress <file> [codec] [level] - Compress a file into a .zip archive (zlib, bz2 or lzma).")
+            print("  compression <file> <codec|off> [level] - Store a file compressed and decompress it on read.")
             print("  decompress <file>    - Decompress a file.")
-            print("  schedule <file> <time> - Schedule a file to run after a delay (in seconds).")
-            print("  storage              - It will return the all and the remain storage of disk .")
+            print("  schedule <file> <time> [interval] - Run a file after a delay, optionally repeating (in seconds).")
+            print("  jobs                 - List scheduled jobs and their dispatch latency.")
+            print("  cancel <id>          - Cancel a scheduled job.")
+            print("  storage              - Show logical and physical usage, slack and free-space fragmentation.")
+            print("  fsck [repair]        - Check the FAT against every file's blocks, optionally repairing it.")
+            print("  defrag [report]      - Show how many extents each file is split into.")
+            print("  defrag run [file]    - Move fragmented files (or one file) into contiguous runs now.")
+            print("  defrag start [rate]|stop - Defragment in the background, moving at most `rate` blocks/s.")
+            print("  dedup on|off|rebuild - Toggle content-addressed block deduplication or rehash the image.")
+            print("  policy <name>        - Set the block allocation policy (next-fit or best-fit).")
+            print("  benchmark alloc      - Measure block allocation cost from an empty to a 95% full disk.")
+            print("  benchmark server     - Measure server throughput (ops/s) as the number of clients grows.")
+            print("  benchmark memory [files] - Compare per-file metadata memory of the old and current layouts.")
+            print("  benchmark startup [files] - Time a cold start, first lookup and checkpoints (default 1M files).")
+            print("  benchmark suite [scale] [save|diff <hostpath>] - Time synthetic workloads (JSON baseline).")
+            print("  script <hostpath> [quiet|<hostpath>] - Run a host file of commands, hiding or capturing output.")
+            print("  serve [port|socket [workers]|stop] - Serve this file system to local clients, or show its status.")
+            print("  sync                 - Write all dirty cached blocks to disk.")
+            print("  checkpoint           - Fold the metadata journal into a new on-disk checkpoint.")
+            print("  cache [size]         - Show buffer cache hit/miss statistics, optionally resizing it.")
+            print("  engine <name>        - Switch the disk storage engine (file or mmap).")
+            print("  resize <size>        - Grow the volume, or shrink it down to its last used block.")
+            print("  audit [command|*] [since|*] [until] - Show logged commands, filtered by name and time or age.")
+            print("  audit config [size segments gzip|plain] - Show audit log statistics or set its rotation.")
+            print("  stats [on|off|reset] - Show call counts, I/O totals and p50/p95/p99 latencies, or toggle them.")
+            print("  stats json [hostpath] - Dump the statistics as JSON, to the screen or a host file.")
+            print("  Paths may be absolute (/a/b.txt) or relative to the current directory (../x).")
             print("  help                 - Show this help menu.")
             print("  exit                 - Exit the system.")
         except Exception as e:
@@ -483,79 +4239,848 @@ class FileSystem:
     # -----------------------------------------------------------------------------------------------------------------------
     def shutdown(self):
         try:
-            self.save_metadata()  # Save data before shutting down
-            self.disk.close()
+            if self.server is not None:
+                self.server.stop()
+                self.server = None
+            self.stop_defrag()
+            self.scheduler.stop()
+            self.engine.shutdown()
+            self._stop_checkpointer()
+            if self.disk is not None:
+                self.save_metadata()  # Save data before shutting down
+            self._close_disk()  # Writes back dirty blocks
+            self.audit.close()  # Writes out buffered audit entries
             print("Disk shut down.")
         except Exception as e:
             print(f"Error shutting down the disk: {e}")
 
 
+# File system server----------------------------------------------------------------------------------------------------
+class ThreadOutput:
+    def __init__(self, stream):
+        # Stands in for sys.stdout: a thread that is capturing gets its prints in its own buffer, the rest pass through
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        if getattr(self.local, "last_line", None) is not None:
+            line = text.rstrip().rpartition("\n")[2].strip()
+            if line:
+                self.local.last_line = line
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def target(self):
+        buffer = getattr(self.local, "buffer", None)
+        return self.stream if buffer is None else buffer
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+        return self.local.buffer
+
+    def track(self):
+        # Remember the last line the calling thread prints from now on, until untrack() returns it. Returns what was
+        # being tracked before, for untrack() to restore when commands nest (a script's commands, for example).
+        previous, self.local.last_line = getattr(self.local, "last_line", None), ""
+        return previous
+
+    def untrack(self, previous=None):
+        last_line, self.local.last_line = self.local.last_line, previous
+        return last_line
+
+    def release(self):
+        self.local.buffer = None
+
+    @contextlib.contextmanager
+    def redirect(self, target):
+        # Send the calling thread's prints to `target` for the block, then back to wherever they went before
+        previous = getattr(self.local, "buffer", None)
+        self.local.buffer = target
+        try:
+            yield target
+        finally:
+            self.local.buffer = previous
+
+
+def redirect_output(target):
+    # Only the calling thread's prints go to `target`; server clients and other threads keep their own output
+    if not isinstance(sys.stdout, ThreadOutput):
+        sys.stdout = ThreadOutput(sys.stdout)
+    return sys.stdout.redirect(target)
+
+
+def current_output():
+    # Where the calling thread's prints end up; output produced on other threads on its behalf is sent there too
+    return sys.stdout.target() if isinstance(sys.stdout, ThreadOutput) else sys.stdout
+
+
+class FileServer:
+    def __init__(self, fs, address, workers=SERVER_WORKERS):
+        # One selector thread reads command lines from every client; a thread pool runs them against `fs`.
+        # `address` is a TCP port on localhost or a Unix socket path. A client has at most one command in flight.
+        self.fs = fs
+        self.workers = workers
+        if address.isdigit():
+            self.listener = socket.create_server((SERVER_HOST, int(address)))
+            self.address = "%s:%d" % self.listener.getsockname()[:2]
+            self.socket_path = None
+        else:
+            if os.path.exists(address):
+                os.unlink(address)  # Stale socket left behind by an earlier server
+            self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.listener.bind(address)
+            os.chmod(address, 0o600)  # Only the server's owner may connect
+            self.listener.listen()
+            self.address = self.socket_path = address
+        self.listener.setblocking(False)
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.clients = {}  # socket -> session: unread input and the client's working directory
+        self.finished = deque()  # Clients whose command completed, to be watched for input again
+        self.requests = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def stop(self):
+        self.stopped = True
+        self.wakeup_writer.send(b'\x00')
+        self.thread.join()
+        self.pool.shutdown(wait=True)  # Let commands already running finish and answer
+        for client in list(self.clients):
+            client.close()
+        self.clients.clear()
+        self.selector.close()
+        self.listener.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _loop(self):
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        while not self.stopped:
+            for key, _ in self.selector.select(timeout=0.5):
+                sock = key.fileobj
+                if sock is self.listener:
+                    try:
+                        client, _ = self.listener.accept()
+                    except BlockingIOError:
+                        continue
+                    client.setblocking(True)
+                    self.clients[client] = {"input": b'', "cwd": "/"}
+                    self.selector.register(client, selectors.EVENT_READ)
+                elif sock is self.wakeup_reader:
+                    sock.recv(4096)
+                else:
+                    try:
+                        data = sock.recv(65536)
+                    except OSError:
+                        data = b''
+                    if not data:
+                        self.selector.unregister(sock)
+                        del self.clients[sock]
+                        sock.close()
+                        continue
+                    self.clients[sock]["input"] += data
+                    self._dispatch(sock)
+
+            while self.finished:
+                client = self.finished.popleft()
+                if client in self.clients and not self._dispatch(client):
+                    self.selector.register(client, selectors.EVENT_READ)
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _dispatch(self, client):
+        # Hand the client's next complete command line to the pool; returns False if there is none yet
+        session = self.clients[client]
+        line, newline, rest = session["input"].partition(b'\n')
+        if not newline:
+            return False
+        session["input"] = rest
+        if self.selector.get_map().get(client) is not None:
+            self.selector.unregister(client)  # No more reads until this command has been answered
+        self.pool.submit(self._handle, client, session, line.decode('utf-8', 'replace').strip())
+        return True
+
+    # -------------------------------------------------------------------------------------------------------------------
+    def _handle(self, client, session, command):
+        fs = self.fs
+        output = sys.stdout.capture()
+        try:
+            fs.current_dir = session["cwd"]
+            args = command.lower().split()
+            cmd = args[0] if args else ""
+            if cmd in SERVER_BLOCKED:
+                print(f"'{cmd}' is only available on the server console.")
+            elif tuple(args[:2]) in SERVER_BLOCKED_FORMS and len(args) > 2:
+                print(f"'{' '.join(args[:2])}' with arguments is only available on the server console.")
+            elif command:
+                run_audited(fs, command)
+            session["cwd"] = fs.current_dir
+        except Exception as e:
+            print(f"Error executing command: {e}")
+        finally:
+            sys.stdout.release()
+            self.requests += 1
+
+        payload = output.getvalue().encode('utf-8')
+        try:
+            client.sendall(RESPONSE_HEADER.pack(len(payload)) + payload)
+        except OSError:
+            pass  # The client went away; the selector notices on its next read
+        self.finished.append(client)
+        try:
+            self.wakeup_writer.send(b'\x00')
+        except OSError:
+            pass
+
+
+class FileClient:
+    def __init__(self, address):
+        # `address` as printed by the server: "host:port" or a Unix socket path
+        host, _, port = address.rpartition(":")
+        if port.isdigit():
+            self.sock = socket.create_connection((host, int(port)))
+        else:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(address)
+
+    def command(self, line):
+        self.sock.sendall(line.encode('utf-8') + b'\n')
+        (length,) = RESPONSE_HEADER.unpack(self._receive(RESPONSE_HEADER.size))
+        return self._receive(length).decode('utf-8')
+
+    def close(self):
+        self.sock.close()
+
+    def _receive(self, count):
+        data = bytearray()
+        while len(data) < count:
+            chunk = self.sock.recv(count - len(data))
+            if not chunk:
+                raise ConnectionError("Server closed the connection.")
+            data += chunk
+        return bytes(data)
+
+
+# Benchmarks------------------------------------------------------------------------------------------------------------
+def benchmark_allocator(num_blocks=1 << 18, samples=2000, linear_samples=20):
+    # Time single-block allocations at increasing fill levels, bitmap allocator vs. the old linear FAT scan
+    def linear_scan(fat):
+        for i in range(len(fat)):
+            if fat[i] == 0:
+                fat[i] = -1
+                return i
+
+    print(f"Allocation cost on a {num_blocks}-block disk (microseconds per block):")
+    print(f"{'fill':>6} {'next-fit':>10} {'best-fit':>10} {'fat scan':>10}")
+    for fill in (0.0, 0.25, 0.5, 0.75, 0.95):
+        used = int(num_blocks * fill)
+        timings = []
+        for policy in ALLOC_POLICIES:
+            allocator = BlockAllocator(num_blocks, METADATA_BLOCKS, policy)
+            if used > METADATA_BLOCKS:
+                allocator.allocate_extent(used - METADATA_BLOCKS)
+            # Scatter a few holes so the policies have something to choose from
+            for block_index in random.Random(0).sample(range(METADATA_BLOCKS, max(used, METADATA_BLOCKS + 1)),
+                                                       min(samples // 2, max(used - METADATA_BLOCKS, 0))):
+                allocator.free(block_index)
+            start = time.perf_counter()
+            for _ in range(samples):
+                allocator.allocate_extent(1)
+            timings.append((time.perf_counter() - start) / samples * 1e6)
+
+        fat = [-1] * used + [0] * (num_blocks - used)
+        start = time.perf_counter()
+        for _ in range(linear_samples):
+            linear_scan(fat)
+        timings.append((time.perf_counter() - start) / linear_samples * 1e6)
+        print(f"{fill:>6.0%} {timings[0]:>10.2f} {timings[1]:>10.2f} {timings[2]:>10.2f}")
+
+
+def benchmark_memory(num_files=1_000_000, blocks_per_file=1, files_per_folder=1000):
+    # Metadata memory for `num_files` files, old layout (dict per file with a list of ints, FAT as a list) vs. the
+    # current one (Inode records with 32-bit block arrays, FAT as an array). Names and folders are shared by both.
+    num_blocks = METADATA_BLOCKS + num_files * blocks_per_file
+    size = blocks_per_file * DEFAULT_BLOCK_SIZE - 1
+    names = [f"file{i}.txt" for i in range(files_per_folder)]
+
+    def build(new_file, fat):
+        tree = {}
+        block_index = METADATA_BLOCKS
+        for folder_index in range(0, num_files, files_per_folder):
+            folder = tree[f"d{folder_index // files_per_folder}"] = {}
+            for name in names[:min(files_per_folder, num_files - folder_index)]:
+                folder[name] = new_file(range(block_index, block_index + blocks_per_file))
+                block_index += blocks_per_file
+        return fat, tree
+
+    layouts = (("dict + list", lambda: build(lambda blocks: {"blocks": list(blocks), "size": size},
+                                             [FAT_FREE] * num_blocks)),
+               ("Inode + array", lambda: build(lambda blocks: Inode(blocks, size), new_fat(num_blocks))))
+    print(f"Metadata memory for {num_files} files of {blocks_per_file} block(s) each:")
+    print(f"{'layout':>14} {'total MiB':>10} {'bytes/file':>11} {'build s':>8}")
+    for label, layout in layouts:
+        start = time.perf_counter()
+        layout()  # Timed untraced; tracing slows allocation down several times
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        metadata = layout()
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del metadata
+        print(f"{label:>14} {used / (1 << 20):>10.1f} {used / num_files:>11.1f} {elapsed:>8.2f}")
+
+
+def benchmark_startup(num_files=1_000_000, files_per_folder=1000):
+    # Cold start of a scratch volume holding `num_files` one-block files: load_disk itself (superblock, FAT and root
+    # folder), the first lookup of a file, checkpoints with few and with all folders loaded, and loading every folder
+    # (what startup used to cost when the whole tree was decoded up front)
+    scratch = tempfile.mkdtemp(prefix="minios-bench-")
+    disk_file = os.path.join(scratch, "disk.img")
+    timings = []
+
+    def timed(label, action):
+        started = time.perf_counter()
+        action()
+        timings.append((label, time.perf_counter() - started, fs.folders_loaded))
+
+    try:
+        with open(os.devnull, 'w') as discard, redirect_output(discard):
+            fs = FileSystem(disk_file=disk_file)
+            fs.format_disk(BENCH_BLOCK_SIZE, BENCH_BLOCK_SIZE * (METADATA_BLOCKS + num_files + num_files // 32 + 4096))
+            start = fs.allocator.allocate_extent(num_files)
+            fs.fat[start:start + num_files] = array('i', [1]) * num_files
+            names = [f"file{i}.txt" for i in range(files_per_folder)]
+            for first in range(0, num_files, files_per_folder):
+                folder = fs.root_dir["/"][f"d{first // files_per_folder}"] = {}
+                for i, name in enumerate(names[:min(files_per_folder, num_files - first)]):
+                    folder[name] = Inode((start + first + i,), BENCH_BLOCK_SIZE // 2)
+            fs._tally()
+            fs.name_index.clear(complete=False)  # Built on the first search, which this benchmark never makes
+            timed("build checkpoint", fs.shutdown)
+
+            fs = FileSystem(disk_file=disk_file)
+            timed("cold start (load_disk)", fs.load_disk)
+            last = (num_files - 1) // files_per_folder
+            timed("first file lookup", lambda: fs.resolve_path(f"/d{last}/{names[(num_files - 1) % files_per_folder]}"))
+            timed("checkpoint, folders copied", fs.save_metadata)
+            timed("load every folder", lambda: sum(1 for _ in fs.walk_files()))
+            timed("checkpoint, folders encoded", fs.save_metadata)
+            fs.shutdown()
+        print(f"Startup of a volume with {num_files} files in {last + 1} folders:")
+        print(f"{'step':>28} {'ms':>10} {'folders loaded':>15}")
+        for label, elapsed, loaded in timings:
+            print(f"{label:>28} {elapsed * 1000:>10.1f} {loaded:>15}")
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def benchmark_server(fs, client_counts=(1, 2, 4, 8, 16), seconds=2.0):
+    # Load generator: N clients on a temporary localhost server, each looping over a mix of reads of a shared file,
+    # writes to its own file and folder listings, for `seconds` per client count
+    server = FileServer(fs, "0")
+    try:
+        admin = FileClient(server.address)
+        if "created" not in admin.command("mkdir /.bench"):
+            print("Benchmark folder '/.bench' already exists; remove it first.")
+            return
+        admin.command("create /.bench/shared " + "x" * 2000)
+        print(f"{'Clients':>7} {'ops/s':>10} {'ops/s/client':>13}")
+        for count in client_counts:
+            clients = [FileClient(server.address) for _ in range(count)]
+            for i, client in enumerate(clients):
+                client.command(f"create /.bench/c{i} " + "y" * 600)
+            counts = [0] * count
+            deadline = time.perf_counter() + seconds
+
+            def work(i):
+                client = clients[i]
+                operations = ["read /.bench/shared", f"write /.bench/c{i} 0 {'z' * 600}", "dir /.bench",
+                              f"read /.bench/c{i}"]
+                while time.perf_counter() < deadline:
+                    client.command(operations[counts[i] % len(operations)])
+                    counts[i] += 1
+
+            started = time.perf_counter()
+            threads = [threading.Thread(target=work, args=(i,)) for i in range(count)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            print(f"{count:>7} {sum(counts) / elapsed:>10.0f} {sum(counts) / elapsed / count:>13.0f}")
+            for i, client in enumerate(clients):
+                client.command(f"delete /.bench/c{i}")
+                client.close()
+        admin.command("delete /.bench/shared")
+        admin.command("rmdir /.bench")
+        admin.close()
+        print("Total ops/s stays about flat as clients are added: commands run one at a time under Python's")
+        print("global interpreter lock and writes also take the metadata lock, so more clients are served at once,")
+        print("not faster.")
+    finally:
+        server.stop()
+
+
+def bench_small_files(fs, scale, rng):
+    # 2000 files of 100 bytes per unit of scale, spread over 20 folders, created and then read back
+    count = 2000 * scale
+    for folder in range(20):
+        run_command(fs, f"mkdir /small{folder}")
+    for i in range(count):
+        run_command(fs, f"create /small{i % 20}/f{i} {rng.choice('abcdefgh') * 100}")
+    for i in range(count):
+        run_command(fs, f"read /small{i % 20}/f{i}")
+    return 20 + 2 * count, 2 * count * 100
+
+
+def bench_huge_files(fs, scale, rng):
+    # Four files of 16 MiB per unit of scale, streamed in and out through file handles 1 MiB at a time
+    chunk = rng.randbytes(1 << 20)
+    count = 16 * scale
+    for i in range(4):
+        with fs.open(f"/huge{i}", "w") as handle:
+            for _ in range(count):
+                handle.write(chunk)
+    for i in range(4):
+        with fs.open(f"/huge{i}") as handle:
+            while handle.read(len(chunk)):
+                pass
+    return 4 * 2 * count, 4 * 2 * count * len(chunk)
+
+
+def bench_deep_tree(fs, scale, rng):
+    # A chain of 100 folders per unit of scale with a file at every level, then lookups of the deepest file
+    depth = 100 * scale
+    for level in range(depth):
+        run_command(fs, f"mkdir d{level}")
+        run_command(fs, f"cd d{level}")
+        run_command(fs, f"create f{level} {'x' * rng.randrange(1, 200)}")
+    deepest = "".join(f"/d{level}" for level in range(depth))
+    run_command(fs, "cd /")
+    lookups = 500 * scale
+    for i in range(lookups):
+        run_command(fs, f"read {deepest}/f{depth - 1}" if i % 2 else f"dir {deepest}")
+    return 3 * depth + 1 + lookups, 0
+
+
+def bench_churn(fs, scale, rng):
+    # 5000 creates or deletes per unit of scale over 64 names, with sizes of up to 4 KiB
+    run_command(fs, "mkdir /churn")
+    live, written = set(), 0
+    operations = 5000 * scale
+    for _ in range(operations):
+        name = rng.randrange(64)
+        if name in live:
+            run_command(fs, f"delete /churn/f{name}")
+            live.discard(name)
+        else:
+            size = rng.randrange(1, 4097)
+            run_command(fs, f"create /churn/f{name} {'c' * size}")
+            live.add(name)
+            written += size
+    return 1 + operations, written
+
+
+def bench_copy_heavy(fs, scale, rng):
+    # 1000 copies of a 64 KiB file per unit of scale, a write to every tenth copy (breaking the sharing), then cleanup
+    source = "".join(rng.choice("abcdef") for _ in range(64 * 1024))
+    run_command(fs, "mkdir /copies")
+    run_command(fs, f"create /copies/source {source}")
+    count = 1000 * scale
+    for i in range(count):
+        run_command(fs, f"copy /copies/source /copies/c{i}")
+    for i in range(0, count, 10):
+        run_command(fs, f"write /copies/c{i} {i % len(source)} z")
+    for i in range(count):
+        run_command(fs, f"delete /copies/c{i}")
+    return 2 + count + (count + 9) // 10 + count, count * len(source)
+
+
+def bench_find_heavy(fs, scale, rng):
+    # 5000 files per unit of scale in 50 folders, then 100 searches per unit of scale in each search mode
+    words = ("alpha", "beta", "gamma", "delta", "omega")
+    count = 5000 * scale
+    for folder in range(50):
+        run_command(fs, f"mkdir /names{folder}")
+    for i in range(count):
+        run_command(fs, f"create /names{i % 50}/item{i:06d}_{rng.choice(words)}.txt x")
+    searches = 100 * scale
+    for i in range(searches):
+        run_command(fs, f"find _{words[i % len(words)]} substring")
+        run_command(fs, f"find item{i % 10} prefix")
+        run_command(fs, f"find *{i % 10}_*.txt glob")
+        run_command(fs, f"find item\\d+{i % 10}_{words[i % len(words)]} regex")
+    return 50 + count + 4 * searches, 0
+
+
+BENCH_WORKLOADS = {"small-files": bench_small_files, "huge-files": bench_huge_files, "deep-tree": bench_deep_tree,
+                   "churn": bench_churn, "copy-heavy": bench_copy_heavy, "find-heavy": bench_find_heavy}
+
+
+def run_workload(workload, scale, traced, instrumented=True):
+    # One workload on a freshly formatted scratch disk with the same random seed every time, printing nowhere.
+    # Returns (operations, bytes moved, seconds, peak traced bytes or None).
+    scratch = tempfile.mkdtemp(prefix="minios-bench-")
+    with open(os.devnull, 'w') as discard, redirect_output(discard):
+        fs = FileSystem(disk_file=os.path.join(scratch, "disk.img"))
+        try:
+            fs.format_disk(BENCH_BLOCK_SIZE, BENCH_VOLUME_SIZE * scale)
+            fs.set_instrumentation(instrumented)
+            if traced:
+                tracemalloc.start()
+            started = time.perf_counter()
+            operations, nbytes = workload(fs, scale, random.Random(0))
+            elapsed = time.perf_counter() - started
+            peak = tracemalloc.get_traced_memory()[1] if traced else None
+        finally:
+            tracemalloc.stop()
+            fs.shutdown()
+            shutil.rmtree(scratch, ignore_errors=True)
+    return operations, nbytes, elapsed, peak
+
+
+def benchmark_suite(fs, scale=1, action=None, host_path=None):
+    # Run every synthetic workload, timed untraced and then again under tracemalloc for its peak memory, and print
+    # ops/s, MB/s and peak MiB. `save` writes the results to a JSON baseline; `diff` compares them with one.
+    baseline = None
+    if action == "diff":
+        with open(host_path, encoding='utf-8') as source:
+            saved = json.load(source)
+        baseline = saved["workloads"]
+        if saved.get("scale") != scale:
+            print(f"Note: the baseline was recorded at scale {saved.get('scale')}, not {scale}.")
+    results = {}
+    print(f"Benchmark suite at scale {scale} ({BENCH_BLOCK_SIZE}-byte blocks):")
+    print(f"{'workload':>12} {'ops':>8} {'seconds':>8} {'ops/s':>10} {'MB/s':>8} {'peak MiB':>9}"
+          + (f" {'ops/s vs base':>14} {'MB/s vs base':>13}" if baseline else ""))
+    for name, workload in BENCH_WORKLOADS.items():
+        operations, nbytes, elapsed, _ = run_workload(workload, scale, traced=False, instrumented=fs.metrics.enabled)
+        peak = run_workload(workload, scale, traced=True, instrumented=fs.metrics.enabled)[3]
+        result = results[name] = {"ops": operations, "bytes": nbytes, "seconds": round(elapsed, 4),
+                                  "ops_per_s": round(operations / elapsed, 1),
+                                  "mb_per_s": round(nbytes / elapsed / (1 << 20), 2),
+                                  "peak_mib": round(peak / (1 << 20), 2)}
+        throughput = f"{result['mb_per_s']:>8.1f}" if nbytes else f"{'-':>8}"  # Lookups move no data
+        line = (f"{name:>12} {operations:>8} {elapsed:>8.2f} {result['ops_per_s']:>10.0f} {throughput}"
+                f" {result['peak_mib']:>9.1f}")
+        if baseline:
+            def change(key):
+                old = baseline.get(name, {}).get(key)
+                return f"{(result[key] - old) / old:+.1%}" if old else "-"
+            line += f" {change('ops_per_s'):>14} {change('mb_per_s'):>13}"
+        print(line)
+    if action == "save":
+        with open(host_path, 'w', encoding='utf-8') as target:
+            json.dump({"created": round(time.time(), 3), "python": sys.version.split()[0], "scale": scale,
+                       "block_size": BENCH_BLOCK_SIZE, "workloads": results}, target, indent=2)
+        print(f"Baseline written to '{host_path}'.")
+
+
 # Command line interface------------------------------------------------------------------------------------------------
-def main():
+def run_command(fs, command):
+    # Parse and execute one command line under the locks it needs; returns False once the disk has been shut down
+    args = command.split()
+    cmd = args[0].lower()
+    params = args[1:]
+
+    pending_run = None
+    started = time.perf_counter()
+    with fs.command_locks(cmd, params):
+        try:
+            if fs.disk is None and cmd not in DISKLESS_COMMANDS:
+                print("No file system is loaded. Use 'format' to create one.")
+            elif cmd == "format" and len(params) <= 2:
+                try:
+                    fs.format_disk(*(parse_size(param) for param in params))
+                except ValueError:
+                    print("Invalid size. Use a byte count with an optional K, M or G suffix.")
+            elif cmd == "create" and len(params) == 2:
+                fs.create_file(params[0], params[1].encode('utf-8'))
+            elif cmd == "write" and len(params) == 3:
+                try:
+                    fs.write_file(params[0], int(params[1]), params[2].encode('utf-8'))
+                except ValueError:
+                    print("Invalid offset. Please provide an integer.")
+            elif cmd == "delete" and len(params) == 1:
+                fs.delete_file(params[0])
+            elif cmd == "rename" and len(params) == 2:
+                fs.rename_file(params[0], params[1])
+            elif cmd == "read" and len(params) in (1, 3):
+                try:
+                    fs.read_file(params[0], *(int(param) for param in params[1:]))
+                except ValueError:
+                    print("Invalid offset or length. Please provide integers.")
+            elif cmd == "import" and len(params) == 2:
+                fs.import_file(params[0], params[1])
+            elif cmd == "export" and len(params) == 2:
+                fs.export_file(params[0], params[1])
+            elif cmd == "append" and len(params) == 2:
+                fs.append_file(params[0], params[1].encode('utf-8'))
+            elif cmd == "truncate" and len(params) == 2:
+                try:
+                    fs.truncate_file(params[0], int(params[1]))
+                except ValueError:
+                    print("Invalid size. Please provide an integer.")
+            elif cmd == "run" and len(params) == 1:
+                pending_run = fs.run_file(params[0], on_output=current_output().write)
+            elif cmd == "runner" and len(params) in (0, 3):
+                try:
+                    fs.configure_engine(*(int(param) for param in params))
+                except ValueError:
+                    print("Invalid engine settings. Please provide integers.")
+            elif cmd == "dir" and len(params) <= 1:
+                fs.list_files(*params)
+            elif cmd == "copy" and len(params) == 2:
+                fs.copy_file(params[0], params[1])
+            elif cmd == "find" and 1 <= len(params) <= 3:
+                try:
+                    limit = int(params[2]) if len(params) == 3 else None
+                    fs.find_file(params[0], params[1] if len(params) >= 2 else "substring", limit)
+                except ValueError:
+                    print("Invalid result limit. Please provide an integer.")
+            elif cmd == "mkdir" and len(params) == 1:
+                fs.mkdir(params[0])
+            elif cmd == "rmdir" and len(params) == 1:
+                fs.rmdir(params[0])
+            elif cmd == "cd" and len(params) == 1:
+                fs.cd(params[0])
+            elif cmd == "cdup":
+                fs.cdup()
+            elif cmd == "pwd":
+                fs.pwd()
+            elif cmd == "compress" and len(params) in (1, 2, 3):
+                try:
+                    fs.compress_file(*params[:2], *(int(param) for param in params[2:]))
+                except ValueError:
+                    print("Invalid compression level. Please provide an integer.")
+            elif cmd == "compression" and len(params) in (2, 3):
+                try:
+                    fs.set_compression(*params[:2], *(int(param) for param in params[2:]))
+                except ValueError:
+                    print("Invalid compression level. Please provide an integer.")
+            elif cmd == "decompress" and len(params) == 1:
+                fs.decompress_file(params[0])
+            elif cmd == "schedule" and len(params) in (2, 3):
+                try:
+                    delay = int(params[1])
+                    interval = int(params[2]) if len(params) == 3 else None
+                    fs.schedule_file(params[0], delay, interval)
+                except ValueError:
+                    print("Invalid time format. Please provide an integer.")
+            elif cmd == "jobs":
+                fs.list_jobs()
+            elif cmd == "cancel" and len(params) == 1:
+                try:
+                    fs.cancel_job(int(params[0]))
+                except ValueError:
+                    print("Invalid job id. Please provide an integer.")
+            elif cmd == "storage":
+                fs.check_storage()
+            elif cmd == "fsck" and params in ([], ["repair"]):
+                fs.fsck(repair=bool(params))
+            elif cmd == "defrag" and params in ([], ["report"]):
+                fs.defrag_report()
+            elif cmd == "defrag" and params[:1] == ["run"] and len(params) <= 2:
+                fs.defrag(*params[1:])
+            elif cmd == "defrag" and params[:1] == ["start"] and len(params) <= 2:
+                try:
+                    fs.start_defrag(*(int(param) for param in params[1:]))
+                except ValueError:
+                    print("Invalid rate. Please provide a number of blocks per second.")
+            elif cmd == "defrag" and params == ["stop"]:
+                fs.stop_defrag()
+                print("Background defrag stopped.")
+            elif cmd == "dedup" and len(params) == 1:
+                fs.set_dedup(params[0])
+            elif cmd == "policy" and len(params) == 1:
+                fs.set_alloc_policy(params[0])
+            elif cmd == "benchmark" and params == ["alloc"]:
+                benchmark_allocator()
+            elif cmd == "benchmark" and len(params) in (1, 2) and params[0] == "memory":
+                try:
+                    benchmark_memory(*(int(param) for param in params[1:]))
+                except ValueError:
+                    print("Invalid file count. Please provide an integer.")
+            elif cmd == "benchmark" and len(params) in (1, 2) and params[0] == "startup":
+                try:
+                    benchmark_startup(*(int(param) for param in params[1:]))
+                except ValueError:
+                    print("Invalid file count. Please provide an integer.")
+            elif cmd == "benchmark" and params == ["server"]:
+                benchmark_server(fs)
+            elif cmd == "benchmark" and params[:1] == ["suite"] and len(params) <= 4:
+                try:
+                    scale = int(params[1]) if len(params) in (2, 4) else 1
+                    action = params[-2:] if len(params) >= 3 else [None, None]
+                    if scale < 1 or action[0] not in (None, "save", "diff"):
+                        raise ValueError
+                    benchmark_suite(fs, scale, *action)
+                except ValueError:
+                    print("Usage: benchmark suite [scale] [save|diff <hostpath>]")
+                except OSError as e:
+                    print(f"Error reading or writing the baseline: {e}")
+            elif cmd == "script" and len(params) in (1, 2):
+                try:
+                    with contextlib.ExitStack() as stack:
+                        lines, output = open_script(params[0], params[1] if len(params) == 2 else None, stack)
+                        count, elapsed, running = run_script(fs, lines, output)
+                    print(f"Ran {count} command(s) in {elapsed:.3f} s ({count / max(elapsed, 1e-9):.0f} commands/s).")
+                    if not running:
+                        return False
+                except OSError as e:
+                    print(f"Error running script: {e}")
+            elif cmd == "serve" and len(params) <= 2:
+                try:
+                    fs.serve(*params[:1], *(int(param) for param in params[1:]))
+                except ValueError:
+                    print("Invalid worker count. Please provide an integer.")
+            elif cmd == "sync":
+                fs.sync()
+            elif cmd == "checkpoint":
+                fs.save_metadata()
+                print("Metadata checkpoint written.")
+            elif cmd == "engine" and len(params) == 1:
+                fs.set_storage_engine(params[0])
+            elif cmd == "resize" and len(params) == 1:
+                try:
+                    fs.resize(parse_size(params[0]))
+                except ValueError:
+                    print("Invalid size. Use a byte count with an optional K, M or G suffix.")
+            elif cmd == "cache" and len(params) <= 1:
+                try:
+                    fs.cache_stats(int(params[0]) if params else None)
+                except ValueError:
+                    print("Invalid cache size. Please provide an integer.")
+            elif cmd == "audit" and params[:1] == ["config"] and len(params) in (1, 4):
+                try:
+                    if len(params) == 1:
+                        fs.audit_config()
+                    elif params[3] in ("gzip", "plain"):
+                        fs.audit_config(parse_size(params[1]), int(params[2]), params[3] == "gzip")
+                    else:
+                        print("Rotated segments are either gzip or plain.")
+                except ValueError:
+                    print("Invalid rotation size or segment count. Please provide integers.")
+            elif cmd == "audit" and len(params) <= 3:
+                try:
+                    bounds = [None if param == "*" else parse_time(param) for param in params[1:]]
+                    fs.audit_query(None if not params or params[0] == "*" else params[0].lower(), *bounds)
+                except ValueError:
+                    print("Invalid time. Use an ISO date/time (2024-05-01T13:00) or an age such as 15m, 2h or 7d.")
+            elif cmd == "stats" and (len(params) <= 1 or len(params) == 2 and params[0] == "json"):
+                if params and params[0] not in ("on", "off", "reset", "json"):
+                    print("Usage: stats [on|off|reset|json [hostpath]]")
+                else:
+                    fs.stats(*params)
+            elif cmd == "help":
+                fs.help_menu()
+            elif cmd == "exit":
+                fs.shutdown()
+                return False
+            else:
+                print("Invalid command or arguments.")
+                cmd = "invalid"  # Timed together, so mistyped names do not each get their own entry
+        except Exception as e:
+            print(f"Error executing command '{cmd}': {e}")
+
+    # Wait for a run outside the locks so other commands and scheduled runs keep going in parallel
+    if pending_run is not None:
+        status = fs.engine.wait(pending_run)
+        if status != "ok":
+            print(f"Error while executing file: {status}")
+    if fs.metrics.enabled:
+        fs.metrics.observe(f"command.{cmd}", time.perf_counter() - started)
+    return True
+
+
+def run_audited(fs, command):
+    # run_command, then queue an audit entry with the working directory, duration and last line of output
+    tracking = isinstance(sys.stdout, ThreadOutput)
+    cwd, started = fs.current_dir, time.perf_counter()
+    previous = sys.stdout.track() if tracking else None
     try:
+        return run_command(fs, command)
+    finally:
+        fs.log_command(command, cwd, time.perf_counter() - started, sys.stdout.untrack(previous) if tracking else "")
+
+
+def run_script(fs, lines, output=None):
+    # Run command lines one after another, skipping blank lines and # comments, with their output sent to the
+    # file-like `output` (None prints as usual). Stops after `exit`. Returns (commands run, seconds, still running).
+    count, running = 0, True
+    started = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if output is not None:
+            stack.enter_context(redirect_output(output))
+        for line in lines:
+            command = line.strip()
+            if not command or command.startswith("#"):
+                continue
+            count += 1
+            if not run_audited(fs, command):
+                running = False
+                break
+    return count, time.perf_counter() - started, running
+
+
+def open_script(host_path, output, stack):
+    # Lines of a host script ("-" for stdin) and where its output goes: None for the screen, a null sink for
+    # "quiet", or else a host file that captures it
+    lines = sys.stdin if host_path == "-" else stack.enter_context(open(host_path, encoding='utf-8'))
+    if output is None:
+        return lines, None
+    return lines, stack.enter_context(open(os.devnull if output == "quiet" else output, 'w', encoding='utf-8'))
+
+
+def main(argv=None):
+    # Interactive console, or batch mode when given a script: python "Operating System.py" script.txt --quiet
+    parser = argparse.ArgumentParser(description="Mini OS file system simulation.")
+    parser.add_argument("script", nargs="?", help="run the commands in this host file ('-' for stdin), then exit")
+    outputs = parser.add_mutually_exclusive_group()
+    outputs.add_argument("--quiet", action="store_true", help="discard the output of the script's commands")
+    outputs.add_argument("--output", metavar="FILE", help="capture the output of the script's commands in FILE")
+    args = parser.parse_args(argv)
+    try:
+        sys.stdout = ThreadOutput(sys.stdout)  # Lets the audit log record each command's last line of output
+        if args.script is not None:
+            with contextlib.ExitStack() as stack:
+                lines, output = open_script(args.script, "quiet" if args.quiet else args.output, stack)
+                with redirect_output(output):
+                    fs = FileSystem()
+                    fs.load_disk()
+                    count, elapsed, running = run_script(fs, lines)
+                    if running:
+                        fs.shutdown()
+            print(f"Ran {count} command(s) in {elapsed:.3f} s ({count / max(elapsed, 1e-9):.0f} commands/s).",
+                  file=sys.stderr)
+            return
+
         fs = FileSystem()
         fs.load_disk()
 
         while True:
-            command = input("C:\\> ").strip()
+            try:
+                command = input("C:\\> ").strip()
+            except EOFError:  # End of piped input, or Ctrl-D
+                fs.shutdown()
+                break
             if not command:
                 continue
 
-            fs.log_command(command)
-            args = command.split()
-            cmd = args[0].lower()
-            params = args[1:]
-
-            try:
-                if cmd == "format":
-                    fs.format_disk()
-                elif cmd == "create" and len(params) == 2:
-                    fs.create_file(params[0], params[1].encode('utf-8'))
-                elif cmd == "delete" and len(params) == 1:
-                    fs.delete_file(params[0])
-                elif cmd == "rename" and len(params) == 2:
-                    fs.rename_file(params[0], params[1])
-                elif cmd == "read" and len(params) == 1:
-                    fs.read_file(params[0])
-                elif cmd == "run" and len(params) == 1:
-                    fs.run_file(params[0])
-                elif cmd == "dir":
-                    fs.list_files()
-                elif cmd == "copy" and len(params) == 2:
-                    fs.copy_file(params[0], params[1])
-                elif cmd == "find" and len(params) == 1:
-                    fs.find_file(params[0])
-                elif cmd == "mkdir" and len(params) == 1:
-                    fs.mkdir(params[0])
-                elif cmd == "rmdir" and len(params) == 1:
-                    fs.rmdir(params[0])
-                elif cmd == "cd" and len(params) == 1:
-                    fs.cd(params[0])
-                elif cmd == "cdup":
-                    fs.cdup()
-                elif cmd == "pwd":
-                    fs.pwd()
-                elif cmd == "compress" and len(params) == 1:
-                    fs.compress_file(params[0])
-                elif cmd == "decompress" and len(params) == 1:
-                    fs.decompress_file(params[0])
-                elif cmd == "schedule" and len(params) == 2:
-                    try:
-                        delay = int(params[1])
-                        fs.schedule_file(params[0], delay)
-                    except ValueError:
-                        print("Invalid time format. Please provide an integer.")
-                elif cmd == "storage":
-                    fs.check_storage()
-                elif cmd == "help":
-                    fs.help_menu()
-                elif cmd == "exit":
-                    fs.shutdown()
-                    break
-                else:
-                    print("Invalid command or arguments.")
-            except Exception as e:
-                print(f"Error executing command '{cmd}': {e}")
+            if not run_audited(fs, command):
+                break
     except Exception as e:
         print(f"Fatal error: {e}")
 